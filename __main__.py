@@ -0,0 +1,12 @@
+# __main__.py
+# Command-line batch runner: python -m Netflux2 models... -s scenarios.json -o results.npz
+# (or python path/to/Netflux2 ...). See batchRunner.py for the scenario file format.
+
+import os, sys
+
+# the modules import each other as top-level modules (import xls2model), as in the webapp
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import batchRunner
+
+if __name__ == '__main__':
+    sys.exit(batchRunner.main())
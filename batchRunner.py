@@ -0,0 +1,297 @@
+# batchRunner.py
+# Headless batch simulations (python -m Netflux2, see __main__.py): runs a list of scenarios for one or
+# more model files in parallel and writes all trajectories to a single compressed NPZ or Parquet file.
+#
+# Scenario file (JSON), either a list of scenarios or
+#   {"defaults": {"tspan": [0, 50], "numPoints": 201},
+#    "scenarios": [{"name": "control"},
+#                  {"name": "highInput", "params": {"w[r1]": 1.0}},
+#                  {"name": "noB", "model": "exampleNet", "perturbations": [{"species": "B", "knockdown": 1}],
+#                   "species": ["A", "C"], "steadyState": true}]}
+# scenario keys (values in "defaults" apply to every scenario):
+#   name           unique per model (default scenario1, scenario2, ...)
+#   model          model name (file name without .xlsx) or list of names, default: every model
+#   params         parameter values by label, e.g. {"w[r1]": 1.0, "tau[C]": 2} (simulation.paramLabels)
+#   perturbations  protocol steps applied after params (protocols.py), e.g.
+#                    {"param": label, "scale": factor} or {"param": label, "value": value}
+#                    {"species": ID, "knockdown": fraction}   ymax *= 1 - fraction (1 = knockout)
+#                    {"species": ID, "clamp": value}          species held at value
+#                  without "t" they apply from the start; with "t" (e.g. {"t": 50, "species": "B",
+#                  "knockdown": 1}) the scenario runs as a timed protocol (protocols.runProtocol)
+#   tspan          [t0, tmax], default [0, 10]
+#   numPoints      output time points over tspan, default 101 (null keeps every solver step)
+#   t_eval         explicit output times within tspan (instead of numPoints)
+#   species        output species IDs, default all
+#   dtype          'float64' (default) or 'float32' for the stored y
+#   solver         one of simulation.SOLVERS, default 'auto'
+#   steadyState    stop once at steady state (simulation.runToSteadyState), default false
+# Without a scenario file every model runs one 'control' scenario.
+#
+# Models are parsed once in this process (modelCache.loadModel -> xls2model.createModel) and scenarios
+# are resolved into full parameter vectors here, so mistakes are reported before anything runs. The
+# parsed models are sent once to each worker (workerPool.poolMap), which compiles every model once
+# (modelRegistry.getCompiledModel); tasks only carry a parameter vector and the run options.
+#
+# Output, written as results arrive (to <output>.part, renamed when complete):
+#   .npz      '<model>/<scenario>/t', '<model>/<scenario>/y' (species x time), '<model>/<scenario>/species'
+#             and 'summary' (JSON text of the summary table); load with np.load, no pickle needed
+#   .parquet  long table with columns model, scenario, species, t, value (needs pyarrow)
+
+import argparse, json, os, sys, time, zipfile
+import numpy as np
+import modelCache, modelRegistry, simulation, instrumentation, protocols, workerPool
+
+OUTPUT_FORMATS = ('npz', 'parquet')
+DEFAULTS = {'tspan': [0, 10], 'numPoints': 101, 't_eval': None, 'species': None, 'dtype': 'float64',
+            'solver': 'auto', 'steadyState': False, 'params': {}, 'perturbations': []}
+SCENARIO_KEYS = set(DEFAULTS) | {'name', 'model'}
+
+def loadScenarios(filename, defaults=None):
+    # scenarios from a JSON file, each merged with DEFAULTS, the file's "defaults" and defaults (e.g. from
+    # command-line options); values given in a scenario always win
+    with open(filename) as f:
+        spec = json.load(f)
+    if isinstance(spec, list):
+        spec = {'scenarios': spec}
+    return mergeScenarios(spec.get('scenarios', []), {**spec.get('defaults', {}), **(defaults or {})})
+
+def mergeScenarios(scenarios, defaults=None):
+    # complete scenario dicts (default names scenario1, scenario2...), checking for unknown keys
+    merged = []
+    for i, scenario in enumerate(scenarios):
+        scenario = {**DEFAULTS, **(defaults or {}), **scenario}
+        unknown = set(scenario) - SCENARIO_KEYS
+        if unknown:
+            raise ValueError(f"Unknown scenario key(s) {sorted(unknown)}, expected {sorted(SCENARIO_KEYS)}")
+        scenario.setdefault('name', f"scenario{i+1}")
+        merged.append(scenario)
+    if not merged:
+        raise ValueError("No scenarios given")
+    return merged
+
+def loadModels(filenames):
+    # parsed NetfluxModels of the model files (names must be unique)
+    models = []
+    for filename in filenames:
+        try:
+            models.append(modelCache.loadModel(filename))
+        except ValueError as e:
+            raise ValueError(f"{filename}: {e}") from None
+    names = [str(mymodel.modelName) for mymodel in models]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate model name(s) {duplicates}, rename the files")
+    return models
+
+def resolveTasks(models, scenarios):
+    # one task per (model, scenario): JSON-like dict with the full parameter vector and run options
+    tasks, seen = [], set()
+    modelNames = [str(mymodel.modelName) for mymodel in models]
+    for scenario in scenarios:
+        selected = scenario.get('model') or modelNames
+        selected = [selected] if isinstance(selected, str) else list(selected)
+        for name in selected:
+            if name not in modelNames:
+                raise ValueError(f"Scenario {scenario['name']!r}: unknown model {name!r}, expected one of {modelNames}")
+            if (name, scenario['name']) in seen:
+                raise ValueError(f"Duplicate scenario {scenario['name']!r} for model {name}")
+            seen.add((name, scenario['name']))
+            mymodel = models[modelNames.index(name)]
+            try:
+                tasks.append(resolveTask(mymodel, modelNames.index(name), scenario))
+            except ValueError as e:
+                raise ValueError(f"Scenario {scenario['name']!r}, model {name}: {e}") from None
+    return tasks
+
+def resolveTask(mymodel, modelNum, scenario):
+    params = simulation.modelParams(mymodel)
+    if scenario['params']:
+        labels = list(scenario['params'])
+        params[simulation.paramColumns(mymodel, labels)] = [float(scenario['params'][label]) for label in labels]
+    tspan = tuple(float(t) for t in scenario['tspan'])
+    if len(tspan) != 2 or not tspan[1] >= tspan[0]:
+        raise ValueError(f"tspan must be [t0, tmax] with tmax >= t0, got {scenario['tspan']}")
+    speciesIDs = list(mymodel.speciesIDs)
+    S, R = len(speciesIDs), len(mymodel.reactionIDs)
+    steps = protocols.compileProtocol(mymodel, scenario['perturbations'], tspan[0])
+    timed = [step for step in steps if step.t > tspan[0]]
+    if timed and scenario['steadyState']:
+        raise ValueError("timed perturbations cannot be combined with steadyState")
+    clamps = []
+    if not timed:   # everything applies at the start: a plain simulation of the perturbed parameters
+        free = np.ones(S)
+        for step in steps:
+            protocols.applyStep(step, params, params[:S], free)     # params[:S] is a view of y0
+        clamps, steps = np.flatnonzero(free == 0).tolist(), []
+    output = speciesIDs if scenario['species'] is None else list(scenario['species'])
+    t_eval = simulation.outputGrid(tspan, scenario['t_eval'], scenario['numPoints'])
+    simulation.selectSolver(simulation.splitParams(params, S, R)[2], scenario['solver'])  # checks the name
+    return {'model': modelNum, 'modelName': str(mymodel.modelName), 'scenario': str(scenario['name']),
+            'params': params, 'clamps': clamps, 'steps': steps, 'tspan': tspan,
+            't_eval': t_eval, 'species': simulation.outputSpecies(speciesIDs, output), 'speciesIDs': output,
+            'dtype': simulation.checkDtype(scenario['dtype']),
+            'solver': scenario['solver'], 'steadyState': bool(scenario['steadyState'])}
+
+def compileModels(models):
+    # compiles each model once per worker (workerPool setup)
+    return [modelRegistry.getCompiledModel(mymodel) for mymodel in models]
+
+def runTask(compiledModels, task):
+    # simulates one task, returns a result dict (error set instead of raising)
+    result = {'modelName': task['modelName'], 'scenario': task['scenario'], 'speciesIDs': task['speciesIDs'],
+              't': None, 'y': None, 'error': None, 'stats': None, 'steadyState': None}
+    start = time.perf_counter()
+    try:
+        solution = simulateTask(compiledModels[task['model']], task)
+        result['t'] = np.asarray(solution.t, dtype=float)
+        result['y'] = np.asarray(solution.y[task['species']], dtype=task['dtype'])
+        result['stats'] = instrumentation.solverStats(solution)
+        if task['steadyState']:
+            result['steadyState'] = bool(solution.steadyState['reached'])
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def simulateTask(compiledModel, task):
+    if task['steps']:
+        return protocols.runProtocol(compiledModel, task['tspan'], task['params'], task['steps'],
+                                     solver=task['solver'], t_eval=task['t_eval'])
+    y0, ymax, tau, w, n, EC50 = simulation.splitParams(task['params'], compiledModel.numSpecies, compiledModel.numReactions)
+    ODEfunc = compiledModel.ODEfunc
+    if task['clamps']:
+        free = np.ones(compiledModel.numSpecies)
+        free[task['clamps']] = 0.0
+        ODEfunc = protocols.clampedODEfunc(ODEfunc, free)
+    options = {} if task['t_eval'] is None else {'t_eval': task['t_eval']}
+    run = simulation.runToSteadyState if task['steadyState'] else simulation.runSimulation
+    return run(ODEfunc, task['tspan'], y0, (ymax, tau, w, n, EC50), task['solver'], compiledModel, **options)
+
+def iterResults(models, tasks, maxWorkers=None):
+    # yields result dicts as the tasks finish (order not guaranteed); maxWorkers=1 runs in this process
+    maxWorkers = maxWorkers or min(os.cpu_count() or 1, len(tasks))
+    yield from workerPool.poolMap(runTask, tasks, models, maxWorkers, setup=compileModels)
+
+def outputFormat(filename, fmt=None):
+    fmt = fmt or os.path.splitext(filename)[1].lstrip('.').lower()
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {fmt!r}, expected one of {OUTPUT_FORMATS} (.npz or .parquet)")
+    return fmt
+
+class NPZWriter:
+    # compressed .npz written one array at a time (same layout as np.savez_compressed)
+    def __init__(self, filename):
+        self.zf = zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+
+    def add(self, name, array):
+        with self.zf.open(name + '.npy', 'w', force_zip64=True) as f:
+            np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+
+    def write(self, result):
+        if result['error'] is None:
+            key = f"{result['modelName']}/{result['scenario']}"
+            self.add(key + '/t', result['t'])
+            self.add(key + '/y', result['y'])
+            self.add(key + '/species', np.array(result['speciesIDs'], dtype=str))
+
+    def close(self, summary):
+        self.add('summary', np.array(json.dumps(summary)))
+        self.zf.close()
+
+class ParquetWriter:
+    # long-format parquet table (model, scenario, species, t, value), one row group per result;
+    # value is float32 only if every scenario asked for float32 (one schema per file)
+    def __init__(self, filename, dtype='float64'):
+        import trajectoryExport
+        self.pa, pq = trajectoryExport.requirePyarrow()
+        self.dtype = np.dtype(dtype)
+        schema = self.pa.schema([('model', self.pa.string()), ('scenario', self.pa.string()), ('species', self.pa.string()),
+                                 ('t', self.pa.float64()), ('value', self.pa.from_numpy_dtype(self.dtype))])
+        self.writer = pq.ParquetWriter(filename, schema, compression='zstd')
+
+    def write(self, result):
+        if result['error'] is None:
+            T, S = len(result['t']), len(result['speciesIDs'])
+            self.writer.write_table(self.pa.table({
+                'model': [result['modelName']]*(S*T), 'scenario': [result['scenario']]*(S*T),
+                'species': np.repeat(np.array(result['speciesIDs'], dtype=str), T).tolist(),
+                't': np.tile(result['t'], S), 'value': result['y'].ravel().astype(self.dtype)}))
+
+    def close(self, summary):
+        self.writer.close()
+
+def summaryRow(result):
+    stats = result['stats'] or {}
+    return {'model': result['modelName'], 'scenario': result['scenario'],
+            'status': 'failed' if result['error'] else 'ok', 'error': result['error'],
+            'method': stats.get('method'), 'timePoints': stats.get('timePoints'), 'nfev': stats.get('nfev'),
+            'steadyState': result['steadyState'], 'seconds': result['seconds']}
+
+def printSummary(summary, stream=sys.stdout):
+    print(f"{'model':24s} {'scenario':24s} {'status':7s} {'method':7s} {'points':>7s} {'nfev':>8s} "
+          f"{'steady':>6s} {'seconds':>9s}", file=stream)
+    for row in summary:
+        steady = '-' if row['steadyState'] is None else ('yes' if row['steadyState'] else 'no')
+        print(f"{row['model'][:24]:24s} {row['scenario'][:24]:24s} {row['status']:7s} {str(row['method'] or '-'):7s} "
+              f"{str(row['timePoints'] or '-'):>7s} {str(row['nfev'] or '-'):>8s} {steady:>6s} {row['seconds']:9.3f}",
+              file=stream)
+        if row['error']:
+            print(f"    {row['error']}", file=stream)
+
+def runBatch(modelFiles, scenarios, output, fmt=None, maxWorkers=None):
+    # runs every scenario for the model files and writes output; returns the summary rows (task order)
+    fmt = outputFormat(output, fmt)
+    models = loadModels(modelFiles)
+    tasks = resolveTasks(models, scenarios)
+    partial = output + '.part'
+    if fmt == 'npz':
+        writer = NPZWriter(partial)
+    else:
+        writer = ParquetWriter(partial, 'float32' if all(task['dtype'] == 'float32' for task in tasks) else 'float64')
+    rows = {}
+    try:
+        for result in iterResults(models, tasks, maxWorkers):
+            writer.write(result)
+            rows[(result['modelName'], result['scenario'])] = summaryRow(result)
+        summary = [rows[(task['modelName'], task['scenario'])] for task in tasks]
+        writer.close(summary)
+    except BaseException:
+        os.remove(partial)
+        raise
+    os.replace(partial, output)
+    return summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m Netflux2',
+                                     description="Run Netflux simulation scenarios for model files in parallel")
+    parser.add_argument('models', nargs='+', help="model spreadsheets (.xlsx)")
+    parser.add_argument('-s', '--scenarios', help="scenario file (JSON); default: one 'control' scenario per model")
+    parser.add_argument('-o', '--output', default='netflux_results.npz', help="output file, .npz or .parquet")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, help="output format (default: from the file extension)")
+    parser.add_argument('-j', '--workers', type=int, help="worker processes (default: one per core, 1 = no pool)")
+    parser.add_argument('--tspan', type=float, nargs=2, help="tspan of scenarios that do not set their own")
+    parser.add_argument('--solver', choices=simulation.SOLVERS, help="solver of scenarios that do not set their own")
+    parser.add_argument('--points', type=int, help="numPoints of scenarios that do not set their own")
+    parser.add_argument('--dtype', choices=simulation.OUTPUT_DTYPES, help="dtype of scenarios that do not set their own")
+    args = parser.parse_args(argv)
+
+    options = (('tspan', args.tspan), ('solver', args.solver), ('numPoints', args.points), ('dtype', args.dtype))
+    defaults = {key: value for key, value in options if value is not None}
+    try:
+        if args.scenarios:
+            scenarios = loadScenarios(args.scenarios, defaults)
+        else:
+            scenarios = mergeScenarios([{'name': 'control'}], defaults)
+        start = time.perf_counter()
+        summary = runBatch(args.models, scenarios, args.output, args.format, args.workers)
+    except (ValueError, OSError) as e:
+        print(f"netflux: {e}", file=sys.stderr)
+        return 2
+    printSummary(summary)
+    failed = sum(row['status'] != 'ok' for row in summary)
+    print(f"{len(summary) - failed} of {len(summary)} simulations written to {args.output} "
+          f"in {time.perf_counter() - start:.2f} s", file=sys.stderr)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,217 @@
+# benchmark.py
+# Times every stage of the Netflux pipeline for the model library and for random networks
+# (randomNetwork.py), and writes the results as JSON so runs can be compared across commits.
+#
+# stages (seconds, best of --repeat runs):
+#   parse            xls2model.createModel (xlsxReader + createInteractionMatrix), library models only
+#   interactionMatrix  xls2model.createInteractionMatrix on the parsed rules
+#   generateODEfile  model2PythonODE.generateODEfile
+#   compilePython    exec of the generated ODE source
+#   compileNumpy     model2NumpyODE.compileModel
+#   rhsPython, rhsPythonLegacy, rhsNumpy  one right-hand-side evaluation (makeODEfunc closure,
+#                    ODEfunc(t,y,params...) and CompiledModel.ODEfunc)
+#   solvePython, solveNumpy  simulation.runSimulation over [0, tmax] (plus method, nfev, steps)
+#   xgmml            model2xgmml.write_xgmml to memory
+#
+# usage:
+#   python benchmark.py                                 library models, results as JSON on stdout
+#   python benchmark.py --sizes 100 1000 10000 -o results.json
+#   python benchmark.py --no-library --sizes 20000 --skip solvePython rhsPythonLegacy
+#   python benchmark.py --no-library --check-imports   exit status 1 if a module import is over its
+#                                                      IMPORT_BUDGETS time or loads a HEAVY_MODULES entry
+
+import argparse, datetime, glob, io, json, os, platform, subprocess, sys, tempfile, time, warnings
+import numpy as np
+import scipy
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import xls2model, model2PythonODE, model2NumpyODE, model2xgmml, simulation, randomNetwork
+
+STAGES = ('parse', 'interactionMatrix', 'generateODEfile', 'compilePython', 'compileNumpy',
+          'rhsPython', 'rhsPythonLegacy', 'rhsNumpy', 'solvePython', 'solveNumpy', 'xgmml')
+IMPORT_MODULES = ('xls2model', 'model2PythonODE', 'model2NumpyODE', 'simulation', 'webapp')
+# cold-start budgets (seconds, generous for slow machines) and packages each module must not load at
+# import time: the core only needs numpy and scipy.sparse, the webapp loads plotting and solvers on first use
+IMPORT_BUDGETS = {'xls2model': 1.0, 'model2PythonODE': 1.0, 'model2NumpyODE': 1.0, 'simulation': 1.0, 'webapp': 2.0}
+CORE_FORBIDDEN = ('pandas', 'matplotlib', 'scipy.integrate', 'scipy.optimize', 'openpyxl', 'flask')
+HEAVY_MODULES = {'xls2model': CORE_FORBIDDEN, 'model2PythonODE': CORE_FORBIDDEN, 'model2NumpyODE': CORE_FORBIDDEN,
+                 'simulation': CORE_FORBIDDEN,
+                 'webapp': ('pandas', 'matplotlib', 'scipy.integrate', 'scipy.optimize', 'openpyxl')}
+
+def bestTime(func, repeat=3, number=1):
+    # best wall time of func() over repeat runs of number calls each, and the last result
+    best, result = np.inf, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            result = func()
+        best = min(best, (time.perf_counter() - start)/number)
+    return best, result
+
+def callsPerRun(func, target=0.05):
+    # number of calls of a fast func that take about target seconds
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    return max(1, int(target/max(elapsed, 1e-7)))
+
+def loadODEtext(ODEfuncText):
+    namespace = {}
+    exec(compile(ODEfuncText, '<ODEfuncText>', 'exec'), namespace)
+    return namespace
+
+def benchmarkModel(mymodel, filename=None, repeat=3, tmax=10, skip=()):
+    # runs the stages for one model, returns a JSON-compatible dict
+    S, R = len(mymodel.speciesIDs), len(mymodel.reactionIDs)
+    entry = {'model': str(mymodel.modelName), 'file': filename, 'numSpecies': S, 'numReactions': R,
+             'numInteractions': int(abs(mymodel.interactionMatrix).sum()), 'stages': {}}
+    stages = entry['stages']
+    def run(stage, func, number=1):
+        if stage in skip:
+            return None
+        stages[stage], result = bestTime(func, repeat, number)
+        return result
+
+    if filename:
+        run('parse', lambda: xls2model.createModel(filename))
+    run('interactionMatrix', lambda: xls2model.createInteractionMatrix(mymodel))
+    ODEfuncText = model2PythonODE.generateODEfile(mymodel)
+    run('generateODEfile', lambda: model2PythonODE.generateODEfile(mymodel))
+    namespace = run('compilePython', lambda: loadODEtext(ODEfuncText)) or loadODEtext(ODEfuncText)
+    compiledModel = run('compileNumpy', lambda: model2NumpyODE.compileModel(mymodel)) or model2NumpyODE.compileModel(mymodel)
+
+    params = simulation.modelParams(mymodel)
+    y0, ymax, tau, w, n, EC50 = simulation.splitParams(params, S, R)
+    y = np.random.default_rng(0).uniform(0, 1, S)
+    ODEfunc = namespace['makeODEfunc'](ymax, tau, w, n, EC50)
+    for stage, func in (('rhsPython', lambda: ODEfunc(0, y)),
+                        ('rhsPythonLegacy', lambda: namespace['ODEfunc'](0, y, ymax, tau, w, n, EC50)),
+                        ('rhsNumpy', lambda: compiledModel.ODEfunc(0, y, ymax, tau, w, n, EC50))):
+        if stage not in skip:
+            run(stage, func, callsPerRun(func))
+
+    for stage, func in (('solvePython', namespace['ODEfunc']), ('solveNumpy', compiledModel.ODEfunc)):
+        if stage in skip:
+            continue
+        solution = run(stage, lambda: simulation.runSimulation(func, [0, tmax], y0, (ymax, tau, w, n, EC50),
+                                                               'auto', compiledModel))
+        stages[stage + 'Info'] = {'method': solution.method, 'nfev': int(solution.nfev), 'njev': int(solution.njev),
+                                  'timePoints': int(len(solution.t))}
+
+    run('xgmml', lambda: model2xgmml.write_xgmml(mymodel, io.StringIO()))
+    return entry
+
+def importTimes():
+    # seconds to import each module in a fresh interpreter (cold start of the webapp and scripts), and
+    # which of its HEAVY_MODULES got loaded along the way
+    # runs in an empty working directory, so importing webapp does not create sessions or caches here
+    times, loaded = {}, {}
+    root = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+    with tempfile.TemporaryDirectory() as workdir:
+        for module in IMPORT_MODULES:
+            code = (f"import json, sys, time; start = time.perf_counter(); import {module}; "
+                    f"print(json.dumps([time.perf_counter() - start, "
+                    f"[m for m in {list(HEAVY_MODULES.get(module, ()))!r} if m in sys.modules]]))")
+            try:
+                output = subprocess.run([sys.executable, '-c', code], cwd=workdir, env=env,
+                                        capture_output=True, text=True, timeout=120)
+                times[module], loaded[module] = json.loads(output.stdout.strip().splitlines()[-1])
+            except Exception as e:
+                print(f"benchmark: could not time import {module}: {e}", file=sys.stderr)
+                times[module], loaded[module] = None, None
+    return times, loaded
+
+def checkImports(times, loaded):
+    # list of budget violations (empty if every import is within IMPORT_BUDGETS and loads no HEAVY_MODULES)
+    problems = []
+    for module in IMPORT_MODULES:
+        if times.get(module) is None:
+            problems.append(f"{module}: import failed")
+            continue
+        if times[module] > IMPORT_BUDGETS.get(module, float('inf')):
+            problems.append(f"{module}: import took {times[module]:.3f} s (budget {IMPORT_BUDGETS[module]} s)")
+        if loaded.get(module):
+            problems.append(f"{module}: import loaded {', '.join(loaded[module])}")
+    return problems
+
+def environment():
+    # versions and commit, so result files can be compared across machines and commits
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'date': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': commit,
+            'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+            'platform': platform.platform(), 'cpuCount': os.cpu_count()}
+
+def printSummary(results, stream=sys.stderr):
+    # table of stage times in milliseconds
+    columns = [stage for stage in STAGES if any(stage in entry['stages'] for entry in results['models'])]
+    print(f"{'model':40s} {'species':>8s} " + ' '.join(f"{c[:14]:>14s}" for c in columns), file=stream)
+    for entry in results['models']:
+        times = ' '.join(f"{1e3*entry['stages'][c]:14.3f}" if c in entry['stages'] else f"{'-':>14s}" for c in columns)
+        print(f"{entry['model'][:40]:40s} {entry['numSpecies']:8d} {times}", file=stream)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Netflux pipeline (times in seconds, JSON output)")
+    parser.add_argument('--models', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models', '*.xlsx'),
+                        help="glob of model spreadsheets (default: models/*.xlsx)")
+    parser.add_argument('--no-library', action='store_true', help="skip the spreadsheet models")
+    parser.add_argument('--sizes', type=int, nargs='*', default=[], help="species counts of random networks")
+    parser.add_argument('--fan-in', type=int, default=2, help="reactants of AND reactions")
+    parser.add_argument('--and-fraction', type=float, default=0.2)
+    parser.add_argument('--not-fraction', type=float, default=0.2)
+    parser.add_argument('--feedback', type=float, default=0.05, help="fraction of reactions with any-species reactants")
+    parser.add_argument('--reactions-per-species', type=float, default=1.5)
+    parser.add_argument('--tau-range', type=float, nargs=2, default=[1, 1], help="log-uniform tau range (wide = stiff)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tmax', type=float, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--skip', nargs='*', default=[], choices=STAGES, help="stages to skip")
+    parser.add_argument('--imports', action='store_true', help="also time module imports in fresh interpreters")
+    parser.add_argument('--check-imports', action='store_true',
+                        help="time imports and exit with status 1 if one is over budget or loads a heavy module")
+    parser.add_argument('-o', '--output', help="JSON file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter('ignore', RuntimeWarning)
+    results = {'environment': environment(), 'settings': vars(args), 'models': []}
+    if not args.no_library:
+        for filename in sorted(glob.glob(args.models)):
+            if os.path.basename(filename) == 'library.xlsx' or os.path.basename(filename).startswith('~$'):
+                continue
+            print(f"benchmark: {filename}", file=sys.stderr)
+            mymodel = xls2model.createModel(filename)
+            results['models'].append(benchmarkModel(mymodel, filename, args.repeat, args.tmax, args.skip))
+    for size in args.sizes:
+        print(f"benchmark: random network with {size} species", file=sys.stderr)
+        start = time.perf_counter()
+        mymodel = randomNetwork.randomModel(size, tauRange=tuple(args.tau_range), seed=args.seed,
+                                            reactionsPerSpecies=args.reactions_per_species, fanIn=args.fan_in,
+                                            andFraction=args.and_fraction, notFraction=args.not_fraction,
+                                            feedback=args.feedback)
+        generated = time.perf_counter() - start
+        entry = benchmarkModel(mymodel, None, args.repeat, args.tmax, args.skip)
+        entry['stages']['generateNetwork'] = generated
+        results['models'].append(entry)
+    if args.imports or args.check_imports:
+        results['imports'], results['importedHeavyModules'] = importTimes()
+        results['importProblems'] = checkImports(results['imports'], results['importedHeavyModules'])
+        for problem in results['importProblems']:
+            print(f"benchmark: {problem}", file=sys.stderr)
+
+    printSummary(results)
+    text = json.dumps(results, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    return results
+
+if __name__ == '__main__':
+    results = main()
+    if results['settings']['check_imports'] and results['importProblems']:
+        sys.exit(1)
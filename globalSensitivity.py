@@ -0,0 +1,315 @@
+# globalSensitivity.py
+# Global parameter sensitivity analysis: which w, n, EC50 and tau values drive the outputs of a model,
+# over whole parameter ranges instead of one knockdown at a time (sensitivity.py).
+#
+# The sampled parameters are labels such as 'w[r1]' (default: every w, n, EC50 and tau) with bounds
+# (default nominal*(1 -/+ spread), w from 0 to 1 so inputs with w = 0 are sampled too; other parameters
+# with nominal value 0 need explicit bounds). The Hill function needs EC50**n < 0.5, so the default
+# spread of a reaction's n and EC50 is narrowed until its whole box is valid; parameter sets outside
+# that region (from explicit bounds) are not simulated and give nan. Designs, in the unit cube:
+#   'lhs'      Latin hypercube, numSamples rows
+#   'morris'   numSamples one-at-a-time trajectories on a grid of levels, numSamples*(D+1) rows
+#   'sobol'    Saltelli design: Latin hypercubes A and B, then A with column i taken from B for each
+#              parameter, numSamples*(D+2) rows
+# Every row is simulated over tspan, and only output summaries (SUMMARIES) are kept:
+#   'final'    value at tspan[1]
+#   'auc'      area under the curve (trapezoid rule on the output grid)
+#   'thalf'    time to half of the largest change from y0 (nan if the species does not change)
+# morrisIndices gives mu, mu* and sigma of the elementary effects (per unit of the parameter range),
+# sobolIndices the first order (S1, Saltelli 2010) and total (ST, Jansen) indices.
+#
+# Rows are simulated in batches with simulation.simulateEnsemble on a process pool (workerPool.poolMap);
+# the compiled model is sent once per worker and at most 2 batches per worker are in flight.
+# Design rows are generated batch by batch (from A and B, or the Morris trajectory starts) and the
+# summaries are written into one preallocated (rows x outputs x summaries) array, so memory stays
+# bounded for 10^5+ rows.
+#
+# usage:
+#   python globalSensitivity.py models/Zeigler2016_cardiac_fibroblast.xlsx --method morris -n 50 --outputs aSMA
+
+import argparse, os, sys, warnings
+from collections import namedtuple
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import modelCache, modelRegistry, simulation, workerPool
+
+METHODS = ('lhs', 'morris', 'sobol')
+SUMMARIES = ('final', 'auc', 'thalf')
+PARAM_GROUPS = ('w', 'n', 'EC50', 'tau')    # sampled by default
+DEFAULT_SPREAD = 0.5
+MORRIS_LEVELS = 4
+
+# method, number of rows, number of parameters, and the arrays the rows are generated from
+Design = namedtuple('Design', 'method numRows numParams data')
+
+# ------------------- parameter space and designs ---------------------
+
+def parameterSpace(model, columns=None, bounds=None, spread=DEFAULT_SPREAD):
+    # (labels, positions in the full parameter vector, lower, upper) of the sampled parameters
+    # bounds: {label: (low, high)} overriding the default nominal*(1 -/+ spread), (0, 1) for w
+    labels = simulation.paramLabels(model)
+    if columns is None:
+        columns = [label for label in labels if label.split('[')[0] in PARAM_GROUPS]
+    columns = [labels[c] if isinstance(c, (int, np.integer)) else c for c in columns]
+    positions = simulation.paramColumns(model, columns)
+    nominal = simulation.modelParams(model)[positions]
+    labelSpread = np.full(len(columns), float(spread))
+    hill = {}   # reaction ID -> positions of its sampled n and EC50
+    for i, label in enumerate(columns):
+        name, ID = label.split('[', 1)
+        if name in ('n', 'EC50'):
+            hill.setdefault(ID[:-1], []).append(i)
+    if hill:
+        IDs = list(hill)
+        nNominal, EC50nominal = simulation.modelParams(model)[simulation.paramColumns(model, [f"{name}[{ID}]" for name in ('n', 'EC50') for ID in IDs])].reshape(2, -1)
+        for ID, reactionSpread in zip(IDs, validHillSpread(nNominal, EC50nominal, spread)):
+            labelSpread[hill[ID]] = reactionSpread
+    lower, upper = nominal*(1 - labelSpread), nominal*(1 + labelSpread)
+    isWeight = np.array([label.startswith('w[') for label in columns], dtype=bool)
+    lower[isWeight], upper[isWeight] = 0.0, 1.0     # like parameterEstimation.fitBounds; inputs often have w = 0
+    lower = np.minimum(lower, upper)
+    index = {label: i for i, label in enumerate(columns)}
+    for label, (low, high) in (bounds or {}).items():
+        if label not in index:
+            raise ValueError(f"Bounds given for {label}, which is not a sampled parameter")
+        if not low <= high:
+            raise ValueError(f"Bounds of {label} must have low <= high, got ({low}, {high})")
+        lower[index[label]], upper[index[label]] = low, high
+    fixed = [label for label, value, low, high in zip(columns, nominal, lower, upper)
+             if value == 0 and low == high and label not in (bounds or {})]
+    if fixed:
+        raise ValueError(f"Default range of {', '.join(fixed)} is empty (nominal value 0); give bounds for them "
+                         f"or leave them out of columns")
+    return columns, positions, lower, upper
+
+def validHillSpread(n, EC50, spread, iterations=40):
+    # largest spread <= spread (per reaction) for which n*(1 - s) and EC50*(1 + s), the corner closest
+    # to EC50**n = 0.5, still give valid Hill constants (0 where the nominal values are not valid)
+    def valid(s):
+        return (EC50*(1 + s))**(n*(1 - s)) < 0.5*(1 - 1e-9)
+    low, high = np.zeros(len(n)), np.full(len(n), float(spread))
+    good = valid(high)
+    for _ in range(iterations):
+        middle = (low + high)/2
+        ok = valid(middle)
+        low, high = np.where(ok, middle, low), np.where(ok, high, middle)
+    return np.where(good, spread, low)
+
+def validParams(full, numSpecies, numReactions):
+    # True for the full parameter vectors (K x P) that the model can be simulated with:
+    # positive tau, n and EC50, and EC50**n < 0.5 (Hill constants, see model2NumpyODE.hillConstants)
+    y0, ymax, tau, w, n, EC50 = simulation.splitParams(full.T, numSpecies, numReactions)
+    with np.errstate(invalid='ignore', over='ignore'):
+        return (np.all(tau > 0, axis=0) & np.all(n > 0, axis=0) & np.all(EC50 > 0, axis=0)
+                & np.all(EC50**n < 0.5, axis=0))
+
+def latinHypercube(numSamples, numParams, rng):
+    # numSamples x numParams Latin hypercube in the unit cube (one sample per stratum of every parameter)
+    strata = np.argsort(rng.random((numSamples, numParams)), axis=0)
+    return (strata + rng.random((numSamples, numParams)))/numSamples
+
+def makeDesign(method, numSamples, numParams, seed=0, levels=MORRIS_LEVELS):
+    # Design for numSamples samples ('lhs', 'sobol') or trajectories ('morris')
+    rng = np.random.default_rng(seed)
+    if numSamples < 2:
+        raise ValueError(f"numSamples must be at least 2, got {numSamples}")
+    if method == 'lhs':
+        return Design(method, numSamples, numParams, {'samples': latinHypercube(numSamples, numParams, rng)})
+    if method == 'sobol':
+        data = {'A': latinHypercube(numSamples, numParams, rng), 'B': latinHypercube(numSamples, numParams, rng)}
+        return Design(method, numSamples*(numParams + 2), numParams, data)
+    if method == 'morris':
+        if levels < 2 or levels % 2:
+            raise ValueError(f"Morris levels must be even and at least 2, got {levels}")
+        # start levels, step direction (up unless that leaves the grid) and the order parameters are moved in
+        start = rng.integers(0, levels, (numSamples, numParams))
+        direction = np.where(start + levels//2 <= levels - 1, 1.0, -1.0)
+        order = np.argsort(rng.random((numSamples, numParams)), axis=1)
+        rank = np.argsort(order, axis=1)    # step at which each parameter is moved (0-based)
+        data = {'start': start/(levels - 1), 'direction': direction, 'order': order, 'rank': rank,
+                'delta': levels/(2*(levels - 1))}
+        return Design(method, numSamples*(numParams + 1), numParams, data)
+    raise ValueError(f"Unknown design method: {method}, expected one of {METHODS}")
+
+def designRows(design, start, stop):
+    # rows start..stop of a design, in the unit cube
+    rows = np.arange(start, stop)
+    data = design.data
+    if design.method == 'lhs':
+        return data['samples'][start:stop]
+    if design.method == 'sobol':
+        N = len(data['A'])
+        block, sample = rows//N, rows % N
+        x = data['A'][sample].copy()
+        x[block == 1] = data['B'][sample[block == 1]]
+        mixed = np.flatnonzero(block >= 2)
+        x[mixed, block[mixed] - 2] = data['B'][sample[mixed], block[mixed] - 2]
+        return x
+    trajectory, step = rows//(design.numParams + 1), rows % (design.numParams + 1)
+    moved = data['rank'][trajectory] < step[:, None]
+    return data['start'][trajectory] + moved*data['direction'][trajectory]*data['delta']
+
+def scaleRows(x, lower, upper):
+    # unit-cube rows to parameter values
+    return lower + x*(upper - lower)
+
+# ------------------- simulation ---------------------
+
+def summarize(t, y, summaries=SUMMARIES):
+    # output summaries of trajectories y (K x outputs x T) on the grid t, as (K x outputs x summaries)
+    result = np.empty(y.shape[:2] + (len(summaries),))
+    for m, name in enumerate(summaries):
+        if name == 'final':
+            result[..., m] = y[..., -1]
+        elif name == 'auc':
+            result[..., m] = np.sum((y[..., 1:] + y[..., :-1])*np.diff(t)/2, axis=-1)
+        elif name == 'thalf':
+            change = np.abs(y - y[..., :1])
+            half = change.max(axis=-1, keepdims=True)/2
+            k = np.argmax(change >= half, axis=-1)[..., None]    # first point past half of the largest change
+            k = np.maximum(k, 1)
+            a, b = np.take_along_axis(change, k - 1, -1), np.take_along_axis(change, k, -1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                fraction = np.clip((half - a)/(b - a), 0, 1)
+            thalf = (t[k - 1] + fraction*(t[k] - t[k - 1]))[..., 0]
+            result[..., m] = np.where(half[..., 0] > 1e-12, thalf, np.nan)
+        else:
+            raise ValueError(f"Unknown summary: {name}, expected one of {SUMMARIES}")
+    return result
+
+def runBatch(state, task):
+    # simulates one batch (start, values), returns (start, summaries)
+    # state: compiled model, nominal parameters, sampled positions and simulation options
+    compiledModel, params, positions, options = state
+    start, values = task
+    return start, batchSummaries(compiledModel, params, positions, values, **options)
+
+def batchSummaries(compiledModel, params, positions, values, tspan=(0, 10), numPoints=101, outputs=None,
+                   summaries=SUMMARIES, solver='auto'):
+    # summaries (B x outputs x summaries) of the parameter sets values (B x D); invalid parameter sets
+    # (validParams) give nan, and if the stacked batch fails its rows are simulated one by one
+    full = np.tile(params, (len(values), 1))
+    full[:, positions] = values
+    numOutputs = len(simulation.outputSpecies(compiledModel.speciesIDs, outputs))
+    result = np.full((len(full), numOutputs, len(summaries)), np.nan)
+    valid = np.flatnonzero(validParams(full, compiledModel.numSpecies, compiledModel.numReactions))
+    if len(valid) == 0:
+        return result
+    try:
+        t, y = simulation.simulateEnsemble(None, full[valid], tspan, numPoints=numPoints, solver=solver,
+                                           compiledModel=compiledModel, species=outputs)
+        result[valid] = summarize(t, y, summaries)
+    except RuntimeError:
+        if len(valid) > 1:
+            for i in valid:
+                result[i] = batchSummaries(compiledModel, params, positions, values[i:i+1], tspan, numPoints,
+                                           outputs, summaries, solver)[0]
+    return result
+
+def iterBatches(model, design, space, batchSize=32, maxWorkers=None, params=None, **options):
+    # yields (start row, summaries) as each batch finishes, starting order not guaranteed
+    # options: tspan, numPoints, outputs (species IDs), summaries, solver (see batchSummaries)
+    # maxWorkers=1 runs in this process without a pool
+    compiledModel = modelRegistry.getCompiledModel(model)
+    params = simulation.modelParams(model) if params is None else np.asarray(params, dtype=float)
+    columns, positions, lower, upper = space
+    tasks = ((start, scaleRows(designRows(design, start, min(start + batchSize, design.numRows)), lower, upper))
+             for start in range(0, design.numRows, batchSize))
+    yield from workerPool.poolMap(runBatch, tasks, (compiledModel, params, positions, options), maxWorkers)
+
+def evaluateDesign(model, design, space, outputs=None, summaries=SUMMARIES, dtype='float64', **options):
+    # summaries of every design row, (rows x outputs x summaries) in dtype ('float32' halves the memory)
+    # options are passed to iterBatches (tspan, numPoints, solver, batchSize, maxWorkers, params)
+    numOutputs = len(simulation.outputSpecies(model.speciesIDs, outputs))
+    results = np.empty((design.numRows, numOutputs, len(summaries)), dtype=simulation.checkDtype(dtype))
+    for start, block in iterBatches(model, design, space, outputs=outputs, summaries=summaries, **options):
+        results[start:start + len(block)] = block
+    return results
+
+# ------------------- indices ---------------------
+
+def morrisIndices(design, results):
+    # mu, mu* and sigma of the elementary effects, (parameters x outputs x summaries) each
+    data, D = design.data, design.numParams
+    r = len(data['order'])
+    steps = np.diff(results.reshape((r, D + 1) + results.shape[1:]).astype(float), axis=1)   # (r x D x ...)
+    # effect of each step, divided by the signed unit step of the parameter moved in it
+    moved = data['order']
+    stepSize = (np.take_along_axis(data['direction'], moved, 1)*data['delta']).reshape((r, D) + (1,)*(results.ndim - 1))
+    effects = np.empty_like(steps)
+    np.put_along_axis(effects, moved.reshape((r, D) + (1,)*(results.ndim - 1)), steps/stepSize, axis=1)
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)     # all-nan effects (e.g. thalf of a constant output)
+        return {'mu': np.nanmean(effects, axis=0), 'muStar': np.nanmean(np.abs(effects), axis=0),
+                'sigma': np.nanstd(effects, axis=0, ddof=1) if r > 1 else np.full(effects.shape[1:], np.nan)}
+
+def sobolIndices(design, results):
+    # first order (S1) and total (ST) Sobol indices, (parameters x outputs x summaries) each
+    N, D = len(design.data['A']), design.numParams
+    values = results.astype(float)
+    fA, fB = values[:N], values[N:2*N]
+    fAB = values[2*N:].reshape((D, N) + values.shape[1:])
+    with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        variance = np.nanvar(np.concatenate([fA, fB]), axis=0)
+        S1 = np.nanmean(fB*(fAB - fA), axis=1)/variance
+        ST = 0.5*np.nanmean((fA - fAB)**2, axis=1)/variance
+    return {'S1': S1, 'ST': ST}
+
+def globalSensitivity(model, method='sobol', numSamples=256, columns=None, bounds=None, spread=DEFAULT_SPREAD,
+                      outputs=None, summaries=SUMMARIES, seed=0, levels=MORRIS_LEVELS, **options):
+    # samples the parameters with method, simulates every row and returns a dict with columns, bounds,
+    # outputs, summaries, results (rows x outputs x summaries), failed (rows that were invalid or did not
+    # solve, all nan) and the indices of the method:
+    # 'morris': mu, muStar, sigma; 'sobol': S1, ST; 'lhs': samples (rows x parameters, for own analyses)
+    # options: tspan, numPoints, solver, batchSize, maxWorkers, params, dtype (see evaluateDesign)
+    space = parameterSpace(model, columns, bounds, spread)
+    columns, positions, lower, upper = space
+    design = makeDesign(method, numSamples, len(columns), seed, levels)
+    outputs = list(model.speciesIDs) if outputs is None else list(outputs)
+    results = evaluateDesign(model, design, space, outputs, summaries, **options)
+    analysis = {'method': method, 'columns': columns, 'lower': lower, 'upper': upper, 'outputs': outputs,
+                'summaries': list(summaries), 'results': results,
+                'failed': int(np.isnan(results.reshape(len(results), -1)).all(axis=1).sum())}
+    if method == 'morris':
+        analysis.update(morrisIndices(design, results))
+    elif method == 'sobol':
+        analysis.update(sobolIndices(design, results))
+    else:
+        analysis['samples'] = scaleRows(designRows(design, 0, design.numRows), lower, upper)
+    return analysis
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Global parameter sensitivity of a Netflux model")
+    parser.add_argument('model', help="model spreadsheet (.xlsx)")
+    parser.add_argument('--method', choices=METHODS, default='morris')
+    parser.add_argument('-n', '--samples', type=int, default=20, help="samples (lhs, sobol) or trajectories (morris)")
+    parser.add_argument('--outputs', nargs='+', help="output species (default: all)")
+    parser.add_argument('--summary', choices=SUMMARIES, default='final', help="summary the ranking is printed for")
+    parser.add_argument('--tmax', type=float, default=10)
+    parser.add_argument('--spread', type=float, default=DEFAULT_SPREAD)
+    parser.add_argument('-j', '--workers', type=int, help="worker processes (default: all cores)")
+    parser.add_argument('--top', type=int, default=10, help="parameters listed per output")
+    parser.add_argument('-o', '--output', help="save all arrays to this .npz file")
+    args = parser.parse_args(argv)
+
+    mymodel = modelCache.loadModel(args.model)
+    analysis = globalSensitivity(mymodel, args.method, args.samples, spread=args.spread, outputs=args.outputs,
+                                 tspan=(0, args.tmax), maxWorkers=args.workers)
+    index = {'morris': 'muStar', 'sobol': 'ST'}.get(args.method)
+    m = analysis['summaries'].index(args.summary)
+    print(f"{args.method}: {analysis['results'].shape[0]} simulations of {len(analysis['columns'])} parameters"
+          f" ({analysis['failed']} invalid or failed)")
+    if index is not None:
+        for o, output in enumerate(analysis['outputs']):
+            scores = analysis[index][:, o, m]
+            ranking = [i for i in np.argsort(-np.nan_to_num(scores, nan=-np.inf))[:args.top]]
+            print(f"{output} ({args.summary}, {index}): " + ', '.join(f"{analysis['columns'][i]}={scores[i]:.3g}" for i in ranking))
+    if args.output:
+        np.savez_compressed(args.output, **{key: np.asarray(value) for key, value in analysis.items()})
+        print(f"Saved {args.output}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,212 @@
+# instrumentation.py
+# Timings, solver statistics and cache counters for the webapp and simulation core, exported in
+# Prometheus text format (webapp /metrics) and per request as a Server-Timing header.
+#
+#   with stage('parse'): ...        times a stage: added to the current request's timings (if any)
+#                                   and to the netflux_stage_seconds summary
+#   startRequest() / endRequest()   per-request list of (stage, seconds), kept in a context variable
+#   stepCounter()                   solve_ivp event counting accepted steps (it never triggers)
+#   solverStats(solution, counter)  nfev, njev, nlu, accepted/rejected steps of a solution
+#   registerCache(name, stats)      exports a module's stats dict (e.g. modelRegistry.stats)
+#   prometheusText()                all metrics in the Prometheus text exposition format
+#   startProfiler(), saveProfile()  cProfile of a request, written to PROFILE_FOLDER/name-<time>.prof
+#   profiled(func, name)            runs func under cProfile the same way
+#
+# Metrics are process-wide and guarded by a lock; summaries keep only count and sum.
+
+import contextvars, cProfile, io, os, pstats, threading, time
+from contextlib import contextmanager
+
+PROFILE_FOLDER = './profiles'
+RK_EVALUATIONS = {'RK45': 6, 'RK23': 3, 'DOP853': 12}  # RHS evaluations per RK step attempt (after the first 2)
+
+_lock = threading.Lock()
+_summaries = {}     # (name, labels) -> [count, sum]
+_counters = {}      # (name, labels) -> value
+_gauges = {}        # (name, labels) -> value
+_caches = {}        # cache name -> stats dict
+_help = {
+    'netflux_stage_seconds': ('summary', 'Time spent in a processing stage'),
+    'netflux_request_seconds': ('summary', 'Request handling time by endpoint'),
+    'netflux_session_bytes': ('summary', 'Serialized size of each saved session'),
+    'netflux_solver_runs_total': ('counter', 'solve_ivp runs by method'),
+    'netflux_solver_nfev_total': ('counter', 'Right-hand-side evaluations by method'),
+    'netflux_solver_njev_total': ('counter', 'Jacobian evaluations by method'),
+    'netflux_solver_nlu_total': ('counter', 'LU decompositions by method'),
+    'netflux_solver_steps_total': ('counter', 'Solver steps by method and outcome (accepted/rejected)'),
+    'netflux_cache_events_total': ('counter', 'Cache lookups by cache and event'),
+    'netflux_cache_hit_ratio': ('gauge', 'Fraction of cache lookups served from the cache'),
+}
+_request = contextvars.ContextVar('netflux_request', default=None)
+
+def labelKey(labels):
+    return tuple(sorted(labels.items()))
+
+def observe(name, value, **labels):
+    # adds value to the summary name{labels}
+    key = (name, labelKey(labels))
+    with _lock:
+        entry = _summaries.setdefault(key, [0, 0.0])
+        entry[0] += 1
+        entry[1] += value
+
+def increment(name, value=1, **labels):
+    key = (name, labelKey(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def setGauge(name, value, **labels):
+    with _lock:
+        _gauges[(name, labelKey(labels))] = value
+
+def startRequest():
+    # starts collecting stage timings for the current request (context)
+    timings = []
+    _request.set(timings)
+    return timings
+
+def endRequest():
+    # stops collecting, returns the request's [(stage, seconds)]
+    timings = _request.get()
+    _request.set(None)
+    return timings or []
+
+@contextmanager
+def stage(name):
+    # times the enclosed block as stage name
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recordStage(name, time.perf_counter() - start)
+
+def recordStage(name, seconds):
+    observe('netflux_stage_seconds', seconds, stage=name)
+    addTiming(name, seconds)
+
+def addTiming(name, seconds):
+    # adds a timing to the current request only (e.g. a stage that ran in a background job)
+    timings = _request.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+def timedIterator(chunks, name):
+    # wraps a streamed response body so the whole stream is recorded as stage name
+    start = time.perf_counter()
+    try:
+        yield from chunks
+    finally:
+        observe('netflux_stage_seconds', time.perf_counter() - start, stage=name)
+
+def serverTiming(timings):
+    # Server-Timing header value, e.g. 'parse;dur=12.3, plot;dur=40.1' (milliseconds)
+    return ', '.join(f"{name};dur={1e3*seconds:.3f}" for name, seconds in timings)
+
+def stepCounter():
+    # solve_ivp event that is evaluated once per accepted step and never triggers;
+    # counter.steps holds the number of accepted steps
+    def counter(t, y, *args):
+        counter.steps += 1
+        return 1.0
+    counter.steps = -1      # solve_ivp also evaluates events once at t0
+    return counter
+
+def solverStats(solution, counter=None):
+    # solver statistics of a solve_ivp solution (JSON-compatible); rejected steps are derived
+    # from nfev for the explicit Runge-Kutta methods, None otherwise; solutions joined from several
+    # solve_ivp runs (protocols.runProtocol) give their number of runs in solution.segments
+    method = getattr(solution, 'method', None)
+    segments = getattr(solution, 'segments', 1)
+    stats = {'method': method, 'nfev': int(solution.nfev), 'njev': int(solution.njev), 'nlu': int(solution.nlu),
+             'timePoints': int(len(solution.t)), 'acceptedSteps': None, 'rejectedSteps': None}
+    if counter is not None:
+        stats['acceptedSteps'] = max(counter.steps - (segments - 1), 0)  # each run evaluates events at its t0
+        if method in RK_EVALUATIONS:
+            attempts = max(solution.nfev - 2*segments, 0)//RK_EVALUATIONS[method]
+            stats['rejectedSteps'] = max(attempts - stats['acceptedSteps'], 0)
+    return stats
+
+def recordSolver(stats):
+    # adds solverStats to the solver counters
+    method = stats['method'] or 'unknown'
+    increment('netflux_solver_runs_total', method=method)
+    for name in ('nfev', 'njev', 'nlu'):
+        increment(f'netflux_solver_{name}_total', stats[name], method=method)
+    for outcome in ('accepted', 'rejected'):
+        if stats[f'{outcome}Steps'] is not None:
+            increment('netflux_solver_steps_total', stats[f'{outcome}Steps'], method=method, outcome=outcome)
+
+def registerCache(name, stats):
+    # exports a stats dict with 'hits'/'misses'-style counts (read at every scrape)
+    _caches[name] = stats
+
+def formatLabels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+def prometheusText():
+    # all metrics in the Prometheus text exposition format (version 0.0.4)
+    with _lock:
+        samples = {}
+        for (name, labels), (count, total) in _summaries.items():
+            samples.setdefault(name, []).extend([(name + '_count', labels, count), (name + '_sum', labels, total)])
+        for (name, labels), value in list(_counters.items()) + list(_gauges.items()):
+            samples.setdefault(name, []).append((name, labels, value))
+    for cache, stats in _caches.items():
+        counts = dict(stats)
+        for event, value in counts.items():
+            samples.setdefault('netflux_cache_events_total', []).append(
+                ('netflux_cache_events_total', labelKey({'cache': cache, 'event': event}), value))
+        served = counts.get('hits', 0) + counts.get('diskHits', 0)
+        lookups = served + counts.get('misses', 0)
+        if lookups:
+            samples.setdefault('netflux_cache_hit_ratio', []).append(
+                ('netflux_cache_hit_ratio', labelKey({'cache': cache}), served/lookups))
+    lines = []
+    for name in sorted(samples):
+        kind, description = _help.get(name, ('untyped', name))
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for sampleName, labels, value in samples[name]:
+            lines.append(f"{sampleName}{formatLabels(labels)} {float(value):.9g}")
+    return '\n'.join(lines) + '\n'
+
+def startProfiler():
+    # enabled cProfile.Profile for the current thread, or None if another profiler is already active
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        print(f"instrumentation: profiling unavailable: {e}")
+        return None
+    return profiler
+
+def saveProfile(profiler, name, folder=PROFILE_FOLDER):
+    # stops profiler, saves its stats as folder/name-<time>.prof, returns (path, top functions text)
+    profiler.disable()
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{threading.get_ident()}.prof")
+    profiler.dump_stats(path)
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(20)
+    return path, summary.getvalue()
+
+def profiled(func, name, folder=PROFILE_FOLDER):
+    # runs func() under cProfile (if available), returns (result, profile path or None)
+    profiler = startProfiler()
+    if profiler is None:
+        return func(), None
+    try:
+        result = func()
+    finally:
+        path, summary = saveProfile(profiler, name, folder)
+    return result, path
+
+def reset():
+    # clears all recorded metrics (registered caches stay)
+    with _lock:
+        _summaries.clear()
+        _counters.clear()
+        _gauges.clear()
@@ -0,0 +1,138 @@
+# jobQueue.py
+# Runs simulations as background jobs on a bounded thread pool, so a long or stiff simulation
+# does not hold the request thread. Used by webapp.simulate and the /job/<id> endpoints.
+#
+#   job = submit(work, tspan)   queues work(job); raises QueueFull when MAX_PENDING jobs are waiting
+#   get(jobID)                  the Job, or None if unknown or expired
+#   cancel(jobID)               asks the job to stop; it raises Cancelled at its next ODE evaluation
+#
+# work(job) integrates with job.track(ODEfunc) instead of ODEfunc: the wrapper records the current
+# simulated time (job.progress) and checks the cancel flag on every right-hand-side evaluation.
+# Finished jobs are kept for JOB_TTL seconds so their result can be fetched. submit(work, tspan, onDiscard)
+# calls onDiscard(job) when a DONE job is forgotten without job.claim() (result never fetched), so
+# whatever the result refers to (e.g. a stored trajectory) can be deleted.
+
+import functools, threading, time, uuid
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_WORKERS = 2     # simulations running at once
+MAX_PENDING = 16    # queued + running jobs accepted before submit raises QueueFull
+JOB_TTL = 600       # seconds a finished job is kept
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+FINISHED = (DONE, FAILED, CANCELLED)
+
+class QueueFull(RuntimeError):
+    pass
+
+class Cancelled(Exception):
+    pass
+
+class Job:
+    def __init__(self, work, tspan, onDiscard=None):
+        self.id = uuid.uuid4().hex
+        self.work = work
+        self.onDiscard = onDiscard
+        self.claimed = False
+        self.tStart, self.tEnd = float(tspan[0]), float(tspan[1])
+        self.tCurrent = self.tStart
+        self.state = QUEUED
+        self.result = None
+        self.error = None
+        self.created, self.started, self.finished = time.time(), None, None
+        self.cancelRequested = threading.Event()
+
+    def track(self, ODEfunc):
+        # ODEfunc wrapper recording the simulated time and raising Cancelled once cancel() is called
+        @functools.wraps(ODEfunc)
+        def tracked(t, y, *args):
+            if self.cancelRequested.is_set():
+                raise Cancelled(f"Job {self.id} cancelled")
+            if t > self.tCurrent:
+                self.tCurrent = t
+            return ODEfunc(t, y, *args)
+        return tracked
+
+    def claim(self):
+        # marks the result as taken, so it is not discarded when the job expires
+        self.claimed = True
+
+    def discard(self):
+        # runs onDiscard once for a DONE job whose result was not claimed
+        onDiscard, self.onDiscard = self.onDiscard, None
+        if onDiscard is not None and self.state == DONE and not self.claimed:
+            try:
+                onDiscard(self)
+            except Exception as e:
+                print(f"jobQueue: discarding job {self.id} failed: {type(e).__name__}: {e}")
+
+    @property
+    def progress(self):
+        # fraction of tspan simulated so far (1 when done)
+        if self.state == DONE:
+            return 1.0
+        span = self.tEnd - self.tStart
+        return min(max((self.tCurrent - self.tStart)/span, 0.0), 1.0) if span > 0 else 0.0
+
+    def run(self):
+        if self.cancelRequested.is_set():
+            self.state, self.finished = CANCELLED, time.time()
+            return
+        self.state, self.started = RUNNING, time.time()
+        try:
+            self.result = self.work(self)
+            self.state = DONE
+        except Cancelled:
+            self.state = CANCELLED
+        except Exception as e:
+            print(f"jobQueue: job {self.id} failed: {type(e).__name__}: {e}")
+            self.error = str(e)
+            self.state = FAILED
+        finally:
+            self.finished = time.time()
+            self.work = None    # release the closure (model, parameters) once finished
+
+    def info(self):
+        # JSON-compatible summary for the status endpoint
+        return {'job': self.id, 'state': self.state, 'progress': self.progress, 'tCurrent': self.tCurrent,
+                'tEnd': self.tEnd, 'error': self.error,
+                'elapsed': (self.finished or time.time()) - (self.started or time.time())}
+
+_jobs = {}
+_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='netflux-job')
+
+def prune():
+    # forgets finished jobs older than JOB_TTL (call with _lock held), returns them for Job.discard
+    now = time.time()
+    expired = [job for job in _jobs.values() if job.state in FINISHED and now - job.finished > JOB_TTL]
+    for job in expired:
+        del _jobs[job.id]
+    return expired
+
+def submit(work, tspan, onDiscard=None):
+    # queues work(job) on the pool and returns the Job
+    # onDiscard(job) is called if the job finishes (DONE) but expires before its result is claimed
+    job = Job(work, tspan, onDiscard)
+    with _lock:
+        expired = prune()
+        full = sum(other.state not in FINISHED for other in _jobs.values()) >= MAX_PENDING
+        if not full:
+            _jobs[job.id] = job
+    for old in expired:     # outside the lock, onDiscard may delete files
+        old.discard()
+    if full:
+        raise QueueFull(f"Too many simulations queued ({MAX_PENDING}), try again later")
+    _executor.submit(job.run)
+    return job
+
+def get(jobID):
+    with _lock:
+        return _jobs.get(jobID)
+
+def cancel(jobID):
+    # requests cancellation, returns the Job (None if unknown)
+    job = get(jobID)
+    if job is not None and job.state not in FINISHED:
+        job.cancelRequested.set()
+    return job
@@ -0,0 +1,243 @@
+# model2NumpyODE.py
+# Compiles a NetfluxModel into index arrays so that the logic-based ODEs can be
+# evaluated with NumPy array operations instead of the generated scalar code
+# from model2PythonODE.generateODEfile.
+#
+# CompiledModel.ODEfunc has the same call signature as ODEfunc in modelName_ODEs.py,
+# so it can be passed to solve_ivp with args=(ymax, tau, w, n, EC50) and
+# gives the same results as the generated code.
+#
+# Internal representation (built once per model structure):
+#   terms: one entry per (reactant, reaction) pair, i.e. each act() or inhib() call
+#   andIndex: terms of each reaction, padded with a sentinel that evaluates to 1
+#   orIndex: reactions producing each species, padded with a sentinel that evaluates to 0
+# The OR gates are folded from the last reaction to the first, which reproduces
+# nestedOR: OR(r1,OR(r2,r3)).
+#
+# CompiledModel.jacobian returns the analytic Jacobian as a scipy.sparse matrix,
+# with the same call signature as ODEfunc so it can be passed to solve_ivp as jac.
+# Its sparsity follows interactionMatrix: d(product)/d(reactant), plus the diagonal.
+# CompiledModel.paramDerivatives gives d(dydt)/d(parameter) for the full parameter vector; every
+# parameter acts on one species only (its own, or the product of its reaction), so it is returned
+# as (row, value) per parameter (used for forward sensitivities in parameterEstimation.py).
+
+import numpy as np
+import scipy.sparse as sp
+
+class CompiledModel:
+    def __init__(self, model):
+        # interactionMatrix/notMatrix may be scipy.sparse (from createInteractionMatrix) or dense
+        intMat = sp.csc_matrix(model.interactionMatrix, copy=True)
+        intMat.sum_duplicates()     # also sorts the species within each reaction
+        notMat = sp.coo_matrix(model.notMatrix)
+        numSpecies, numReactions = intMat.shape
+        self.modelName = model.modelName
+        self.speciesIDs = list(model.speciesIDs)
+        self.numSpecies = numSpecies
+        self.numReactions = numReactions
+        entries = intMat.tocoo()    # ordered by reaction, then by species
+
+        # act/inhib terms, ordered by reaction and then by reactant (same order as getReactionString)
+        isReactant = entries.data == -1
+        termSpecies, termReaction = entries.row[isReactant], entries.col[isReactant]
+        self.termSpecies = termSpecies
+        self.termReaction = termReaction
+        notKeys = notMat.col[notMat.data != 0].astype(np.int64)*numSpecies + notMat.row[notMat.data != 0]
+        self.termNot = np.isin(termReaction.astype(np.int64)*numSpecies + termSpecies, notKeys)
+        numTerms = len(termSpecies)
+
+        # AND gates: terms belonging to each reaction
+        self.numReactants = np.bincount(termReaction, minlength=numReactions)
+        maxReactants = max(int(self.numReactants.max(initial=0)), 1)
+        self.andIndex = np.full((numReactions, maxReactants), numTerms)  # sentinel: 1.0
+        termPosition = np.arange(numTerms) - np.searchsorted(termReaction, termReaction)
+        self.andIndex[termReaction, termPosition] = np.arange(numTerms)
+        self.termPosition = termPosition
+        self.inputReaction = self.numReactants == 0
+        self.andReaction = self.numReactants >= 2
+        self.andPower = np.maximum(self.numReactants - 2, 0)
+
+        # OR gates: reactions where each species is a product, ordered by species and then by reaction
+        isProduct = entries.data == 1
+        order = np.lexsort((entries.col[isProduct], entries.row[isProduct]))
+        productSpecies, productReaction = entries.row[isProduct][order], entries.col[isProduct][order]
+        numProducing = np.bincount(productSpecies, minlength=numSpecies)
+        maxProducing = max(int(numProducing.max(initial=0)), 1)
+        self.orIndex = np.full((numSpecies, maxProducing), numReactions)  # sentinel: 0.0
+        productPosition = np.arange(len(productSpecies)) - np.searchsorted(productSpecies, productSpecies)
+        self.orIndex[productSpecies, productPosition] = productReaction
+        self.reactionProduct = np.full(numReactions, -1)
+        self.reactionProduct[productReaction] = productSpecies
+        self.reactionOrPosition = np.zeros(numReactions, dtype=int)
+        self.reactionOrPosition[productReaction] = productPosition
+
+        # Jacobian entries: one per term whose reaction has a product, then the diagonal
+        jacTerms = np.nonzero(self.reactionProduct[termReaction] >= 0)[0]
+        self.jacTerms = jacTerms
+        self.jacRows = np.concatenate([self.reactionProduct[termReaction[jacTerms]], np.arange(numSpecies)])
+        self.jacCols = np.concatenate([termSpecies[jacTerms], np.arange(numSpecies)])
+
+    def hillConstants(self, n, EC50):
+        # beta and K**n of act() for each reaction; these depend only on the parameters
+        EC50n = EC50**n
+        beta = (EC50n - 1)/(2*EC50n - 1)
+        Kn = ((beta - 1)**(1/n))**n
+        return beta, Kn
+
+    def termValues(self, y, w, n, EC50):
+        # act() or inhib() for every term
+        x = np.maximum(y[self.termSpecies], 0)
+        beta, Kn = self.hillConstants(n, EC50)
+        wt, nt = w[self.termReaction], n[self.termReaction]
+        xn = x**nt
+        fact = np.minimum(wt*(beta[self.termReaction]*xn)/(Kn[self.termReaction] + xn), wt)
+        notMask = self.termNot if y.ndim == 1 else self.termNot[:, None]
+        return np.where(notMask, wt - fact, fact)
+
+    def reactionValues(self, y, w, n, EC50):
+        # value of each reaction: w for input reactions, act/inhib for single reactants, AND otherwise
+        f = self.termValues(y, w, n, EC50)
+        f = np.concatenate([f, np.ones((1,) + f.shape[1:])])
+        p = f[self.andIndex].prod(axis=1)
+
+        inputMask, andMask, andPower = self.inputReaction, self.andReaction, self.andPower
+        if y.ndim == 2:
+            inputMask, andMask, andPower = inputMask[:, None], andMask[:, None], andPower[:, None]
+        andZero = andMask & (w == 0)
+        scale = np.where(andMask & ~andZero, w, 1.0)**andPower
+        r = np.where(andZero, 0.0, p/scale)
+        return np.where(inputMask, w, r)
+
+    def speciesValues(self, y, w, n, EC50):
+        # OR of all reactions producing each species, folded as in nestedOR
+        r = self.reactionValues(y, w, n, EC50)
+        r = np.concatenate([r, np.zeros((1,) + r.shape[1:])])
+        acc = r[self.orIndex[:, -1]]
+        for col in range(self.orIndex.shape[1] - 2, -1, -1):
+            a = r[self.orIndex[:, col]]
+            acc = a + acc - a*acc
+        return acc
+
+    def termDerivatives(self, y, w, n, EC50):
+        # d(act or inhib)/dy of every term with respect to its reactant
+        x = np.maximum(y[self.termSpecies], 0)
+        beta, Kn = self.hillConstants(n, EC50)
+        wt, nt = w[self.termReaction], n[self.termReaction]
+        bt, Knt = beta[self.termReaction], Kn[self.termReaction]
+        xn = x**nt
+        fact = wt*(bt*xn)/(Knt + xn)
+        positive = x > 0
+        xSafe = np.where(positive, x, 1.0)
+        dfact = wt*bt*nt*xSafe**(nt - 1)*Knt/(Knt + xn)**2
+        dfact = np.where(positive & (fact < wt), dfact, 0.0)  # act() is flat for x<0 and once capped at w
+        return np.where(self.termNot, -dfact, dfact)
+
+    def termParamDerivatives(self, y, w, n, EC50):
+        # d(act or inhib)/dw, /dn and /dEC50 of every term, for its reaction's parameters
+        # act = min(w*g, w) with g = beta*x**n/(Kn + x**n), Kn = beta - 1, beta = (EC50**n - 1)/(2*EC50**n - 1)
+        x = np.maximum(y[self.termSpecies], 0)
+        wt, nt, Et = w[self.termReaction], n[self.termReaction], EC50[self.termReaction]
+        beta, Kn = self.hillConstants(n, EC50)
+        bt, Knt = beta[self.termReaction], Kn[self.termReaction]
+        xn = x**nt
+        g = bt*xn/(Knt + xn)
+        EC50n = Et**nt
+        dBeta = 1/(2*EC50n - 1)**2                 # d(beta)/d(EC50**n)
+        dgBeta = xn*(xn - 1)/(Knt + xn)**2          # dg/d(beta), through beta and Kn
+        dgXn = bt*Knt/(Knt + xn)**2                 # dg/d(x**n)
+        logX = np.log(np.where(x > 0, x, 1.0))      # x**n does not depend on n at x = 0
+        dgdn = dgBeta*dBeta*EC50n*np.log(Et) + dgXn*xn*logX
+        dgdEC50 = dgBeta*dBeta*nt*Et**(nt - 1)
+        capped = g >= 1                             # act() is capped at w
+        dw = np.where(capped, 1.0, g)
+        dn = np.where(capped, 0.0, wt*dgdn)
+        dEC50 = np.where(capped, 0.0, wt*dgdEC50)
+        return np.where(self.termNot, 1 - dw, dw), np.where(self.termNot, -dn, dn), np.where(self.termNot, -dEC50, dEC50)
+
+    def paramDerivatives(self, t, y, ymax, tau, w, n, EC50):
+        # d(dydt)/d(parameter) for the full parameter vector [y0, ymax, tau, w, n, EC50] (simulation.py):
+        # returns (rows, values), the species each parameter acts on (-1 for none) and the derivative
+        y = np.asarray(y, dtype=float)
+        ymax, tau, w, n, EC50 = (np.asarray(p, dtype=float) for p in (ymax, tau, w, n, EC50))
+        S, R = self.numSpecies, self.numReactions
+        rcn = self.speciesValues(y, w, n, EC50)
+        dydt = (rcn*ymax - y)/tau
+
+        # reactions: input w, single act/inhib, or AND = product of the terms / w**andPower
+        f = np.concatenate([self.termValues(y, w, n, EC50), [1.0]])[self.andIndex]
+        andOthers = productOfOthers(f)
+        andZero = self.andReaction & (w == 0)       # AND() is 0 for w = 0, and flat in w there
+        scale = np.where(self.andReaction & ~andZero, w, 1.0)**self.andPower
+        dReaction = []
+        for dTerm in self.termParamDerivatives(y, w, n, EC50):
+            dTerm = np.concatenate([dTerm, [0.0]])[self.andIndex]
+            dReaction.append(np.where(andZero, 0.0, (andOthers*dTerm).sum(axis=1)/scale))
+        r = self.reactionValues(y, w, n, EC50)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dReaction[0] = np.where(self.andReaction & ~andZero, dReaction[0] - self.andPower*r/w, dReaction[0])
+        dReaction[0] = np.where(self.inputReaction, 1.0, dReaction[0])
+
+        # OR gates, then (rcn*ymax - y)/tau of the product
+        dSpecies = productOfOthers(1 - np.concatenate([r, [0.0]])[self.orIndex])
+        product = self.reactionProduct
+        hasProduct = product >= 0
+        chain = np.where(hasProduct, dSpecies[product, self.reactionOrPosition]*ymax[product]/tau[product], 0.0)
+        rows = np.concatenate([np.full(S, -1), np.arange(S), np.arange(S), np.tile(product, 3)])
+        values = np.concatenate([np.zeros(S), rcn/tau, -dydt/tau] + [chain*d for d in dReaction])
+        return rows, np.where(rows >= 0, values, 0.0)
+
+    def jacobian(self, t, y, ymax, tau, w, n, EC50):
+        # analytic Jacobian of ODEfunc as a sparse (species x species) matrix
+        y = np.asarray(y, dtype=float)
+        ymax, tau, w, n, EC50 = (np.asarray(p, dtype=float) for p in (ymax, tau, w, n, EC50))
+
+        # AND gates: d(reaction)/d(term) is the product of the other terms, scaled like AND()
+        f = self.termValues(y, w, n, EC50)
+        f = np.concatenate([f, [1.0]])[self.andIndex]
+        andOthers = productOfOthers(f)
+        andZero = self.andReaction & (w == 0)
+        scale = np.where(self.andReaction & ~andZero, w, 1.0)**self.andPower
+        dReaction = np.where(andZero[:, None], 0.0, andOthers/scale[:, None])
+
+        # OR gates: d(1 - prod(1 - r))/dr is the product of (1 - r) over the other reactions
+        r = np.concatenate([self.reactionValues(y, w, n, EC50), [0.0]])[self.orIndex]
+        dSpecies = productOfOthers(1 - r)
+
+        terms = self.jacTerms
+        termReaction = self.termReaction[terms]
+        product = self.reactionProduct[termReaction]
+        dTerm = self.termDerivatives(y, w, n, EC50)[terms]
+        chain = dSpecies[product, self.reactionOrPosition[termReaction]] \
+            * dReaction[termReaction, self.termPosition[terms]] * dTerm
+        data = np.concatenate([chain*ymax[product]/tau[product], -1/tau])
+        return sp.csr_matrix((data, (self.jacRows, self.jacCols)), shape=(self.numSpecies, self.numSpecies))
+
+    def jacSparsity(self):
+        # structural nonzeros of the Jacobian, for solve_ivp(jac_sparsity=...) with finite differences
+        ones = np.ones(len(self.jacRows))
+        return sp.csr_matrix((ones, (self.jacRows, self.jacCols)), shape=(self.numSpecies, self.numSpecies))
+
+    def ODEfunc(self, t, y, ymax, tau, w, n, EC50):
+        # logic-based differential equations, same signature as the generated ODEfunc
+        # y may also be 2D (species x batch), with parameters of shape (species or reactions,) or (.., batch)
+        y = np.asarray(y, dtype=float)
+        ymax, tau, w, n, EC50 = (asColumn(p, y.ndim) for p in (ymax, tau, w, n, EC50))
+        rcn = self.speciesValues(y, w, n, EC50)
+        return (rcn*ymax - y)/tau
+
+def productOfOthers(a):
+    # for each column of a (rows x k), the product of the other k-1 columns, without dividing
+    prefix = np.cumprod(np.concatenate([np.ones((a.shape[0], 1)), a[:, :-1]], axis=1), axis=1)
+    suffix = np.cumprod(np.concatenate([np.ones((a.shape[0], 1)), a[:, :0:-1]], axis=1), axis=1)[:, ::-1]
+    return prefix*suffix
+
+def asColumn(param, ndim):
+    # converts a parameter to a float array that broadcasts against y (1D or species x batch)
+    param = np.asarray(param, dtype=float)
+    if ndim == 2 and param.ndim == 1:
+        param = param[:, None]
+    return param
+
+def compileModel(model):
+    # returns a CompiledModel for a NetfluxModel
+    return CompiledModel(model)
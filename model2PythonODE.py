@@ -9,26 +9,37 @@
 # BUG: not loading correct file when running export model
 
 import numpy as np
+import scipy.sparse as sp
 import datetime, io, os
+import modelRegistry, simulation, xls2model
 
-def returnModelFuncs(model):
+ODE_ENGINES = ('python', 'numpy') # python: generated scalar code, numpy: model2NumpyODE.CompiledModel
+
+def returnModelFuncs(model, engine='python'):
 # Returns loadParamFunc and ODEfunc as handles, runScript as ioString object
+# engine='numpy' returns the vectorized ODEfunc from model2NumpyODE instead of the generated code
+# ODEfunc comes from modelRegistry, so it is compiled once per model and safe to share between threads
+    if engine not in ODE_ENGINES:
+        raise ValueError(f"Unknown ODE engine: {engine}, expected one of {ODE_ENGINES}")
     paramsFileText = generateParamsFile(model)
-    exec(paramsFileText) 
-    loadParamsFunc = locals()['loadParams'] # generates function handle
+    namespace = {}
+    exec(paramsFileText, namespace) 
+    loadParamsFunc = namespace['loadParams'] # generates function handle
 
     runScript = generateRunFile(model)
 
-    ODEfileText = generateODEfile(model)
-    exec(ODEfileText,globals())   # had bug unless I put ODEfileText in globals
-    ODEfunc = globals()['ODEfunc']
+    if engine == 'numpy':
+        ODEfunc = modelRegistry.getCompiledModel(model).ODEfunc
+    else:
+        ODEfunc = modelRegistry.getODEfunc(generateODEfile(model))
     
     return loadParamsFunc, runScript, ODEfunc
 
 
-def writeModel(model,export_path=[]):
+def writeModel(model,export_path=[],solver='auto',**outputOptions):
 # Writes modelname_params.py, modelname_run.py, modelname_ODEs.py
 # confirmed working for exampleNet, 3/15/2025
+# solver and outputOptions (numPoints, species, dtype) are passed to generateRunFile (see simulation.SOLVERS)
     
     print(f"DEBUG/writeModel: modelName:{model.modelName}")
     if export_path:
@@ -43,7 +54,7 @@ def writeModel(model,export_path=[]):
         file.write(paramsFileText)
     print(f"Netflux wrote {paramsFilename}")
     
-    runFileText = generateRunFile(model)
+    runFileText = generateRunFile(model,solver,**outputOptions)
     runFilename = filename + "_run.py"
     with open(runFilename, 'w') as file:
         file.write(runFileText)
@@ -67,116 +78,223 @@ def generateParamsFile(model):
     output.write("import numpy as np\n\n")
     output.write("def loadParams():\n")
     output.write("    # species parameters\n")
-    output.write(f"    speciesIDs = {model.speciesIDs.tolist()}\n") 
-    y0 = model.speciesParams.iloc[:,0].tolist()
-    ymax = model.speciesParams.iloc[:,1].tolist()
-    tau = model.speciesParams.iloc[:,2].tolist()
+    output.write(f"    speciesIDs = {list(model.speciesIDs)}\n") 
+    y0 = model.speciesParams[:,0].tolist()
+    ymax = model.speciesParams[:,1].tolist()
+    tau = model.speciesParams[:,2].tolist()
     output.write(f"    y0 = np.array({y0})\n")
     output.write(f"    ymax = np.array({ymax})\n")
     output.write(f"    tau = np.array({tau})\n\n")
     output.write("    # reaction parameters\n")
-    w = model.reactionParams.iloc[:,0].tolist()
-    n = model.reactionParams.iloc[:,1].tolist()
-    EC50 = model.reactionParams.iloc[:,2].tolist()
+    w = model.reactionParams[:,0].tolist()
+    n = model.reactionParams[:,1].tolist()
+    EC50 = model.reactionParams[:,2].tolist()
     output.write(f"    w = np.array({w})\n")
     output.write(f"    n = np.array({n})\n")
     output.write(f"    EC50 = np.array({EC50})\n\n")
     output.write("    return speciesIDs, y0, ymax, tau, w, n, EC50")
     return output.getvalue() # returns paramsFileText
         
-def generateRunFile(model):
+def generateRunFile(model,solver='auto',numPoints=None,species=None,dtype='float64'):
     # Takes a NetfluxModel and writes modelName_run.py, which runs the simulation
     # Confirmed working 3/15/2025
+    # solver='auto' writes BDF for stiff models (see simulation.selectSolver), otherwise RK45.
+    # BDF/Radau also get the Jacobian sparsity pattern from the interaction matrix.
+    # numPoints, species and dtype are the output settings written into the script (as in the webapp):
+    # numPoints output time points (None keeps every solver step), species IDs to keep, 'float32' results
     
+    tau = model.speciesParams[:,2]
+    method = simulation.selectSolver(tau, solver)
+    simulation.outputSpecies(model.speciesIDs, species)    # checks the species IDs
+    dtype = simulation.checkDtype(dtype)
     output = io.StringIO()
     fname = str(model.modelName) + "_run.py"
     output.write(f"# {fname}\n")
     output.write(f"# Automatically generated by Netflux on {datetime.date.today()}\n")
     output.write("import numpy as np\n")
     output.write("from scipy.integrate import solve_ivp\n")
+    if method in ('BDF', 'Radau'):
+        output.write("from scipy.sparse import csr_matrix\n")
     output.write("import matplotlib.pyplot as plt\n")
     output.write(f"import {model.modelName}_ODEs\n")
     output.write(f"import {model.modelName}_params\n\n")
     output.write(f"speciesNames, y0, ymax, tau, w, n, EC50 = {model.modelName}_params.loadParams()\n\n")        
+    jacOption = ""
+    if method in ('BDF', 'Radau'):
+        compiledModel = modelRegistry.getCompiledModel(model)
+        numSpecies = compiledModel.numSpecies
+        output.write("# Jacobian sparsity pattern (reactant -> product, plus diagonal)\n")
+        output.write(f"jacRows = {compiledModel.jacRows.tolist()}\n")
+        output.write(f"jacCols = {compiledModel.jacCols.tolist()}\n")
+        output.write(f"jac_sparsity = csr_matrix((np.ones(len(jacRows)), (jacRows, jacCols)), shape=({numSpecies}, {numSpecies}))\n\n")
+        jacOption = ", jac_sparsity=jac_sparsity"
     output.write("# Run single simulation\n")
     output.write("tspan = [0, 10]\n")
-    output.write(f"solution = solve_ivp({model.modelName}_ODEs.ODEfunc, tspan, y0, rtol=1e-8, args=(ymax, tau, w, n, EC50))\n\n")
+    output.write("# Output settings: numPoints time points over tspan (None keeps every solver step),\n")
+    output.write("# species IDs to keep (None keeps all), dtype of the results (np.float32 halves their size)\n")
+    output.write(f"numPoints = {None if numPoints is None else int(numPoints)}\n")
+    output.write(f"outputSpecies = {None if species is None else list(species)}\n")
+    output.write(f"dtype = np.{dtype}\n")
+    output.write("t_eval = None if numPoints is None else np.linspace(tspan[0], tspan[1], numPoints)\n")
+    output.write(f"ODEfunc = {model.modelName}_ODEs.makeODEfunc(ymax, tau, w, n, EC50) # Hill constants computed once\n")
+    output.write(f"solution = solve_ivp(ODEfunc, tspan, y0, method='{method}', rtol=1e-8, t_eval=t_eval{jacOption})\n")
+    output.write("keep = list(range(len(speciesNames))) if outputSpecies is None else [speciesNames.index(ID) for ID in outputSpecies]\n")
+    output.write("t, y = solution.t, solution.y[keep].astype(dtype)\n\n")
     output.write("fig, ax = plt.subplots()\n")
-    output.write("ax.plot(solution.t,solution.y.T)\n")
+    output.write("ax.plot(t,y.T)\n")
     output.write("ax.set(xlabel='Time',ylabel='Normalized activity')\n")
-    output.write("ax.legend(speciesNames)\n")
+    output.write("ax.legend([speciesNames[i] for i in keep])\n")
     output.write("plt.show()")
     return output.getvalue() # returns runFileText
 
-def generateODEfile(model):
+def generateODEfile(model, comments=True):
     # writes the ODEs as logic-based differential equations
     # called by modelname_run.py
     # confirmed working for write mode, but BUG for interactive mode can't find ODEfunc 3/15/2025
+    # makeODEfunc(ymax,tau,w,n,EC50) computes the Hill constants (beta, K**n) and AND divisors of every
+    # reaction once per parameter set and returns ODEfunc(t,y) with the act/inhib/AND/OR arithmetic inlined.
+    # ODEfunc(t,y,ymax,tau,w,n,EC50) keeps the old signature, reusing makeODEfunc while the parameter values are unchanged.
+    # comments=True writes each equation in the act/inhib/AND/OR form (getReactionString) above its code
+    # the text is assembled from one section per species (generateODEsections), so that modelEdit.py
+    # can regenerate only the sections of the species an edit affects
     
+    incidence = xls2model.reactionIncidence(model) # products/reactants from the sparse matrices, built once
+    sections = generateODEsections(model, range(len(model.speciesIDs)), incidence, comments)
+    return assembleODEfile(model, sections)
+
+def generateODEsections(model, speciesNums, incidence, comments=True):
+    # code of the equations of speciesNums, one string per species (comment, reaction code, dydt line)
+    # incidence only needs productReactions[speciesNum] and reactants[rcnID] for these species (lists or dicts)
+    sections = []
+    speciesID = None
     try: 
-        output = io.StringIO()
-        filename = model.modelName + "_ODEs.py"
-        output.write(f"# {filename}\n")
-        output.write(f"# Automatically generated by Netflux on {datetime.date.today()}\n")
-        output.write("import numpy as np\n\n")
-        output.write("def ODEfunc(t,y,ymax,tau,w,n,EC50):\n\n")
-    
-        # name the indices by speciesID
-        output.write("    # network species\n")
-        for i, speciesID in enumerate(model.speciesIDs):
-            output.write(f"    {speciesID} = {i}\n")
-    
-        output.write("\n    # logic-based differential equaations\n")
-        output.write(f"    dydt = np.zeros({i+1})\n")      
-        for speciesNum, speciesID in enumerate(model.speciesIDs):
-            #print(f"DEBUG/model2PythonODE/generateODEfile: speciesNum:{speciesNum}, speciesID:{speciesID}")
-            rcnString = getReactionString(model,speciesNum) # potential BUG: might also need to modify ymax for AND gates?
-            #print(f"DEBUG/model2PythonODE: rcnString:{rcnString}")
-            output.write(f"    dydt[{speciesID}] = ({rcnString}*ymax[{speciesID}] - y[{speciesID}])/tau[{speciesID}]\n")
-        output.write("\n    return dydt\n")
-        output.write(returnUtilityFunctions()) # writes the AND/OR/fact/finhib functions
-        return output.getvalue() # returns ODEfuncText    
+        for speciesNum in speciesNums:
+            speciesID = model.speciesIDs[speciesNum]
+            #print(f"DEBUG/model2PythonODE/generateODEsections: speciesNum:{speciesNum}, speciesID:{speciesID}")
+            output = io.StringIO()
+            if comments:
+                rcnString = getReactionString(model,speciesNum,incidence) # potential BUG: might also need to modify ymax for AND gates?
+                output.write(f"        # dydt[{speciesID}] = ({rcnString}*ymax[{speciesID}] - y[{speciesID}])/tau[{speciesID}]\n")
+            lines, F = getReactionCode(speciesNum, incidence)
+            for line in lines:
+                output.write(f"        {line}\n")
+            output.write(f"        dydt[{speciesNum}] = ({F}*ymax[{speciesNum}] - y[{speciesNum}])/tau[{speciesNum}]\n")
+            sections.append(output.getvalue())
+        return sections
         
     except Exception as e:  
         print(f"Error in model2PythonODE.generateODEfile: speciesID:{speciesID} {e}") # captures errors
         raise
+
+def assembleODEfile(model, sections):
+    # ODEfuncText from the species sections; the AND gate divisors are read from interactionMatrix
+    output = io.StringIO()
+    filename = model.modelName + "_ODEs.py"
+    output.write(f"# {filename}\n")
+    output.write(f"# Automatically generated by Netflux on {datetime.date.today()}\n")
+    output.write("import numpy as np\n\n")
+    output.write("def makeODEfunc(ymax,tau,w,n,EC50):\n")
+    output.write("    # returns ODEfunc(t,y) for one parameter set, with the per-reaction constants computed once\n")
+    output.write("    beta, Kn = hillConstants(n, EC50)\n")
+    output.write("    ymax, tau, w = [np.asarray(p, dtype=float).tolist() for p in (ymax, tau, w)]\n")
+    output.write("    n = np.asarray(n, dtype=float).tolist()\n")
+
+    andReactions = [(rcnID, numReactants) for rcnID, numReactants in enumerate(reactantCounts(model)) if numReactants > 1]
+    if andReactions:
+        output.write("\n    # AND gate divisors w**(reactants-2), inf when w == 0 so the gate gives 0\n")
+        for rcnID, numReactants in andReactions:
+            output.write(f"    d{rcnID} = ANDdivisor(w[{rcnID}], {numReactants})\n")
+
+    output.write("\n    def ODEfunc(t,y):\n")
+    output.write("        y = np.asarray(y, dtype=float).tolist()\n")
+    output.write(f"        dydt = [0.0]*{len(model.speciesIDs)}\n")
+    output.write("\n        # logic-based differential equaations\n")
+    output.writelines(sections)
+    output.write("        return np.array(dydt)\n")
+    output.write("\n    return ODEfunc\n")
+    output.write(returnLegacyODEfunc())
+    output.write(returnUtilityFunctions()) # writes the AND/OR/fact/finhib functions
+    return output.getvalue() # returns ODEfuncText    
+
+def reactantCounts(model):
+    # number of reactants of each reaction (-1 entries of each interactionMatrix column)
+    interactionMatrix = sp.csc_matrix(model.interactionMatrix, copy=True)
+    interactionMatrix.sum_duplicates()
+    entries = interactionMatrix.tocoo()
+    return np.bincount(entries.col[entries.data == -1], minlength=interactionMatrix.shape[1]).tolist()
+
+def getReactionCode(speciesNum, incidence):
+    # generates inlined statements for the reactions for which speciesNum is a product
+    # returns (lines, F): lines compute the reaction values, F is the expression combining them
+    # same arithmetic as act/inhib/AND/OR in returnUtilityFunctions, using the constants from makeODEfunc
+    productReactions, reactants = incidence
+    lines, values = [], []
+    for rcnID in productReactions[speciesNum]:
+        value = f"r{len(values)}"
+        if len(reactants[rcnID]) == 0:           # input reaction
+            values.append(f"w[{rcnID}]")
+            continue
+        terms = []
+        for reactant, inhibiting in reactants[rcnID]:
+            term = value if len(reactants[rcnID]) == 1 else f"{value}_{len(terms)}"
+            lines.append(f"xn = (0.0 if y[{reactant}] < 0 else y[{reactant}])**n[{rcnID}]")
+            lines.append(f"{term} = w[{rcnID}]*(beta[{rcnID}]*xn)/(Kn[{rcnID}]+xn)")
+            lines.append(f"if {term} > w[{rcnID}]: {term} = w[{rcnID}]")
+            if inhibiting:
+                lines.append(f"{term} = w[{rcnID}] - {term}")
+            terms.append(term)
+        if len(terms) > 1:                      # AND gate
+            lines.append(f"{value} = ({'*'.join(terms)})/d{rcnID}")
+        values.append(value)
+
+    if len(values) == 0: # no input reaction or reactants
+        return lines, "0"
+    if len(values) > 1: # OR gates, nested from the right: OR(r0,OR(r1,r2))
+        lines.append(f"o = {values[-1]}")
+        for value in reversed(values[:-1]):
+            lines.append(f"o = {value} + o - {value}*o")
+        return lines, "o"
+    return lines, values[0]
         
-def getReactionString(model,speciesNum):
+def getReactionString(model,speciesNum,incidence=None):
     # generates strings for the reactions for which speciesNum is a product
     # utility function for writeODEfile
+    # incidence: xls2model.reactionIncidence(model), pass it when calling for many species
     # TODO: add case when there are no reactants for that product
     # TODO: update error handling to raise the reaction string to the GUI
-    #print(f"DEBUG/getReactionString: speciesID:{model.speciesIDs[speciesNum+1]}")
+    #print(f"DEBUG/getReactionString: speciesID:{model.speciesIDs[speciesNum]}")
 
     # find reactions where speciesNum is a product
-    intMat = model.interactionMatrix
-    notMat = model.notMatrix
-    rcnsWhereSpeciesIsProduct = np.where(intMat[speciesNum, :] == 1)[0].tolist()
-    #print(f"DEBUG/getReactionString: speciesID:{model.speciesIDs[speciesNum+1]}, rcnsWhereSpeciesIsProduct: {rcnsWhereSpeciesIsProduct}")
+    if incidence is None:
+        incidence = xls2model.reactionIncidence(model)
+    productReactions, reactants = incidence
+    rcnsWhereSpeciesIsProduct = productReactions[speciesNum]
+    #print(f"DEBUG/getReactionString: speciesID:{model.speciesIDs[speciesNum]}, rcnsWhereSpeciesIsProduct: {rcnsWhereSpeciesIsProduct}")
     
     # loop over rcnsWhereSpeciesIsProduct to generate rcnStringList
     
     #try:
     rcnStringList = []  # list of reactions where speciesNum is a product
     for rcnID in rcnsWhereSpeciesIsProduct:    
-        reactantIndices = np.where(intMat[:,rcnID] == -1)[0].tolist() 
+        reactantIndices = [reactant for reactant, inhibiting in reactants[rcnID]]
+        inhibitors = [reactant for reactant, inhibiting in reactants[rcnID] if inhibiting]
         if len(reactantIndices) == 0:           # input reaction, no reactants; DEBUG: does this catch cases with no input reaction?
             rcnStringList.append(f"w[{rcnID}]")
  
         elif len(reactantIndices) == 1:         # single reactant
             reactant = reactantIndices[0]
-            if notMat[reactant,rcnID] == 0: # reactant is activating            
-                rcnStringList.append(f"act(y[{model.speciesIDs[reactant+1]}],w[{rcnID}],n[{rcnID}],EC50[{rcnID}])")
+            if reactant not in inhibitors: # reactant is activating            
+                rcnStringList.append(f"act(y[{model.speciesIDs[reactant]}],w[{rcnID}],n[{rcnID}],EC50[{rcnID}])")
             else:                                   # reactant is inhibiting
-                rcnStringList.append(f"inhib(y[{model.speciesIDs[reactant+1]}],w[{rcnID}],n[{rcnID}],EC50[{rcnID}])")
+                rcnStringList.append(f"inhib(y[{model.speciesIDs[reactant]}],w[{rcnID}],n[{rcnID}],EC50[{rcnID}])")
         
         else:                                   
             rcnString = []
             for reactant in reactantIndices:    # multiple reactants 
-                if notMat[reactant,rcnID] == 0: # reactant is activating            
-                      rcnString.append(f"act(y[{model.speciesIDs[reactant+1]}],w[{rcnID}],n[{rcnID}],EC50[{rcnID}])")
+                if reactant not in inhibitors: # reactant is activating            
+                      rcnString.append(f"act(y[{model.speciesIDs[reactant]}],w[{rcnID}],n[{rcnID}],EC50[{rcnID}])")
                 else:                                   # reactant is inhibiting
-                      rcnString.append(f"inhib(y[{model.speciesIDs[reactant+1]}],w[{rcnID}],n[{rcnID}],EC50[{rcnID}])") # up to here is correct
+                      rcnString.append(f"inhib(y[{model.speciesIDs[reactant]}],w[{rcnID}],n[{rcnID}],EC50[{rcnID}])") # up to here is correct
             rcnStringList.append(f"AND(w[{rcnID}],[{','.join(rcnString)}])")  # BUG 3/25 potentially fixed but needs more testing
 
     #print(f"DEBUG/model2PythonODE/getReactionString: rcnStringList: {rcnStringList}") 
@@ -199,11 +317,56 @@ def nestedOR(items):
     else:
         return f"OR({items[0]},{nestedOR(items[1:])})"
         
+def jobODEfunc(makeODEfunc):
+    # ODEfunc(t,y,ymax,tau,w,n,EC50) for one simulation run, from the generated makeODEfunc: the constants
+    # are rebuilt only when other parameter arrays are passed (e.g. each protocol segment), so the arrays
+    # must not be changed in place during the run; not shared between threads, unlike the legacy ODEfunc
+    bound = [None, None]    # parameter arrays, makeODEfunc result
+    def ODEfunc(t, y, *params):
+        if bound[0] is None or any(a is not b for a, b in zip(bound[0], params)):
+            bound[:] = [params, makeODEfunc(*params)]
+        return bound[1](t, y)
+    return ODEfunc
+
+def returnLegacyODEfunc():
+    # called by generateODEfile: ODEfunc with the parameters as arguments (solve_ivp args=...)
+    
+    legacyFunctionText = """
+_lastODEfunc = [None, None] # copies of the last parameter values, makeODEfunc result
+
+def ODEfunc(t,y,ymax,tau,w,n,EC50):
+    # same equations as makeODEfunc(ymax,tau,w,n,EC50)(t,y), for scripts calling the generated file; the constants
+    # are rebuilt whenever a parameter value changes (also in place), call makeODEfunc once per parameter set for speed
+    params = (ymax, tau, w, n, EC50)
+    values, func = _lastODEfunc
+    if values is None or not all(np.array_equal(a, b) for a, b in zip(values, params)):
+        func = makeODEfunc(*params)
+        _lastODEfunc[:] = [tuple(np.array(p, dtype=float) for p in params), func]
+    return func(t, y)
+"""
+    return legacyFunctionText
+
 def returnUtilityFunctions():
     # called by writeODEfile
     
     utilityFunctionText = """
 # utility functions
+def hillConstants(n, EC50):
+    # beta and K**n of act() for each reaction, as lists
+    beta, Kn = [], []
+    for ni, EC50i in zip(np.asarray(n, dtype=float), np.asarray(EC50, dtype=float)):
+        b = ((EC50i**ni)-1)/(2*EC50i**ni-1)
+        K = (b-1)**(1/ni)
+        beta.append(float(b))
+        Kn.append(float(K**ni))
+    return beta, Kn
+
+def ANDdivisor(w, numReactants):
+    # divisor of the AND gate product, inf for w == 0 (gate value 0)
+    if w == 0:
+        return np.inf
+    return float(np.float64(w)**(numReactants-2))
+
 def act(x, w, n, EC50):
     # hill activation function with parameters w (weight), n (Hill coeff), EC50
     if x < 0:   # BUG: needs more testing.
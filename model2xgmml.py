@@ -2,90 +2,111 @@
 # This file obtains intMat and notMat from my model and converts to XGMML
 # Jeff Saucerman 3/30/2025
 # JS 7/4/2025 to add activates/inhibits labels
+#
+# The XGMML is written incrementally: iter_xgmml yields the document in chunks while walking
+# only the nonzeros of the interaction/not matrices, so time and memory scale with the number
+# of edges. write_xgmml sends it to any file-like object, and the webapp streams it directly
+# as the /downloadxgmml response. The output matches the previous ElementTree version.
 
-import xml.etree.ElementTree as ET
 import os
+import xls2model
+
+CHUNK_SIZE = 1 << 16   # characters per chunk yielded by iter_xgmml
+
+def escape_attribute(value):
+    # escapes an XML attribute value the same way ElementTree does
+    value = str(value)
+    if any(c in value for c in '&<>"\r\n\t'):
+        value = value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+        value = value.replace("\r", "&#13;").replace("\n", "&#10;").replace("\t", "&#09;")
+    return value
+
+def iter_xgmml_elements(mymodel):
+    # yields the XGMML document one element at a time
+    speciesIDs = list(mymodel.speciesIDs)
+    yield f'<graph label="{escape_attribute(mymodel.modelName)}" xmlns="http://www.cs.rpi.edu/XGMML">'
+
+    def node(nodeID, label):
+        return f'<node id="{escape_attribute(nodeID)}" label="{escape_attribute(label)}" />'
+
+    def edge(source, target, label):
+        return (f'<edge source="{escape_attribute(source)}" target="{escape_attribute(target)}">'
+                f'<att name="label" value="{label}" /></edge>')
+
+    # Set of nodes already written
+    nodes = set()
+
+    # Iterate through the nonzeros of the (sparse or dense) interaction and not matrices
+    productReactions, reactionReactants = xls2model.reactionIncidence(mymodel)
+    reactionProducts = [[] for _ in reactionReactants]
+    for i, rcnIDs in enumerate(productReactions):
+        for j in rcnIDs:
+            reactionProducts[j].append(speciesIDs[i])
+
+    for j in range(len(reactionReactants)): # loop over reactions, j: reaction number
+        reactants = [speciesIDs[i] for i, inhibiting in reactionReactants[j]]
+        products = reactionProducts[j]
+        inhibitors = [speciesIDs[i] for i, inhibiting in reactionReactants[j] if inhibiting]
 
-def interaction_matrix_to_xgmml(mymodel, export_path=[]):
-    modelName = mymodel.modelName
-    interactionMatrix = mymodel.interactionMatrix
-    notMatrix = mymodel.notMatrix
-    speciesIDs = mymodel.speciesIDs.tolist()
-    #reactionIDs= mymodel.reactionIDs.tolist()
-    
-    # Create the root element for XGMML
-    root = ET.Element("graph", attrib={
-        "label": modelName,
-        "xmlns": "http://www.cs.rpi.edu/XGMML"
-    })
-    
-    # Create a dictionary to store nodes
-    nodes = {}
-    
-    # Iterate through the interaction matrix to create nodes and edges
-    
-    for j in range(interactionMatrix.shape[1]): # loop over species, j: species number, shape[1] is num species
-        reactants = []
-        products = []
-        inhibitors = []
-        
-        for i in range(interactionMatrix.shape[0]): # loop over reactions; i: reaction number, shape[0] is num reactions
-            if interactionMatrix[i, j] == -1:
-                reactants.append(speciesIDs[i])
-            elif interactionMatrix[i, j] == 1:
-                products.append(speciesIDs[i]) # DEBUG, ERROR HERE
-            if notMatrix[i, j] == 1:
-                inhibitors.append(speciesIDs[i])
-        
         # Create product nodes
         for product in products:
             if product not in nodes:
-                node = ET.SubElement(root, "node", attrib={"id": product, "label": product})
-                nodes[product] = node
-        
+                nodes.add(product)
+                yield node(product, product)
+
         # Create reactant nodes and AND node if necessary
         if len(reactants) > 1:
             and_node_id = f"and_{j}"
-            and_node = ET.SubElement(root, "node", attrib={"id": and_node_id, "label": "AND"})
-            nodes[and_node_id] = and_node
-            
+            nodes.add(and_node_id)
+            yield node(and_node_id, "AND")
+
             for reactant in reactants:
                 if reactant not in nodes:
-                    node = ET.SubElement(root, "node", attrib={"id": reactant, "label": reactant})
-                    nodes[reactant] = node
-                
-                edge = ET.SubElement(root, "edge", attrib={"source": reactant, "target": and_node_id})
-                ET.SubElement(edge, "att", attrib={"name": "label", "value": "activates"})
-            
+                    nodes.add(reactant)
+                    yield node(reactant, reactant)
+                yield edge(reactant, and_node_id, "activates")
+
             for product in products:
-                edge = ET.SubElement(root, "edge", attrib={"source": and_node_id, "target": product})
-                ET.SubElement(edge, "att", attrib={"name": "label", "value": "activates"})
+                yield edge(and_node_id, product, "activates")
 
         else:
             for reactant in reactants:
                 if reactant not in nodes:
-                    node = ET.SubElement(root, "node", attrib={"id": reactant, "label": reactant})
-                    nodes[reactant] = node
-                
+                    nodes.add(reactant)
+                    yield node(reactant, reactant)
+
                 for product in products:
-                    edge = ET.SubElement(root, "edge", attrib={"source": reactant, "target": product})
-                    ET.SubElement(edge, "att", attrib={"name": "label", "value": "activates"})
+                    yield edge(reactant, product, "activates")
 
-        
         # Create inhibitor nodes and edges
         for inhibitor in inhibitors:
             if inhibitor not in nodes:
-                node = ET.SubElement(root, "node", attrib={"id": inhibitor, "label": inhibitor})
-                nodes[inhibitor] = node
-            
+                nodes.add(inhibitor)
+                yield node(inhibitor, inhibitor)
+
             for product in products:
-                edge = ET.SubElement(root, "edge", attrib={"source": inhibitor, "target": product})
-                ET.SubElement(edge, "att", attrib={"name": "label", "value": "inhibits"})
-    
-    
-    # Convert the XML tree to a string
-    xgmml_string = ET.tostring(root).decode()
-    
+                yield edge(inhibitor, product, "inhibits")
+
+    yield '</graph>'
+
+def iter_xgmml(mymodel, chunk_size=CHUNK_SIZE):
+    # yields the XGMML document in chunks of about chunk_size characters
+    chunk, size = [], 0
+    for element in iter_xgmml_elements(mymodel):
+        chunk.append(element)
+        size += len(element)
+        if size >= chunk_size:
+            yield ''.join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield ''.join(chunk)
+
+def write_xgmml(mymodel, stream):
+    # writes the XGMML document to a text stream (open file, io.StringIO, ...)
+    for chunk in iter_xgmml(mymodel):
+        stream.write(chunk)
+
+def interaction_matrix_to_xgmml(mymodel, export_path=[]):
     # Save the XGMML output to a file
     if export_path:
         print(f"DEBUG/writeModel: export_path:{export_path}")
@@ -93,12 +114,12 @@ def interaction_matrix_to_xgmml(mymodel, export_path=[]):
     else:
         filename = str(mymodel.modelName) + ".xgmml"
     print(f"DEBUG/model2xgmml: writing {filename}")
-    
+
     with open(filename, "w") as f:
-        f.write(xgmml_string)
+        write_xgmml(mymodel, f)
         print(f"model2xgmml: written to {filename}")
-        
+
 # # TESTING
-# import xls2model                   
+# import xls2model
 # mymodel = xls2model.createModel("exampleNet.xlsx")
 # interaction_matrix_to_xgmml(mymodel)
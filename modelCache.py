@@ -0,0 +1,128 @@
+# modelCache.py
+# Cache of parsed NetfluxModels, so that opening a model skips pd.read_excel and
+# createInteractionMatrix when the file has been seen before.
+#
+# loadModel(filepath) looks for the model in:
+#   1. memory, keyed by (absolute path, mtime, size), then by the sha256 of the file contents
+#   2. disk, a pickle next to the source (filepath + CACHE_SUFFIX), if diskCache=True
+#   3. otherwise it calls xls2model.createModel and stores the result in both
+# Only use diskCache=True for trusted folders (e.g. the model library): the disk cache is a
+# pickle, so it must never be read from a folder users can upload files into.
+#
+# Cached models are shared; treat them as read-only (copy.copy before editing with modelEdit.py).
+
+import hashlib, os, pickle, threading, copy
+from collections import OrderedDict
+import xls2model
+
+CACHE_SUFFIX = '.nfcache'
+CACHE_VERSION = 3       # bump when NetfluxModel or createInteractionMatrix output changes
+MAX_MODELS = 32
+
+_byFile = OrderedDict()   # (path, mtime_ns, size) -> sha256
+_byHash = OrderedDict()   # sha256 -> NetfluxModel
+_lock = threading.Lock()
+stats = {'hits': 0, 'diskHits': 0, 'misses': 0}
+
+def fileHash(filepath):
+    # sha256 of a file's contents
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def loadModel(filepath, diskCache=False):
+    # returns the NetfluxModel for an xlsx file, parsing it only if it is not cached
+    stat = os.stat(filepath)
+    fileKey = (os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size)
+    modelName = xls2model.modelNameFromFilename(filepath)
+    with _lock:
+        contentHash = _byFile.get(fileKey)
+        if contentHash in _byHash:
+            stats['hits'] += 1
+            _byFile.move_to_end(fileKey)        # least recently used is evicted first (remember)
+            _byHash.move_to_end(contentHash)
+            return renamed(_byHash[contentHash], modelName)
+
+    contentHash = fileHash(filepath)
+    with _lock:
+        if contentHash in _byHash:     # same contents seen under another path or mtime
+            stats['hits'] += 1
+            remember(fileKey, contentHash, _byHash[contentHash])
+            return renamed(_byHash[contentHash], modelName)
+
+    mymodel = readDiskCache(filepath, contentHash) if diskCache else None
+    fromDisk = mymodel is not None
+    if not fromDisk:
+        mymodel = xls2model.createModel(filepath)
+        if diskCache:
+            writeDiskCache(filepath, contentHash, mymodel)
+    with _lock:
+        stats['diskHits' if fromDisk else 'misses'] += 1
+        remember(fileKey, contentHash, mymodel)
+    return mymodel
+
+def remember(fileKey, contentHash, mymodel):
+    # stores a model in the memory cache (call with _lock held), evicting the least recently used
+    _byFile[fileKey] = contentHash
+    _byHash[contentHash] = mymodel
+    _byFile.move_to_end(fileKey)
+    _byHash.move_to_end(contentHash)
+    while len(_byHash) > MAX_MODELS:
+        _byHash.popitem(last=False)
+    while len(_byFile) > 4*MAX_MODELS:
+        _byFile.popitem(last=False)
+
+def renamed(mymodel, modelName):
+    # the cached model, or a shallow copy if the same contents were opened under another filename
+    if mymodel.modelName == modelName:
+        return mymodel
+    mymodel = copy.copy(mymodel)
+    mymodel.modelName = modelName
+    return mymodel
+
+def readDiskCache(filepath, contentHash):
+    # returns the model pickled next to filepath, or None if missing or stale
+    try:
+        with open(filepath + CACHE_SUFFIX, 'rb') as f:
+            entry = pickle.load(f)
+        if entry.get('version') == CACHE_VERSION and entry.get('sha256') == contentHash:
+            return entry['model']
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"modelCache: ignoring unreadable cache for {filepath}: {e}")
+    return None
+
+def writeDiskCache(filepath, contentHash, mymodel):
+    # pickles the model next to filepath; a read-only folder only costs the cache
+    cachePath = filepath + CACHE_SUFFIX
+    try:
+        tmpPath = f"{cachePath}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmpPath, 'wb') as f:
+            pickle.dump({'version': CACHE_VERSION, 'sha256': contentHash, 'model': mymodel}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpPath, cachePath)
+    except OSError as e:
+        print(f"modelCache: could not write {cachePath}: {e}")
+
+def warm(folder, exclude=('library.xlsx',)):
+    # loads every model in folder into the cache (disk cache enabled), returns their names
+    names = []
+    if not os.path.isdir(folder):
+        return names
+    for filename in sorted(os.listdir(folder)):
+        if not filename.endswith('.xlsx') or filename in exclude or filename.startswith('~$'):
+            continue
+        try:
+            names.append(loadModel(os.path.join(folder, filename), diskCache=True).modelName)
+        except Exception as e:
+            print(f"modelCache: could not preload {filename}: {type(e).__name__}: {e}")
+    return names
+
+def clear():
+    # empties the memory cache (disk caches are invalidated by content hash and CACHE_VERSION)
+    with _lock:
+        _byFile.clear()
+        _byHash.clear()
@@ -0,0 +1,269 @@
+# modelEdit.py
+# Edits a NetfluxModel in place, for building models interactively without re-reading the xlsx:
+#
+#   setRule(model, reactionID, rule)                        replaces the rule of a reaction
+#   addReaction(model, reactionID, rule, w, n, EC50)        appends a reaction
+#   removeReaction(model, reactionID)
+#   addSpecies(model, speciesID, name, y0, ymax, tau)       appends a species (used by no rule yet)
+#   renameSpecies(model, speciesID, newID)                  also rewrites the rules that use it
+#   removeSpecies(model, speciesID)                         only for species that no rule uses
+#
+# Only the edited rule is parsed, and only the affected columns (reactions) or rows (species) of
+# interactionMatrix and notMatrix are rewritten. Each edit returns the species numbers whose
+# equations changed, so that
+#   updateODEfile(model, sections, affected)  -> (ODEfuncText, sections)
+# regenerates only those sections of the generated ODE file (model2PythonODE.generateODEsections);
+# sections=None generates all of them. Keep the returned sections for the next edit; the results of
+# several edits can be combined (a | b) and applied at once.
+# Removing a reaction or species renumbers the ones after it, so the equations that refer to them
+# by number are regenerated too. The numpy engine recompiles from the matrices (modelRegistry).
+#
+# Edits raise ValueError and leave the model unchanged. They replace the model's attributes instead
+# of changing the tuples, arrays and matrices themselves, so a copy.copy of a cached model (modelCache.py)
+# can be edited without touching the cache.
+
+import numpy as np
+import scipy.sparse as sp
+import model2PythonODE, xls2model
+
+DEFAULT_SPECIES_PARAMS = (0.0, 1.0, 1.0)       # y0, ymax, tau
+DEFAULT_REACTION_PARAMS = (1.0, 1.4, 0.5)      # w, n, EC50
+
+def setRule(model, reactionID, rule):
+    # replaces the rule of reactionID; returns the affected species (old and new product)
+    rcnNum = reactionNumber(model, reactionID)
+    interactionMatrix, notMatrix = matrices(model)
+    oldProduct = productOf(interactionMatrix, rcnNum)
+    column, notColumn = ruleColumns(model, reactionID, rule)
+    model.interactionMatrix = spliceColumn(interactionMatrix, rcnNum, column)
+    model.notMatrix = spliceColumn(notMatrix, rcnNum, notColumn)
+    model.reactionRules = replaceEntry(model.reactionRules, rcnNum, rule)
+    return {product for product in (oldProduct, productOf(model.interactionMatrix, rcnNum)) if product is not None}
+
+def addReaction(model, reactionID, rule, w=DEFAULT_REACTION_PARAMS[0], n=DEFAULT_REACTION_PARAMS[1],
+                EC50=DEFAULT_REACTION_PARAMS[2]):
+    # appends a reaction; returns the affected species (its product)
+    if reactionID in model.reactionIndex:
+        raise ValueError(f"Reaction {reactionID} already exists")
+    interactionMatrix, notMatrix = matrices(model)
+    rcnNum = interactionMatrix.shape[1]
+    column, notColumn = ruleColumns(model, reactionID, rule)
+    params = [float(w), float(n), float(EC50)]
+    model.interactionMatrix = spliceColumn(interactionMatrix, rcnNum, column)
+    model.notMatrix = spliceColumn(notMatrix, rcnNum, notColumn)
+    model.reactionIDs = appendEntry(model.reactionIDs, reactionID)
+    model.reactionRules = appendEntry(model.reactionRules, rule)
+    model.reactionParams = appendEntry(model.reactionParams, params)
+    product = productOf(model.interactionMatrix, rcnNum)
+    return set() if product is None else {product}
+
+def removeReaction(model, reactionID):
+    # removes a reaction; returns the affected species (its product and the products of the
+    # renumbered reactions after it)
+    rcnNum = reactionNumber(model, reactionID)
+    interactionMatrix, notMatrix = matrices(model)
+    oldProduct = productOf(interactionMatrix, rcnNum)
+    model.interactionMatrix = spliceColumn(interactionMatrix, rcnNum)
+    model.notMatrix = spliceColumn(notMatrix, rcnNum)
+    model.reactionIDs = removeEntry(model.reactionIDs, rcnNum)
+    model.reactionRules = removeEntry(model.reactionRules, rcnNum)
+    model.reactionParams = removeEntry(model.reactionParams, rcnNum)
+    start = model.interactionMatrix.indptr[rcnNum]
+    affected = model.interactionMatrix.indices[start:][model.interactionMatrix.data[start:] == 1]
+    return set(affected.tolist()) | ({oldProduct} if oldProduct is not None else set())
+
+def addSpecies(model, speciesID, name=None, y0=DEFAULT_SPECIES_PARAMS[0], ymax=DEFAULT_SPECIES_PARAMS[1],
+               tau=DEFAULT_SPECIES_PARAMS[2]):
+    # appends a species without reactions (dydt = -y/tau until a rule produces it); returns {its number}
+    checkSpeciesID(model, speciesID)
+    interactionMatrix, notMatrix = matrices(model)
+    speciesNum = interactionMatrix.shape[0]
+    params = [float(y0), float(ymax), float(tau)]
+    model.interactionMatrix = resized(interactionMatrix, speciesNum + 1)
+    model.notMatrix = resized(notMatrix, speciesNum + 1)
+    model.speciesIDs = appendEntry(model.speciesIDs, speciesID)
+    model.speciesNames = appendEntry(model.speciesNames, speciesID if name is None else name)
+    model.speciesParams = appendEntry(model.speciesParams, params)
+    return {speciesNum}
+
+def renameSpecies(model, speciesID, newID):
+    # renames a species and rewrites the rules that use it (the matrices do not change);
+    # returns the affected species (its equation and those of the products of its reactions, whose comments change)
+    speciesNum = speciesNumber(model, speciesID)
+    checkSpeciesID(model, newID)
+    interactionMatrix, notMatrix = matrices(model)
+    reactions = model.speciesReactions[speciesNum]
+    rules = list(model.reactionRules)
+    for rcnNum in reactions:
+        rules[rcnNum] = renameInRule(rules[rcnNum], speciesID, newID)
+    model.reactionRules = tuple(rules)
+    model.speciesIDs = replaceEntry(model.speciesIDs, speciesNum, newID)
+    products = [productOf(interactionMatrix, rcnNum) for rcnNum in reactions]
+    return {speciesNum} | {product for product in products if product is not None}
+
+def removeSpecies(model, speciesID):
+    # removes a species that no rule uses; returns the affected species (the renumbered species after
+    # it, and the products of reactions with renumbered reactants)
+    speciesNum = speciesNumber(model, speciesID)
+    interactionMatrix, notMatrix = matrices(model)
+    reactions = model.speciesReactions[speciesNum]
+    if len(reactions):
+        used = ', '.join(str(model.reactionIDs[rcnNum]) for rcnNum in reactions)
+        raise ValueError(f"Species {speciesID} is used by reaction(s) {used}; remove or change them first")
+    model.interactionMatrix = removeEmptyRow(interactionMatrix, speciesNum)
+    model.notMatrix = removeEmptyRow(notMatrix, speciesNum)
+    model.speciesIDs = removeEntry(model.speciesIDs, speciesNum)
+    model.speciesNames = removeEntry(model.speciesNames, speciesNum)
+    model.speciesParams = removeEntry(model.speciesParams, speciesNum)
+    entries = model.interactionMatrix.tocoo()
+    shifted = np.unique(entries.col[entries.row >= speciesNum])
+    products = entries.row[np.isin(entries.col, shifted) & (entries.data == 1)]
+    return set(range(speciesNum, model.interactionMatrix.shape[0])) | set(products.tolist())
+
+def updateODEfile(model, sections=None, affected=None, comments=True):
+    # ODEfuncText after an edit: regenerates the sections of the affected species and reuses the others
+    # (sections from the previous call); sections=None generates every section
+    # returns (ODEfuncText, sections)
+    numSpecies = len(model.speciesIDs)
+    if sections is None:
+        incidence = xls2model.reactionIncidence(model)
+        sections = model2PythonODE.generateODEsections(model, range(numSpecies), incidence, comments)
+        return model2PythonODE.assembleODEfile(model, sections), sections
+    # sections after the last species belong to removed species; added species are always affected, and
+    # species numbers from earlier edits that a removal shifted are covered by the removal's own result
+    sections = list(sections[:numSpecies]) + [None]*(numSpecies - len(sections))
+    speciesNums = sorted(speciesNum for speciesNum in affected or () if speciesNum < numSpecies)
+    incidence = partialIncidence(model, speciesNums)
+    for speciesNum, section in zip(speciesNums, model2PythonODE.generateODEsections(model, speciesNums, incidence, comments)):
+        sections[speciesNum] = section
+    if None in sections:
+        raise ValueError(f"No equation for species {model.speciesIDs[sections.index(None)]}; pass it in affected")
+    return model2PythonODE.assembleODEfile(model, sections), sections
+
+def partialIncidence(model, speciesNums):
+    # xls2model.reactionIncidence for the given species only, as dicts:
+    # productReactions[speciesNum] for speciesNums and reactants[rcnID] for their reactions
+    interactionMatrix, notMatrix = matrices(model)
+    rowMatrix = interactionMatrix.tocsr()
+    rowMatrix.sort_indices()
+    productReactions, reactants = {}, {}
+    for speciesNum in speciesNums:
+        start, end = rowMatrix.indptr[speciesNum], rowMatrix.indptr[speciesNum + 1]
+        productReactions[speciesNum] = rowMatrix.indices[start:end][rowMatrix.data[start:end] == 1].tolist()
+        for rcnID in productReactions[speciesNum]:
+            rows, values = columnOf(interactionMatrix, rcnID)
+            inhibiting = set(columnOf(notMatrix, rcnID)[0].tolist())
+            reactants[rcnID] = [(reactant, reactant in inhibiting) for reactant in rows[values == -1].tolist()]
+    return productReactions, reactants
+
+# ------------------- lookups ---------------------
+
+def reactionNumber(model, reactionID):
+    # position of reactionID (first match)
+    if reactionID not in model.reactionIndex:
+        raise ValueError(f"Unknown reaction {reactionID}")
+    return model.reactionIndex[reactionID]
+
+def speciesNumber(model, speciesID):
+    # position of speciesID (first match, like createInteractionMatrix)
+    if speciesID not in model.speciesIndex:
+        raise ValueError(f"Unknown species {speciesID}")
+    return model.speciesIndex[speciesID]
+
+def checkSpeciesID(model, speciesID):
+    # raises ValueError unless speciesID is a new, valid species ID for reaction rules
+    tokens = xls2model.tokenizeReactionRule(speciesID) if isinstance(speciesID, str) else []
+    if len(tokens) != 1 or tokens[0] != ('id', speciesID):
+        raise ValueError(f"Invalid species ID {speciesID!r}: use letters, digits or _ without spaces, & ! = > or AND/NOT")
+    if speciesID in model.speciesIndex:
+        raise ValueError(f"Species {speciesID} already exists")
+
+def ruleColumns(model, reactionID, rule):
+    # (rows, values) of the interactionMatrix and notMatrix columns of a rule, rows sorted
+    try:
+        entries, inhibitors = xls2model.ruleEntries(rule, model.speciesIndex)
+    except ValueError as e:
+        raise ValueError(f"reaction {reactionID} '{rule}': {e}") from None
+    rows = sorted(entries)
+    notRows = sorted(set(inhibitors))
+    return (rows, [float(entries[row]) for row in rows]), (notRows, [1.0]*len(notRows))
+
+def renameInRule(rule, speciesID, newID):
+    # rule with the species ID tokens speciesID replaced by newID, keeping the rest of the text
+    parts, end = [], 0
+    for match in xls2model.TOKEN_PATTERN.finditer(rule):
+        if match.lastgroup == 'id' and match.group('id') == speciesID:
+            parts.append(rule[end:match.start('id')] + newID)
+            end = match.end('id')
+    return ''.join(parts) + rule[end:]
+
+# ------------------- sparse matrices ---------------------
+
+def matrices(model):
+    # interactionMatrix and notMatrix as CSC matrices with sorted indices (copied only if needed)
+    result = []
+    for matrix in (model.interactionMatrix, model.notMatrix):
+        matrix = sp.csc_matrix(matrix)
+        if not matrix.has_canonical_format:
+            matrix = matrix.copy()
+            matrix.sum_duplicates()
+        result.append(matrix)
+    return result
+
+def columnOf(matrix, k):
+    # (rows, values) of column k of a CSC matrix
+    start, end = matrix.indptr[k], matrix.indptr[k + 1]
+    return matrix.indices[start:end], matrix.data[start:end]
+
+def productOf(interactionMatrix, rcnNum):
+    # product species number of a reaction, or None
+    rows, values = columnOf(interactionMatrix, rcnNum)
+    products = rows[values == 1]
+    return int(products[0]) if len(products) else None
+
+def spliceColumn(matrix, k, column=None):
+    # new CSC matrix with column k replaced by column = (rows, values), removed (column None), or
+    # appended (k = number of columns); the other columns' entries are copied, not rebuilt
+    numRows, numCols = matrix.shape
+    start, end = (matrix.indptr[k], matrix.indptr[k + 1]) if k < numCols else (matrix.nnz, matrix.nnz)
+    rows, values = column if column is not None else ([], [])
+    indices = np.concatenate([matrix.indices[:start], np.asarray(rows, dtype=matrix.indices.dtype), matrix.indices[end:]])
+    data = np.concatenate([matrix.data[:start], np.asarray(values, dtype=matrix.data.dtype), matrix.data[end:]])
+    shift = len(rows) - (end - start)
+    if column is None:
+        indptr = np.concatenate([matrix.indptr[:k + 1], matrix.indptr[k + 2:] + shift])
+        numCols -= 1
+    elif k == numCols:
+        indptr = np.append(matrix.indptr, matrix.nnz + shift)
+        numCols += 1
+    else:
+        indptr = np.concatenate([matrix.indptr[:k + 1], matrix.indptr[k + 1:] + shift])
+    return sp.csc_matrix((data, indices, indptr), shape=(numRows, numCols))
+
+def resized(matrix, numRows):
+    # the same CSC matrix with more (empty) rows
+    return sp.csc_matrix((matrix.data, matrix.indices, matrix.indptr), shape=(numRows, matrix.shape[1]))
+
+def removeEmptyRow(matrix, i):
+    # CSC matrix without row i, which must have no entries
+    indices = matrix.indices - (matrix.indices > i)
+    return sp.csc_matrix((matrix.data.copy(), indices.astype(matrix.indices.dtype), matrix.indptr.copy()),
+                         shape=(matrix.shape[0] - 1, matrix.shape[1]))
+
+# ------------------- tuples (IDs, names, rules) and parameter arrays ---------------------
+
+def appendEntry(values, value):
+    # tuple with value appended, or parameter array with the row value appended
+    if isinstance(values, tuple):
+        return values + (value,)
+    return np.vstack([values, [value]])
+
+def replaceEntry(values, position, value):
+    # tuple with the value at position replaced
+    return values[:position] + (value,) + values[position + 1:]
+
+def removeEntry(values, position):
+    # tuple or parameter array without the entry (row) at position
+    if isinstance(values, tuple):
+        return values[:position] + values[position + 1:]
+    return np.delete(values, position, axis=0)
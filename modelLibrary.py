@@ -0,0 +1,109 @@
+# modelLibrary.py
+# In-memory index of the model library (library.xlsx and the models next to it), shared by all
+# requests, so browsing the library does not read library.xlsx or write the session on every visit.
+#
+# entries(folder) returns {model name: LibraryEntry} in library order. It is built on first use and
+# rebuilt when the folder or library.xlsx changes (mtime). Each entry has the description and image from
+# library.xlsx, plus the model file, species/reaction counts and parsed model (None if the file is
+# missing or fails to parse). Models come from modelCache (disk cache enabled), so they are shared;
+# treat them as read-only.
+#
+# thumbnail(folder, imageName, width, cacheFolder) returns the path of a copy of a library image at most
+# width pixels wide (width rounded up to THUMBNAIL_WIDTHS). Each copy is made once per image version
+# (mtime in the file name) with Pillow, which comes with matplotlib, in the original's encoding.
+#
+# usage (webapp.py):
+#   names = list(modelLibrary.entries(app.config['MODELS_FOLDER']))
+#   entry = modelLibrary.entries(app.config['MODELS_FOLDER']).get(name)
+
+import os, threading
+from collections import namedtuple, OrderedDict
+import modelCache, xlsxReader
+
+LIBRARY_FILE = 'library.xlsx'
+THUMBNAIL_WIDTHS = (200, 400, 800)
+
+LibraryEntry = namedtuple('LibraryEntry', 'name description image filename numSpecies numReactions model')
+
+_index = {}     # folder -> (signature, OrderedDict of entries)
+_lock = threading.Lock()
+stats = {'builds': 0, 'thumbnails': 0}
+
+def signature(folder):
+    # changes whenever a file is added, removed or renamed in folder, or library.xlsx is rewritten
+    libraryPath = os.path.join(folder, LIBRARY_FILE)
+    if not os.path.isdir(folder):
+        return None
+    return (os.stat(folder).st_mtime_ns, os.stat(libraryPath).st_mtime_ns if os.path.exists(libraryPath) else None)
+
+def entries(folder):
+    # {model name: LibraryEntry}, rebuilt if the library changed since the last call
+    folder = os.path.abspath(folder)
+    current = signature(folder)
+    with _lock:
+        cached = _index.get(folder)
+        if cached is not None and cached[0] == current:
+            return cached[1]
+        library = buildIndex(folder)
+        _index[folder] = (current, library)
+        stats['builds'] += 1
+    return library
+
+def buildIndex(folder):
+    # reads library.xlsx (columns: model name, description, image) and loads every listed model
+    library = OrderedDict()
+    libraryPath = os.path.join(folder, LIBRARY_FILE)
+    if not os.path.exists(libraryPath):
+        return library
+    for row in xlsxReader.readSheet(libraryPath)[1:]:     # first row: column headers
+        name, description, image = (None if value is None else str(value).strip() for value in (row + [None]*3)[:3])
+        if not name:
+            continue
+        filename = name + '.xlsx'
+        model = None
+        if os.path.exists(os.path.join(folder, filename)):
+            try:
+                model = modelCache.loadModel(os.path.join(folder, filename), diskCache=True)
+            except Exception as e:
+                print(f"modelLibrary: could not load {filename}: {type(e).__name__}: {e}")
+        library[name] = LibraryEntry(name, description or '', image, filename if model is not None else None,
+                                     len(model.speciesIDs) if model is not None else None,
+                                     len(model.reactionIDs) if model is not None else None, model)
+    return library
+
+def thumbnailWidth(width):
+    # smallest THUMBNAIL_WIDTHS >= width (the largest for anything bigger)
+    return next((w for w in THUMBNAIL_WIDTHS if w >= width), THUMBNAIL_WIDTHS[-1])
+
+def thumbnail(folder, imageName, width, cacheFolder):
+    # path of imageName resized to at most width pixels wide; the original if it is not wider
+    # or cannot be read as an image
+    from PIL import Image
+    imagePath = os.path.join(folder, os.path.basename(imageName))
+    width = thumbnailWidth(width)
+    stem = os.path.splitext(os.path.basename(imageName))[0]
+    extension = os.path.splitext(imageName)[1]
+    thumbPath = os.path.join(cacheFolder, f"{stem}_{width}_{os.stat(imagePath).st_mtime_ns}{extension}")
+    if os.path.exists(thumbPath):
+        return thumbPath
+    try:
+        with Image.open(imagePath) as image:
+            if image.width <= width:
+                return imagePath
+            height = max(1, round(image.height*width/image.width))
+            resized, imageFormat = image.resize((width, height), Image.LANCZOS), image.format or 'PNG'
+    except Exception as e:
+        print(f"modelLibrary: serving {imageName} unresized: {type(e).__name__}: {e}")
+        return imagePath
+    os.makedirs(cacheFolder, exist_ok=True)
+    tmpPath = f"{thumbPath}.{os.getpid()}.{threading.get_ident()}.tmp"
+    resized.save(tmpPath, format=imageFormat)   # same encoding as the original, under its name
+    os.replace(tmpPath, thumbPath)
+    with _lock:
+        stats['thumbnails'] += 1
+    return thumbPath
+
+def clear():
+    # forgets every index (thumbnails on disk are versioned by mtime and stay valid)
+    with _lock:
+        _index.clear()
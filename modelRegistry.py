@@ -0,0 +1,82 @@
+# modelRegistry.py
+# Process-wide registry of compiled model callables, so a model is compiled once and
+# reused by every request and thread instead of exec()-ing the ODE text each time.
+#
+# Entries are keyed by content, not by session or model name:
+#   getODEfunc(ODEfuncText)    sha256 of the generated source  -> ODEfunc from exec()
+#   getODEfuncs(ODEfuncText)   same entry -> (ODEfunc, makeODEfunc); makeODEfunc binds one parameter set
+#   getCompiledModel(model)    sha256 of the model structure    -> model2NumpyODE.CompiledModel
+# (speciesIDs, interactionMatrix, notMatrix); parameters are not part of the key, since
+# they are passed to ODEfunc at call time.
+#
+# The registry is an LRU cache (MAX_ENTRIES) guarded by a lock, safe under threaded
+# Flask/gunicorn workers. Compilation runs outside the lock; if two threads compile the
+# same key at once, the first one stored wins and both get the same callable.
+
+import hashlib, threading
+from collections import OrderedDict
+import numpy as np
+import scipy.sparse as sp
+import model2NumpyODE
+
+MAX_ENTRIES = 64
+
+_entries = OrderedDict()
+_lock = threading.Lock()
+stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def lookup(key, build):
+    # returns the cached value for key, calling build() and storing the result on a miss
+    with _lock:
+        if key in _entries:
+            _entries.move_to_end(key)
+            stats['hits'] += 1
+            return _entries[key]
+        stats['misses'] += 1
+    value = build()
+    with _lock:
+        value = _entries.setdefault(key, value)
+        _entries.move_to_end(key)
+        while len(_entries) > MAX_ENTRIES:
+            _entries.popitem(last=False)
+            stats['evictions'] += 1
+    return value
+
+def sourceKey(ODEfuncText):
+    # key for generated ODE source text
+    return 'source:' + hashlib.sha256(ODEfuncText.encode()).hexdigest()
+
+def structureKey(model):
+    # key for a model's structure: species IDs and the interaction and not matrices
+    # (hashed in canonical CSC form, so sparse and dense copies of a model share a key)
+    digest = hashlib.sha256()
+    digest.update('\0'.join(map(str, model.speciesIDs)).encode())
+    for matrix in (model.interactionMatrix, model.notMatrix):
+        matrix = sp.csc_matrix(matrix, dtype=np.int8, copy=True)
+        matrix.sum_duplicates()
+        matrix.eliminate_zeros()
+        digest.update(str(matrix.shape).encode())
+        for array in (matrix.indptr, matrix.indices, matrix.data):
+            digest.update(np.ascontiguousarray(array, dtype=np.int64).tobytes())
+    return 'structure:' + digest.hexdigest()
+
+def getODEfunc(ODEfuncText):
+    # ODEfunc defined by generated source text (model2PythonODE.generateODEfile)
+    return getODEfuncs(ODEfuncText)[0]
+
+def getODEfuncs(ODEfuncText):
+    # (ODEfunc, makeODEfunc) defined by generated source text, compiled once
+    def build():
+        namespace = {}
+        exec(compile(ODEfuncText, '<ODEfuncText>', 'exec'), namespace)
+        return namespace['ODEfunc'], namespace['makeODEfunc']
+    return lookup(sourceKey(ODEfuncText), build)
+
+def getCompiledModel(model):
+    # model2NumpyODE.CompiledModel for a NetfluxModel
+    return lookup(structureKey(model), lambda: model2NumpyODE.compileModel(model))
+
+def clear():
+    # removes all entries (e.g. after editing modules during development)
+    with _lock:
+        _entries.clear()
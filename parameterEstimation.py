@@ -0,0 +1,224 @@
+# parameterEstimation.py
+# Fits parameters of a NetfluxModel (default: every w, EC50 and tau) to measured time courses.
+#
+# data: {speciesID: (t, values)} or {speciesID: (t, values, sigma)}; the residuals are
+# (simulated - measured)/sigma at the measured times, with the simulation started from y0 at tspan[0].
+#
+# Gradients are exact, not finite differences: the forward sensitivities s = dy/dp of the fitted
+# parameters are integrated together with the state,
+#   ds/dt = J(y) s + df/dp,   s(t0) = dy0/dp
+# with the analytic Jacobian J (CompiledModel.jacobian) and parameter derivatives df/dp
+# (CompiledModel.paramDerivatives), so one simulation of species x (1 + parameters) states gives the
+# residuals and their Jacobian. Implicit solvers get the block Jacobian of the augmented system.
+#
+# method: 'least_squares' (trust region reflective, residual Jacobian) or 'L-BFGS-B' (cost and
+# gradient), both with bounds. Default bounds: w in [0, 1], tau within 10x of the model value, n and
+# EC50 +/- 50% as globalSensitivity.parameterSpace, kept to EC50**n < 0.5.
+# numStarts > 1 also starts from Latin hypercube points within the bounds, on a process pool
+# (workerPool.poolMap: model, data and options sent once per worker); the best fit is returned.
+#
+# usage:
+#   fit = fitParameters(model, {'C': (t, values)}, columns=['w[r1]', 'tau[C]'], numStarts=8)
+#   fit.x, fit.columns, fit.params (full parameter vector), fit.cost, fit.starts
+
+from collections import namedtuple
+import numpy as np
+import scipy.sparse as sp
+from scipy import optimize
+from scipy.integrate import solve_ivp
+import globalSensitivity, modelRegistry, simulation, workerPool
+
+FIT_METHODS = ('least_squares', 'L-BFGS-B')
+FIT_GROUPS = ('w', 'EC50', 'tau')   # parameters fitted by default
+TAU_RANGE = 10                      # default tau bounds: model value /10 to *10
+
+# measured values: times (the t_eval grid), and per data point its species, time index, value and sigma
+Measurements = namedtuple('Measurements', 't species timeIndex values sigma')
+
+def measurements(model, data):
+    # Measurements from {speciesID: (t, values[, sigma])}
+    speciesIDs = list(model.speciesIDs)
+    species, times, values, sigma = [], [], [], []
+    for speciesID, series in data.items():
+        if speciesID not in speciesIDs:
+            raise ValueError(f"Unknown species in data: {speciesID}")
+        t, y = np.asarray(series[0], dtype=float), np.asarray(series[1], dtype=float)
+        s = np.broadcast_to(np.asarray(series[2], dtype=float) if len(series) > 2 else 1.0, t.shape)
+        if t.shape != y.shape or t.ndim != 1:
+            raise ValueError(f"Data for {speciesID} needs times and values of the same length")
+        if np.any(s <= 0):
+            raise ValueError(f"Data for {speciesID} has sigma <= 0")
+        keep = np.isfinite(y)
+        species.append(np.full(keep.sum(), speciesIDs.index(speciesID)))
+        times.append(t[keep]), values.append(y[keep]), sigma.append(s[keep])
+    if not species or not sum(map(len, species)):
+        raise ValueError("No data points to fit")
+    times = np.concatenate(times)
+    grid, timeIndex = np.unique(times, return_inverse=True)
+    return Measurements(grid, np.concatenate(species), timeIndex, np.concatenate(values), np.concatenate(sigma))
+
+def fitBounds(model, columns=None, bounds=None):
+    # (labels, positions, lower, upper) of the fitted parameters; bounds {label: (low, high)} override the defaults
+    labels = simulation.paramLabels(model)
+    if columns is None:
+        columns = [label for label in labels if label.split('[')[0] in FIT_GROUPS]
+    columns = [labels[c] if isinstance(c, (int, np.integer)) else c for c in columns]
+    nominal = simulation.modelParams(model)[simulation.paramColumns(model, columns)]
+    defaults = {}   # w: (0, 1) in parameterSpace
+    for label, value in zip(columns, nominal):
+        if label.startswith('EC50[') and 'n' + label[4:] not in columns:
+            # n stays fixed: EC50 only has to keep EC50**n < 0.5
+            n = simulation.modelParams(model)[simulation.paramColumns(model, ['n' + label[4:]])[0]]
+            spread = globalSensitivity.DEFAULT_SPREAD
+            defaults[label] = (value*(1 - spread), min(value*(1 + spread), (0.5*(1 - 1e-9))**(1/n)))
+        elif label.startswith(('tau[', 'ymax[')):
+            defaults[label] = (value/TAU_RANGE, value*TAU_RANGE)
+        elif label.startswith('y0['):
+            defaults[label] = (0.0, max(1.0, value))
+    return globalSensitivity.parameterSpace(model, columns, {**defaults, **(bounds or {})})
+
+def sensitivityODE(compiledModel, params, positions):
+    # right-hand side of the state and its sensitivities to the parameters at positions (full vector),
+    # z = [y, s (species x parameters, row-major)], and the Jacobian of the augmented system
+    S, R = compiledModel.numSpecies, compiledModel.numReactions
+    P = len(positions)
+    ymax, tau, w, n, EC50 = simulation.splitParams(params, S, R)[1:]
+    columns = np.arange(P)
+
+    def rhs(t, z):
+        y, s = z[:S], z[S:].reshape(S, P)
+        dydt = compiledModel.ODEfunc(t, y, ymax, tau, w, n, EC50)
+        ds = compiledModel.jacobian(t, y, ymax, tau, w, n, EC50) @ s
+        rows, values = compiledModel.paramDerivatives(t, y, ymax, tau, w, n, EC50)
+        rows, values = rows[positions], values[positions]
+        acts = rows >= 0
+        ds[rows[acts], columns[acts]] += values[acts]
+        return np.concatenate([dydt, ds.ravel()])
+
+    def jac(t, z):
+        # d(J s + df/dp)/ds = J for every parameter; the second derivative terms d(J s)/dy are left out,
+        # which only slows the Newton iterations of implicit methods down, not the accuracy
+        J = compiledModel.jacobian(t, z[:S], ymax, tau, w, n, EC50)
+        return sp.block_diag([J, sp.kron(J, sp.identity(P), format='csr')], format='csr')
+
+    return rhs, jac
+
+def simulateSensitivities(compiledModel, params, positions, tspan, t_eval, solver='auto', rtol=1e-6, atol=1e-8):
+    # y (species x T) and dy/dp (species x parameters x T) at t_eval, for the parameters at positions
+    # (positions in the full parameter vector, as from simulation.paramColumns)
+    S, R = compiledModel.numSpecies, compiledModel.numReactions
+    params = np.asarray(params, dtype=float)
+    positions = np.asarray(positions, dtype=int)
+    P = len(positions)
+    s0 = np.zeros((S, P))
+    isY0 = positions < S                                # y0 parameters: s(t0) = 1 for their species
+    s0[positions[isY0], np.flatnonzero(isY0)] = 1.0
+    rhs, jac = sensitivityODE(compiledModel, params, positions)
+    method = simulation.selectSolver(simulation.splitParams(params, S, R)[2], solver)
+    options = {'jac': jac} if method in ('BDF', 'Radau') else {}
+    solution = solve_ivp(rhs, tspan, np.concatenate([params[:S], s0.ravel()]), method=method, t_eval=t_eval,
+                         rtol=rtol, atol=atol, **options)
+    if not solution.success:
+        raise RuntimeError(f"solve_ivp ({method}) failed: {solution.message}")
+    return solution.y[:S], solution.y[S:].reshape(S, P, -1)
+
+def residualFunctions(compiledModel, params, positions, data, tspan, solver='auto', rtol=1e-6, atol=1e-8):
+    # residuals(x) and jacobian(x) of the fitted values x; one sensitivity simulation serves both
+    # (least_squares asks for the residuals and then the Jacobian at the same x)
+    cache = {}
+
+    def evaluate(x):
+        x = np.asarray(x, dtype=float)
+        if cache.get('x') is None or not np.array_equal(cache['x'], x):
+            full = params.copy()
+            full[positions] = x
+            cache['x'] = x.copy()
+            if not globalSensitivity.validParams(full[None, :], compiledModel.numSpecies, compiledModel.numReactions)[0]:
+                cache['r'], cache['J'] = np.full(len(data.values), np.nan), None
+                return cache
+            try:
+                y, s = simulateSensitivities(compiledModel, full, positions, tspan, data.t, solver, rtol, atol)
+            except RuntimeError:
+                cache['r'], cache['J'] = np.full(len(data.values), np.nan), None
+                return cache
+            cache['r'] = (y[data.species, data.timeIndex] - data.values)/data.sigma
+            cache['J'] = s[data.species, :, data.timeIndex]/data.sigma[:, None]
+        return cache
+
+    def residuals(x):
+        return evaluate(x)['r']
+
+    def jacobian(x):
+        J = evaluate(x)['J']
+        return np.zeros((len(data.values), len(positions))) if J is None else J
+
+    return residuals, jacobian
+
+def fitFrom(compiledModel, params, positions, lower, upper, data, x0, tspan, method='least_squares',
+            solver='auto', rtol=1e-6, atol=1e-8, **options):
+    # one local fit from x0; returns a dict (x, cost, success, message, nfev, njev)
+    # options go to scipy.optimize.least_squares or minimize (e.g. max_nfev, ftol, options={'maxiter': ...})
+    residuals, jacobian = residualFunctions(compiledModel, params, positions, data, tspan, solver, rtol, atol)
+    if method == 'least_squares':
+        result = optimize.least_squares(residuals, x0, jac=jacobian, bounds=(lower, upper), x_scale='jac', **options)
+        return {'x': result.x, 'cost': float(result.cost), 'success': bool(result.success), 'message': result.message,
+                'nfev': int(result.nfev), 'njev': int(result.njev or 0)}
+    if method == 'L-BFGS-B':
+        # minimizes over u = (x - lower)/scale in [0, 1] so w, EC50 and tau steps are comparable
+        scale = np.where(upper > lower, upper - lower, 1.0)
+        def cost(u):
+            r = residuals(lower + u*scale)
+            return 0.5*float(r @ r) if np.all(np.isfinite(r)) else np.inf
+        def gradient(u):
+            x = lower + u*scale
+            return scale*(jacobian(x).T @ np.nan_to_num(residuals(x)))
+        result = optimize.minimize(cost, (x0 - lower)/scale, jac=gradient, method='L-BFGS-B',
+                                   bounds=list(zip(np.zeros(len(x0)), (upper - lower)/scale)), **options)
+        return {'x': lower + result.x*scale, 'cost': float(result.fun), 'success': bool(result.success),
+                'message': str(result.message), 'nfev': int(result.nfev), 'njev': int(result.get('njev', result.nfev))}
+    raise ValueError(f"Unknown fitting method: {method}, expected one of {FIT_METHODS}")
+
+def runStart(state, task):
+    # one start of a multi-start fit, returns (start number, result)
+    # state: compiled model, parameters, fitted positions, bounds, data and fit settings
+    compiledModel, params, positions, lower, upper, data, options = state
+    start, x0 = task
+    return start, fitFrom(compiledModel, params, positions, lower, upper, data, x0, **options)
+
+def startPoints(x0, lower, upper, numStarts, seed=0):
+    # x0 (clipped to the bounds) followed by numStarts - 1 Latin hypercube points within the bounds
+    rng = np.random.default_rng(seed)
+    points = [np.clip(x0, lower, upper)]
+    if numStarts > 1:
+        points += list(lower + globalSensitivity.latinHypercube(numStarts - 1, len(x0), rng)*(upper - lower))
+    return points
+
+def fitParameters(model, data, columns=None, bounds=None, method='least_squares', numStarts=1, maxWorkers=None,
+                  seed=0, tspan=None, params=None, solver='auto', rtol=1e-6, atol=1e-8, **options):
+    # fits the parameters columns (labels, default FIT_GROUPS) of model to data; returns an OptimizeResult
+    # with x, columns, params (full parameter vector with the fit), cost (0.5*sum of squared residuals),
+    # success, message, lower, upper and starts (the result of every start, best first)
+    # tspan: simulated interval (default 0 to the last measured time); params: starting full parameter
+    # vector (default the model's); maxWorkers=1 runs the starts in this process without a pool
+    if method not in FIT_METHODS:
+        raise ValueError(f"Unknown fitting method: {method}, expected one of {FIT_METHODS}")
+    compiledModel = modelRegistry.getCompiledModel(model)
+    params = simulation.modelParams(model) if params is None else np.array(params, dtype=float)
+    columns, positions, lower, upper = fitBounds(model, columns, bounds)
+    data = measurements(model, data)
+    tspan = (0.0, float(data.t[-1])) if tspan is None else (float(tspan[0]), float(tspan[1]))
+    if data.t[0] < tspan[0] or data.t[-1] > tspan[1]:
+        raise ValueError(f"Measured times must be within tspan [{tspan[0]:g}, {tspan[1]:g}]")
+    fitOptions = dict(options, tspan=tspan, method=method, solver=solver, rtol=rtol, atol=atol)
+    tasks = list(enumerate(startPoints(params[positions], lower, upper, numStarts, seed)))
+
+    results = dict(workerPool.poolMap(runStart, tasks, (compiledModel, params, positions, lower, upper, data, fitOptions),
+                                      1 if len(tasks) == 1 else maxWorkers))
+    starts = sorted(({'start': start, **result} for start, result in results.items()),
+                    key=lambda result: (not np.isfinite(result['cost']), result['cost']))
+    best = starts[0]
+    fitted = params.copy()
+    fitted[positions] = best['x']
+    return optimize.OptimizeResult(x=best['x'], columns=columns, params=fitted, cost=best['cost'],
+                                   success=best['success'], message=best['message'], lower=lower, upper=upper,
+                                   nfev=best['nfev'], njev=best['njev'], starts=starts)
@@ -0,0 +1,102 @@
+# plotRenderer.py
+# Renders simulation plots for the webapp (base64 PNG), without the pyplot state machine.
+#
+# - Figures are object-oriented Agg figures (matplotlib.figure.Figure + FigureCanvasAgg), one per
+#   thread and size, cleared and reused for every render, so nothing accumulates in pyplot.
+# - Each series is downsampled to the first, last, min and max point of every pixel column
+#   before drawing, so render time depends on the plot width rather than the number of time points.
+# - Encoded PNGs are kept in an LRU cache (MAX_ENTRIES) keyed by
+#   (trajectory id, trajectory version, selected species, legend names, width, height); the version
+#   changes whenever trajectoryStore appends a segment, so Replot of an unchanged selection is a lookup,
+#   and renaming a species (modelEdit) draws a new legend.
+# - matplotlib is imported with the first figure, not with this module (webapp start-up time).
+
+import io, base64, threading
+from collections import OrderedDict
+import numpy as np
+
+WIDTH, HEIGHT, DPI = 640, 480, 100   # pixels, same as the matplotlib default figure
+MIN_SIZE, MAX_SIZE = 100, 2000       # allowed plot width/height in pixels
+MAX_ENTRIES = 128
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+_figures = threading.local()
+stats = {'hits': 0, 'misses': 0}
+
+def plotSize(width=None, height=None):
+    # plot size in pixels, clipped to [MIN_SIZE, MAX_SIZE]
+    width = int(np.clip(int(width or WIDTH), MIN_SIZE, MAX_SIZE))
+    height = int(np.clip(int(height or HEIGHT), MIN_SIZE, MAX_SIZE))
+    return width, height
+
+def minMaxIndices(t, y, numBins):
+    # indices of the first, last, min and max point of y in each of numBins equal time bins
+    # t must be nondecreasing; returns all indices when there are few points per bin
+    if len(t) <= 4*numBins:
+        return np.arange(len(t))
+    span = t[-1] - t[0]
+    bins = np.zeros(len(t), dtype=np.int64) if span <= 0 else np.minimum(((t - t[0])/span*numBins).astype(np.int64), numBins - 1)
+    starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+    ends = np.r_[starts[1:], len(t)] - 1
+    order = np.lexsort((y, bins))        # by bin, then by value
+    return np.unique(np.concatenate([starts, ends, order[starts], order[ends]]))
+
+def figureFor(width, height):
+    # the calling thread's figure of this size, cleared for reuse
+    figures = getattr(_figures, 'figures', None)
+    if figures is None:
+        figures = _figures.figures = {}
+    fig = figures.get((width, height))
+    if fig is None:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure(figsize=(width/DPI, height/DPI), dpi=DPI)
+        FigureCanvasAgg(fig)
+        figures.clear()                  # keep a single figure per thread
+        figures[(width, height)] = fig
+    fig.clear()
+    return fig
+
+def renderPlot(t, y, names, width=WIDTH, height=HEIGHT):
+    # PNG bytes of y (selected species x time) against t, one line per species
+    fig = figureFor(width, height)
+    try:
+        ax = fig.add_subplot()
+        t = np.asarray(t, dtype=float)
+        for series in np.asarray(y, dtype=float):
+            keep = minMaxIndices(t, series, width)
+            ax.plot(t[keep], series[keep])
+        ax.legend(names)
+        ax.set_xlabel('Time')
+        ax.set_ylabel('Normalized activity')
+        img = io.BytesIO()
+        fig.savefig(img, format='png')
+        return img.getvalue()
+    finally:
+        fig.clear()                      # release the artists and data of this render
+
+def cachedPlot(trajectory, speciesNums, names, load, width=WIDTH, height=HEIGHT):
+    # base64 PNG of the selected species of a stored trajectory
+    # load() returns (t, y) as from trajectoryStore.load and is only called on a cache miss
+    width, height = plotSize(width, height)
+    key = (trajectory['id'], trajectory['version'], tuple(int(i) for i in speciesNums), tuple(names), width, height)
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            stats['hits'] += 1
+            return _cache[key]
+        stats['misses'] += 1
+    t, y = load()
+    plot_url = base64.b64encode(renderPlot(t, y[np.asarray(speciesNums, dtype=int)], names, width, height)).decode('utf8')
+    with _lock:
+        _cache[key] = plot_url
+        _cache.move_to_end(key)
+        while len(_cache) > MAX_ENTRIES:
+            _cache.popitem(last=False)
+    return plot_url
+
+def clear():
+    # empties the PNG cache
+    with _lock:
+        _cache.clear()
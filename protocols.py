@@ -0,0 +1,153 @@
+# protocols.py
+# Time-scheduled perturbation protocols, e.g. "raise input w at t=10, remove it at t=50, knock down B
+# at t=80", simulated in one call instead of one Simulate click per change.
+#
+# A protocol is a list of steps, each a dict with a time "t" and one change:
+#   {"t": 10, "param": "w[r1]", "value": 1.0}       sets a parameter (labels from simulation.paramLabels)
+#   {"t": 10, "param": "w[r1]", "scale": 2.0}       multiplies a parameter
+#   {"t": 80, "species": "B", "knockdown": 0.8}     ymax *= 1 - knockdown (1 = knockout)
+#   {"t": 20, "species": "A", "set": 0.5}           sets the state of a species (bolus, washout)
+#   {"t": 30, "species": "A", "clamp": 0.3}         sets the state and holds it there (dydt = 0) ...
+#   {"t": 60, "species": "A", "release": true}      ... until released
+# Steps at or before the start time (or without "t") are applied before integrating.
+#
+# runProtocol integrates between breakpoints only: the compiled model is reused for every segment,
+# parameter changes are written into the one parameter vector, and the output goes into a buffer
+# preallocated for the t_eval grid (or, without a grid, the segments are joined with a single copy).
+
+from collections import namedtuple
+import numpy as np
+import simulation
+
+Step = namedtuple('Step', 't kind index value')   # kind: 'value', 'scale', 'set', 'clamp', 'release'
+
+def compileProtocol(model, steps, t0=0.0):
+    # Steps sorted by time (stable, so steps at the same time apply in the given order);
+    # index is a position in the full parameter vector ('value', 'scale') or a species number
+    speciesIDs = list(model.speciesIDs)
+    compiled = []
+    for step in steps:
+        t = float(step.get('t', t0))
+        if 'param' in step:
+            column = int(simulation.paramColumns(model, [step['param']])[0])
+            if 'value' in step:
+                compiled.append(Step(t, 'value', column, float(step['value'])))
+            elif 'scale' in step:
+                compiled.append(Step(t, 'scale', column, float(step['scale'])))
+            else:
+                raise ValueError(f"Protocol step {step} needs 'value' or 'scale'")
+        elif 'species' in step:
+            if step['species'] not in speciesIDs:
+                raise ValueError(f"Unknown species {step['species']!r} in protocol step {step}")
+            speciesNum = speciesIDs.index(step['species'])
+            if 'knockdown' in step:
+                column = int(simulation.paramColumns(model, [f"ymax[{step['species']}]"])[0])
+                compiled.append(Step(t, 'scale', column, 1 - float(step['knockdown'])))
+            elif 'set' in step or 'clamp' in step:
+                kind = 'set' if 'set' in step else 'clamp'
+                compiled.append(Step(t, kind, speciesNum, float(step[kind])))
+            elif step.get('release'):
+                compiled.append(Step(t, 'release', speciesNum, None))
+            else:
+                raise ValueError(f"Protocol step {step} needs 'knockdown', 'set', 'clamp' or 'release'")
+        else:
+            raise ValueError(f"Protocol step {step} needs 'param' or 'species'")
+    return sorted(compiled, key=lambda step: step.t)
+
+def checkProtocol(steps, tspan):
+    # raises ValueError if a step falls at or after the end of tspan
+    late = [step for step in steps if step.t >= tspan[1] and step.t > tspan[0]]
+    if late:
+        raise ValueError(f"Protocol step at t={late[0].t:g} is not before the end of the simulation (t={tspan[1]:g})")
+
+def applyStep(step, params, y, free):
+    # applies a step to the parameter vector, the state and the free (not clamped) mask, in place
+    if step.kind == 'value':
+        params[step.index] = step.value
+    elif step.kind == 'scale':
+        params[step.index] *= step.value
+    elif step.kind == 'set':
+        y[step.index] = step.value
+    elif step.kind == 'clamp':
+        y[step.index] = step.value
+        free[step.index] = 0.0
+    elif step.kind == 'release':
+        free[step.index] = 1.0
+
+def clampedODEfunc(ODEfunc, free):
+    # ODEfunc with dydt = 0 for the clamped species (free == 0)
+    def clamped(t, y, *args):
+        return ODEfunc(t, y, *args)*free
+    return clamped
+
+def runProtocol(compiledModel, tspan, params, steps, y0=None, solver='auto', t_eval=None, ODEfunc=None,
+                rtol=1e-8, **options):
+    # simulates the full parameter vector params over tspan with the compiled protocol steps
+    # y0 overrides the initial state in params (e.g. to continue a simulation); ODEfunc defaults to
+    # compiledModel.ODEfunc (a wrapper such as jobQueue.Job.track can be given instead)
+    # t_eval: output grid within tspan; None keeps the solver steps, with the state before and
+    # after each breakpoint both included
+    # returns an OptimizeResult like solve_ivp's (t, y, nfev, njev, nlu, method) plus params (the final
+    # parameter vector), breakpoints and segments; extra options (events, atol...) go to every segment
+    S, R = compiledModel.numSpecies, compiledModel.numReactions
+    ODEfunc = ODEfunc or compiledModel.ODEfunc
+    t0, t1 = float(tspan[0]), float(tspan[1])
+    params = np.array(params, dtype=float)
+    y = np.array(simulation.splitParams(params, S, R)[0] if y0 is None else y0, dtype=float)
+    free = np.ones(S)
+    checkProtocol(steps, tspan)
+    for step in steps:
+        if step.t <= t0:
+            applyStep(step, params, y, free)
+    breakpoints = sorted({step.t for step in steps if t0 < step.t < t1})
+    bounds = [t0] + breakpoints + [t1]
+
+    if t_eval is not None:
+        t_eval = np.asarray(t_eval, dtype=float)
+        if len(t_eval) and (t_eval[0] < t0 or t_eval[-1] > t1 or np.any(np.diff(t_eval) < 0)):
+            raise ValueError(f"t_eval must be increasing and within tspan [{t0:g}, {t1:g}]")
+        yOut = np.empty((S, len(t_eval)))
+    else:
+        tSegments, ySegments = [], []
+    stats = {'nfev': 0, 'njev': 0, 'nlu': 0}
+    methods, segments = [], 0
+    for k in range(len(bounds) - 1):
+        ta, tb = bounds[k], bounds[k + 1]
+        last = k == len(bounds) - 2
+        func = ODEfunc if free.all() else clampedODEfunc(ODEfunc, free.copy())
+        args = simulation.splitParams(params.copy(), S, R)[1:]
+        if t_eval is not None:
+            # grid points in [ta, tb) (the last segment includes t1), plus tb for the restart state
+            lo = np.searchsorted(t_eval, ta, 'left')
+            hi = np.searchsorted(t_eval, tb, 'right' if last else 'left')
+            segmentEval = t_eval[lo:hi] if last else np.append(t_eval[lo:hi], tb)
+            if len(segmentEval) == 0:
+                break
+            solution = simulation.runSimulation(func, (ta, tb), y, args, solver, compiledModel, rtol,
+                                                t_eval=segmentEval, **options)
+            yOut[:, lo:hi] = solution.y[:, :hi - lo]
+        else:
+            solution = simulation.runSimulation(func, (ta, tb), y, args, solver, compiledModel, rtol, **options)
+            tSegments.append(solution.t)
+            ySegments.append(solution.y)
+        segments += 1
+        for name in stats:
+            stats[name] += int(solution[name])
+        if solution.method not in methods:
+            methods.append(solution.method)
+        if last:
+            break
+        y = np.array(solution.y[:, -1], dtype=float)
+        for step in steps:
+            if step.t == tb:
+                applyStep(step, params, y, free)
+
+    if t_eval is not None:
+        t = t_eval
+    else:
+        t = np.concatenate(tSegments)
+        yOut = np.empty((S, len(t)))
+        np.concatenate(ySegments, axis=1, out=yOut)
+    from scipy.optimize import OptimizeResult
+    return OptimizeResult(t=t, y=yOut, method='+'.join(methods), success=True, message='Protocol complete',
+                          params=params, breakpoints=breakpoints, segments=segments, **stats)
@@ -0,0 +1,70 @@
+# randomNetwork.py
+# Generates random networks in Netflux syntax, for benchmarks and scaling tests.
+#
+# randomModel(numSpecies, ...) returns a NetfluxModel built like xls2model.createModel would from a
+# spreadsheet (rules parsed by createInteractionMatrix), and
+# writeXlsx(model, filename) saves it as a spreadsheet that createModel can read back.
+#
+# Network structure: species are ordered; the first numInputs species get input reactions (=> A),
+# every other species gets on average reactionsPerSpecies reactions (combined by OR). Each reaction
+# has fanIn reactants (AND gate) with probability andFraction, otherwise one reactant. Reactants come
+# from upstream species, except with probability feedback, where any species can be chosen
+# (feedback loops). Each reactant is inhibiting (!) with probability notFraction.
+
+import numpy as np
+import xls2model
+
+def randomRules(numSpecies, numInputs=None, reactionsPerSpecies=1.5, fanIn=2, andFraction=0.2,
+                notFraction=0.2, feedback=0.05, seed=0):
+    # returns speciesIDs and reaction rules (Netflux v1 syntax) of a random network
+    rng = np.random.default_rng(seed)
+    numInputs = numInputs if numInputs is not None else max(1, numSpecies//20)
+    if not 0 < numInputs <= numSpecies:
+        raise ValueError(f"numInputs must be between 1 and numSpecies ({numSpecies}), got {numInputs}")
+    width = len(str(numSpecies))
+    speciesIDs = [f"S{i:0{width}d}" for i in range(numSpecies)]
+    rules = [f"=> {speciesIDs[i]}" for i in range(numInputs)]
+    for product in range(numInputs, numSpecies):
+        for _ in range(max(1, rng.poisson(reactionsPerSpecies))):
+            numReactants = fanIn if rng.random() < andFraction else 1
+            if rng.random() < feedback:
+                pool = numSpecies        # any species, including downstream ones
+            else:
+                pool = product           # upstream species only
+            reactants = rng.choice(pool, size=min(numReactants, pool), replace=False)
+            terms = [("!" if rng.random() < notFraction else "") + speciesIDs[r] for r in reactants]
+            rules.append(f"{' & '.join(terms)} => {speciesIDs[product]}")
+    return speciesIDs, rules
+
+def randomModel(numSpecies, modelName=None, tauRange=(1, 1), seed=0, **options):
+    # NetfluxModel of a random network; tau is log-uniform in tauRange (a wide range gives a stiff model)
+    # options are passed to randomRules
+    speciesIDs, rules = randomRules(numSpecies, seed=seed, **options)
+    rng = np.random.default_rng(seed + 1)
+    numReactions = len(rules)
+    tau = np.exp(rng.uniform(np.log(tauRange[0]), np.log(tauRange[1]), numSpecies))
+    speciesParams = np.column_stack([np.zeros(numSpecies), np.ones(numSpecies), tau])
+    w = [0.1 if rule.startswith('=>') else 1.0 for rule in rules]
+    reactionParams = np.column_stack([w, np.full(numReactions, 1.4), np.full(numReactions, 0.5)])
+    mymodel = xls2model.NetfluxModel(modelName or f"random{numSpecies}", speciesIDs, speciesIDs, speciesParams,
+                                     [f"r{i+1}" for i in range(numReactions)], rules, reactionParams)
+    return xls2model.createInteractionMatrix(mymodel)
+
+def writeXlsx(mymodel, filename):
+    # writes the model as a Netflux spreadsheet (species and reactions sheets) readable by createModel
+    import pandas as pd     # only needed for writing spreadsheets
+    numSpecies, numReactions = len(mymodel.speciesIDs), len(mymodel.reactionRules)
+    species = pd.DataFrame({'Species information': [None]*numSpecies,
+                            'ID': list(mymodel.speciesIDs), 'name': list(mymodel.speciesNames)})
+    species[['Yinit', 'Ymax', 'tau']] = np.array(mymodel.speciesParams, dtype=float)
+    reactions = pd.DataFrame({'Reaction Information': [None]*numReactions,
+                              'ID': list(mymodel.reactionIDs), 'Rule': list(mymodel.reactionRules)})
+    reactions[['Weight', 'n', 'EC50']] = np.array(mymodel.reactionParams, dtype=float)
+    with pd.ExcelWriter(filename) as writer:
+        for sheet, df in (('species', species), ('reactions', reactions)):
+            header = pd.DataFrame([['module'] + list(df.columns[1:])], columns=df.columns)
+            pd.concat([header, df]).to_excel(writer, sheet_name=sheet, index=False)
+        for row in writer.sheets['reactions'].iter_rows(min_col=3, max_col=3):
+            for cell in row:
+                if cell.data_type == 'f':   # openpyxl stores '=> A' as a formula, keep it as text
+                    cell.data_type = 's'
@@ -0,0 +1,83 @@
+# sensitivity.py
+# Knockdown sensitivity analysis: knocks down each species in turn and records how every
+# species responds, giving a (knocked-down species x species) sensitivity matrix.
+#
+# knockdown modes:
+#   'ymax'   scales ymax of the knocked-down species by (1 - knockdown), 1 = complete knockout
+#   'clamp'  holds the knocked-down species at clampValue for the whole simulation
+# Each simulation runs from y0 to tmax, or stops early at steady state (steadyState=True, see
+# simulation.runToSteadyState), where the final state is polished by a Newton step.
+#
+# The knockdowns are independent, so they run on a process pool (workerPool.poolMap). The compiled
+# model and parameters are sent to each worker once; tasks only carry a species number, and results
+# stream back as they finish (iterKnockdowns).
+
+import numpy as np
+import modelRegistry, simulation, workerPool
+
+KNOCKDOWN_MODES = ('ymax', 'clamp')
+CONTROL = -1    # species number used for the unperturbed control simulation
+
+def runKnockdown(state, speciesNum):
+    # simulates one knockdown (state: compiled model, parameters, options), returns (speciesNum, final state)
+    compiledModel, params, options = state
+    return speciesNum, knockdownSimulation(compiledModel, params, speciesNum, **options)
+
+def knockdownSimulation(compiledModel, params, speciesNum, knockdown=1.0, mode='ymax', clampValue=0.0,
+                        tmax=10, steadyState=False, solver='auto'):
+    # final state after knocking down speciesNum (CONTROL for no knockdown); params = full parameter vector
+    y0, ymax, tau, w, n, EC50 = (p.copy() for p in simulation.splitParams(params, compiledModel.numSpecies, compiledModel.numReactions))
+    ODEfunc = compiledModel.ODEfunc
+    if speciesNum != CONTROL:
+        if mode == 'ymax':
+            ymax[speciesNum] *= 1 - knockdown
+        elif mode == 'clamp':
+            y0[speciesNum] = clampValue
+            def ODEfunc(t, y, *args):
+                dydt = compiledModel.ODEfunc(t, y, *args)
+                dydt[speciesNum] = 0
+                return dydt
+        else:
+            raise ValueError(f"Unknown knockdown mode: {mode}, expected one of {KNOCKDOWN_MODES}")
+    if steadyState:     # stops at steady state (or at once if y0 already is one), then Newton polish
+        solution = simulation.runToSteadyState(ODEfunc, [0, tmax], y0, (ymax, tau, w, n, EC50), solver, compiledModel)
+    else:
+        solution = simulation.runSimulation(ODEfunc, [0, tmax], y0, (ymax, tau, w, n, EC50), solver, compiledModel)
+    return solution.y[:, -1]
+
+def iterKnockdowns(model, species=None, params=None, maxWorkers=None, **options):
+    # yields (speciesNum, final state) as each simulation finishes, starting order not guaranteed
+    # species: species IDs or numbers to knock down (default: all); CONTROL is always included
+    # params: full parameter vector (simulation.modelParams(model) by default)
+    # options: knockdown, mode, clampValue, tmax, steadyState, solver (see knockdownSimulation)
+    # maxWorkers=1 runs in this process without a pool
+    compiledModel = modelRegistry.getCompiledModel(model)
+    params = simulation.modelParams(model) if params is None else np.asarray(params, dtype=float)
+    tasks = [CONTROL] + speciesNumbers(compiledModel, species)
+    if options.get('mode', 'ymax') not in KNOCKDOWN_MODES:
+        raise ValueError(f"Unknown knockdown mode: {options['mode']}, expected one of {KNOCKDOWN_MODES}")
+    yield from workerPool.poolMap(runKnockdown, tasks, (compiledModel, params, options), maxWorkers)
+
+def sensitivityMatrix(model, species=None, relative=False, **options):
+    # runs all knockdowns and returns (yControl, knockedDown, sens)
+    # sens[k, j] = change in species j when knockedDown[k] is knocked down (final - control),
+    # divided by the control value if relative=True
+    # options are passed to iterKnockdowns (params, maxWorkers, knockdown, mode, tmax, steadyState...)
+    results = dict(iterKnockdowns(model, species, **options))
+    yControl = results.pop(CONTROL)
+    knockedDown = sorted(results)
+    sens = np.array([results[k] for k in knockedDown]).reshape(len(knockedDown), len(yControl)) - yControl
+    if relative:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sens = np.where(yControl != 0, sens/yControl, 0.0)
+    return yControl, knockedDown, sens
+
+def speciesNumbers(compiledModel, species):
+    # converts species IDs or numbers into a list of species numbers
+    if species is None:
+        return list(range(compiledModel.numSpecies))
+    index = {ID: i for i, ID in enumerate(compiledModel.speciesIDs)}
+    try:
+        return [s if isinstance(s, (int, np.integer)) else index[s] for s in species]
+    except KeyError as e:
+        raise ValueError(f"Unknown species {e}") from None
@@ -0,0 +1,257 @@
+# simulation.py
+# Runs Netflux simulations with solve_ivp, choosing the integration method.
+# Used by webapp.simulate; modelName_run.py gets the same method choice from generateRunFile.
+#
+# solver options:
+#   'auto'  picks BDF when the tau values span STIFF_TAU_RATIO or more (stiff), otherwise RK45
+#   'RK45'  explicit Runge-Kutta (solve_ivp default), no Jacobian needed
+#   'LSODA', 'BDF', 'Radau'  implicit/switching methods, given the analytic Jacobian from
+#           model2NumpyODE when available, otherwise its sparsity pattern for finite differences
+#
+# Parameter vectors: a full parameter set of a model is laid out as
+#   [y0 (species), ymax (species), tau (species), w (reactions), n (reactions), EC50 (reactions)]
+# with labels like 'tau[AngII]' or 'w[i1]' from paramLabels(model).
+#
+# runToSteadyState stops integrating once max|dydt| < tol (terminal event), then refines the final state
+# with a Newton solve of dydt = 0 and reports diagnostics in solution.steadyState.
+#
+# simulateEnsemble integrates K parameter sets together as one stacked state vector
+# (species x K), so the Python overhead per step is paid once instead of K times.
+#
+# Output controls, shared by the webapp, the generated _run.py and the batch APIs:
+#   outputGrid(tspan, t_eval, numPoints)  t_eval for solve_ivp (interpolated from the solver's dense
+#                                         output), so the result size follows the request, not the steps
+#   outputSpecies(speciesIDs, species)    species numbers to keep (all by default)
+#   OUTPUT_DTYPES                         'float64', or 'float32' to halve stored results
+#
+# scipy.integrate and scipy.optimize are imported by the functions that use them, so importing this
+# module (parameter layout, solver choice) stays fast for the webapp and command line tools.
+
+import numpy as np
+import scipy.sparse as sp
+import modelRegistry
+
+SOLVERS = ('auto', 'RK45', 'LSODA', 'BDF', 'Radau')
+STIFF_TAU_RATIO = 100   # max(tau)/min(tau) above which auto mode treats the model as stiff
+STIFF_SOLVER = 'BDF'    # method used by auto mode for stiff models
+STEADY_STATE_TOL = 1e-6 # max |dydt| below which a simulation is considered at steady state
+NEWTON_MAX_STEP = 0.05 # largest change of any species accepted from the Newton polish of a steady state
+OUTPUT_DTYPES = ('float64', 'float32')
+SPECIES_PARAMS = ('y0', 'ymax', 'tau')
+REACTION_PARAMS = ('w', 'n', 'EC50')
+
+def isStiff(tau):
+    # stiffness from the spread of time constants
+    tau = np.abs(np.asarray(tau, dtype=float))
+    tau = tau[tau > 0]
+    if tau.size == 0:
+        return False
+    return tau.max()/tau.min() >= STIFF_TAU_RATIO
+
+def selectSolver(tau, solver='auto'):
+    # returns the solve_ivp method name for solver
+    if solver not in SOLVERS:
+        raise ValueError(f"Unknown solver: {solver}, expected one of {SOLVERS}")
+    if solver == 'auto':
+        return STIFF_SOLVER if isStiff(tau) else 'RK45'
+    return solver
+
+def jacOptions(method, ODEfunc, compiledModel=None):
+    # solve_ivp keyword arguments giving the Jacobian (or its sparsity) to implicit methods
+    if method == 'RK45' or compiledModel is None:
+        return {}
+    ODEfunc = getattr(ODEfunc, '__wrapped__', ODEfunc)  # e.g. jobQueue.Job.track wrappers
+    analytic = getattr(ODEfunc, '__self__', None) is compiledModel  # ODEfunc is compiledModel.ODEfunc
+    if method == 'LSODA':   # LSODA only accepts dense Jacobians
+        if analytic:
+            return {'jac': lambda t, y, *args: compiledModel.jacobian(t, y, *args).toarray()}
+        return {}
+    if analytic:
+        return {'jac': compiledModel.jacobian}
+    return {'jac_sparsity': compiledModel.jacSparsity()}
+
+def runSimulation(ODEfunc, tspan, y0, params, solver='auto', compiledModel=None, rtol=1e-8, **options):
+    # integrates ODEfunc over tspan from y0; params = (ymax, tau, w, n, EC50)
+    # compiledModel (model2NumpyODE.CompiledModel) supplies jac/jac_sparsity for implicit methods
+    # extra options (t_eval, events, atol...) are passed on to solve_ivp
+    method = selectSolver(params[1], solver)
+    options.update(jacOptions(method, ODEfunc, compiledModel))
+    from scipy.integrate import solve_ivp
+    solution = solve_ivp(ODEfunc, tspan, y0, method=method, rtol=rtol, args=tuple(params), **options)
+    if not solution.success:
+        raise RuntimeError(f"solve_ivp ({method}) failed: {solution.message}")
+    solution.method = method
+    return solution
+
+def steadyStateEvent(ODEfunc, tol=STEADY_STATE_TOL):
+    # terminal solve_ivp event that fires once max|dydt| drops below tol
+    def event(t, y, *args):
+        return np.max(np.abs(ODEfunc(t, y, *args))) - tol
+    event.terminal = True
+    event.direction = -1
+    return event
+
+def runToSteadyState(ODEfunc, tspan, y0, params, solver='auto', compiledModel=None, tol=STEADY_STATE_TOL,
+                     polish=True, rtol=1e-8, **options):
+    # integrates until max|dydt| < tol (or tspan[1]), then polishes the final state with a Newton step
+    # (scipy.optimize.root with the analytic Jacobian of compiledModel, when given)
+    # returns the solve_ivp solution; if polishing succeeds its final point is replaced by the polished
+    # steady state, and solution.steadyState holds the convergence diagnostics
+    events = options.pop('events', [])
+    events = [events] if callable(events) else list(events)
+    if np.max(np.abs(np.asarray(ODEfunc(tspan[0], np.asarray(y0, dtype=float), *params), dtype=float))) <= tol:
+        tspan = (tspan[0], tspan[0])    # already at steady state, nothing to integrate
+        options.pop('t_eval', None)     # the solution is the single point t0
+    solution = runSimulation(ODEfunc, tspan, y0, params, solver, compiledModel, rtol=rtol,
+                             events=[steadyStateEvent(ODEfunc, tol)] + events, **options)
+    if options.get('t_eval') is not None and len(solution.t_events[0]) and solution.t[-1] < solution.t_events[0][0]:
+        # with an output grid the last point is before the event; end at the steady state itself
+        solution.t = np.append(solution.t, solution.t_events[0][0])
+        solution.y = np.column_stack([solution.y, solution.y_events[0][0]])
+    yEnd = np.array(solution.y[:, -1], dtype=float)
+    maxRate = float(np.max(np.abs(ODEfunc(solution.t[-1], yEnd, *params))))
+    tEvent = solution.t_events[0]
+    diagnostics = {'reached': len(tEvent) > 0 or maxRate <= tol, 'tEnd': float(solution.t[-1]),
+                   'tEvent': float(tEvent[0]) if len(tEvent) else None, 'maxRate': maxRate,
+                   'polished': False, 'maxRatePolished': None, 'newtonStep': None, 'newtonEvaluations': 0,
+                   'tol': tol, 'method': solution.method}
+    if polish and diagnostics['reached']:
+        diagnostics.update(newtonPolish(ODEfunc, yEnd, params, compiledModel))
+        if diagnostics['polished']:
+            solution.y = np.array(solution.y, dtype=float)
+            solution.y[:, -1] = diagnostics.pop('y')
+        diagnostics.pop('y', None)
+    solution.steadyState = diagnostics
+    return solution
+
+def newtonPolish(ODEfunc, y, params, compiledModel=None):
+    # solves dydt = 0 starting from y, accepting the root only if it improves max|dydt|
+    # and stays within NEWTON_MAX_STEP of y (so it cannot jump to a different steady state)
+    def rates(x):
+        return np.asarray(ODEfunc(0, x, *params), dtype=float)
+    jac = None
+    if getattr(getattr(ODEfunc, '__wrapped__', ODEfunc), '__self__', None) is compiledModel is not None:
+        jac = lambda x: compiledModel.jacobian(0, x, *params).toarray()   # not for modified ODEfuncs (clamps)
+    before = float(np.max(np.abs(rates(y))))
+    from scipy import optimize
+    try:
+        result = optimize.root(rates, y, jac=jac, method='hybr')
+    except (ValueError, np.linalg.LinAlgError, FloatingPointError) as e:  # anything else (e.g. a cancelled job) propagates
+        print(f"simulation: Newton polish failed: {e}")
+        return {'polished': False}
+    step = float(np.max(np.abs(result.x - y)))
+    after = float(np.max(np.abs(rates(result.x))))
+    accepted = bool(result.success) and after <= before and step <= NEWTON_MAX_STEP
+    return {'polished': accepted, 'maxRatePolished': after, 'newtonStep': step,
+            'newtonEvaluations': int(result.nfev), 'y': result.x if accepted else None}
+
+def outputGrid(tspan, t_eval=None, numPoints=None):
+    # output time points within tspan: t_eval, or numPoints evenly spaced; None keeps every solver step
+    if t_eval is not None:
+        t_eval = np.asarray(t_eval, dtype=float)
+        if t_eval.ndim != 1 or np.any(np.diff(t_eval) < 0) or (len(t_eval) and (t_eval[0] < tspan[0] or t_eval[-1] > tspan[1])):
+            raise ValueError(f"t_eval must be increasing and within tspan [{tspan[0]:g}, {tspan[1]:g}]")
+        return t_eval
+    if numPoints is not None:
+        if int(numPoints) < 2:
+            raise ValueError(f"numPoints must be at least 2, got {numPoints}")
+        return np.linspace(tspan[0], tspan[1], int(numPoints))
+    return None
+
+def outputSpecies(speciesIDs, species=None):
+    # species numbers of the species IDs to keep (all species by default)
+    speciesIDs = list(speciesIDs)
+    if species is None:
+        return list(range(len(speciesIDs)))
+    index = {ID: i for i, ID in enumerate(speciesIDs)}
+    unknown = [ID for ID in species if ID not in index]
+    if unknown:
+        raise ValueError(f"Unknown species: {', '.join(map(str, unknown))}")
+    return [index[ID] for ID in species]
+
+def checkDtype(dtype):
+    # output dtype name, one of OUTPUT_DTYPES
+    dtype = np.dtype(dtype).name
+    if dtype not in OUTPUT_DTYPES:
+        raise ValueError(f"Unknown output dtype: {dtype}, expected one of {OUTPUT_DTYPES}")
+    return dtype
+
+def paramLabels(model):
+    # labels of the full parameter vector, e.g. ['y0[A]', ..., 'w[r1]', ...]
+    speciesIDs, reactionIDs = list(model.speciesIDs), list(model.reactionIDs)
+    labels = [f"{name}[{ID}]" for name in SPECIES_PARAMS for ID in speciesIDs]
+    labels += [f"{name}[{ID}]" for name in REACTION_PARAMS for ID in reactionIDs]
+    return labels
+
+def modelParams(model):
+    # full parameter vector of a model, in the paramLabels order
+    speciesParams = np.array(model.speciesParams, dtype=float)
+    reactionParams = np.array(model.reactionParams, dtype=float)
+    return np.concatenate([speciesParams.T.ravel(), reactionParams.T.ravel()])
+
+def splitParams(params, numSpecies, numReactions):
+    # splits full parameter vectors (P,) or (P, K) into y0, ymax, tau, w, n, EC50
+    S, R = numSpecies, numReactions
+    bounds = np.cumsum([0, S, S, S, R, R, R])
+    return tuple(params[bounds[i]:bounds[i+1]] for i in range(6))
+
+def paramColumns(model, columns):
+    # converts parameter labels (or indices) into positions in the full parameter vector
+    labels = paramLabels(model)
+    index = {label: i for i, label in enumerate(labels)}
+    try:
+        return np.array([c if isinstance(c, (int, np.integer)) else index[c] for c in columns], dtype=int)
+    except KeyError as e:
+        raise ValueError(f"Unknown parameter {e}, expected labels like {labels[0]} or {labels[-1]}") from None
+
+def simulateEnsemble(model, paramSets, tspan, columns=None, t_eval=None, numPoints=101,
+                     solver='auto', rtol=1e-8, atol=1e-6, batchSize=None, compiledModel=None,
+                     species=None, dtype='float64'):
+    # simulates the model under K parameter sets in one integration per batch
+    # paramSets: (K x P) full parameter vectors, or (K x len(columns)) values for the given
+    #            columns (labels such as 'w[r1]' or indices), other parameters from the model
+    # returns t (T,) and y (K x species x T) on the shared grid t_eval (numPoints over tspan by default)
+    # species (IDs) and dtype ('float32') limit what is kept in y
+    # batchSize limits how many copies are stacked in one integration (default: all K)
+    compiledModel = compiledModel or modelRegistry.getCompiledModel(model)
+    S, R = compiledModel.numSpecies, compiledModel.numReactions
+    paramSets = np.atleast_2d(np.asarray(paramSets, dtype=float))
+    K = paramSets.shape[0]
+    if columns is not None:
+        full = np.tile(modelParams(model), (K, 1))
+        full[:, paramColumns(model, columns)] = paramSets
+        paramSets = full
+    if paramSets.shape[1] != 3*S + 3*R:
+        raise ValueError(f"paramSets has {paramSets.shape[1]} columns, expected {3*S + 3*R} or columns=...")
+    t_eval = outputGrid(tspan, t_eval, numPoints)
+    keep = outputSpecies(compiledModel.speciesIDs, species)
+
+    y = np.empty((K, len(keep), len(t_eval)), dtype=checkDtype(dtype))
+    batchSize = batchSize or K
+    for start in range(0, K, batchSize):
+        batch = paramSets[start:start + batchSize].T    # (P x batch)
+        y[start:start + batchSize] = integrateBatch(compiledModel, batch, tspan, t_eval, solver, rtol, atol)[:, keep]
+    return t_eval, y
+
+def integrateBatch(compiledModel, params, tspan, t_eval, solver, rtol, atol):
+    # integrates one batch of parameter sets (P x B) as a stacked (species x B) state vector
+    # solve_ivp controls the RMS error over the whole stacked vector, so the tolerances are
+    # divided by sqrt(B) to keep each copy within rtol/atol, as when simulated alone
+    S, R = compiledModel.numSpecies, compiledModel.numReactions
+    B = params.shape[1]
+    y0, ymax, tau, w, n, EC50 = splitParams(params, S, R)
+
+    def stackedODEfunc(t, y):
+        return compiledModel.ODEfunc(t, y.reshape(S, B), ymax, tau, w, n, EC50).ravel()
+
+    method = selectSolver(tau, solver)
+    options = {}
+    if method in ('BDF', 'Radau'):  # copies are independent: block pattern, state index = species*B + copy
+        options['jac_sparsity'] = sp.kron(compiledModel.jacSparsity(), sp.identity(B), format='csr')
+    scale = np.sqrt(B)
+    from scipy.integrate import solve_ivp
+    solution = solve_ivp(stackedODEfunc, tspan, y0.ravel(), method=method, rtol=rtol/scale, atol=atol/scale,
+                         t_eval=t_eval, **options)
+    if not solution.success:
+        raise RuntimeError(f"solve_ivp ({method}) failed: {solution.message}")
+    return solution.y.reshape(S, B, -1).transpose(1, 0, 2)
@@ -0,0 +1,6 @@
+# conftest.py
+# Makes the Netflux modules (flat, in the repository root) importable from the tests.
+
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,11 @@
+# test_import_budget.py
+# Cold-start budget of the core modules and the webapp (benchmark.IMPORT_BUDGETS, HEAVY_MODULES):
+# each import runs in a fresh interpreter, so pandas, matplotlib, scipy.integrate/optimize or openpyxl
+# creeping back into an import path fails here instead of only showing up in benchmark --check-imports.
+
+import benchmark
+
+def test_imports_within_budget():
+    times, loaded = benchmark.importTimes()
+    problems = benchmark.checkImports(times, loaded)
+    assert problems == []
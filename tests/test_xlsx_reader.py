@@ -0,0 +1,50 @@
+# test_xlsx_reader.py
+# xlsxReader must read the library spreadsheets exactly like pandas.read_excel did before it replaced it:
+# every sheet cell by cell, and the models built from them (IDs, names, parameters, interaction matrices).
+
+import glob, os
+import numpy as np
+import pytest
+import xls2model, xlsxReader
+
+pd = pytest.importorskip('pandas')
+
+MODELS_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'models')
+SPREADSHEETS = sorted(glob.glob(os.path.join(MODELS_FOLDER, '*.xlsx')))
+MODELS = [path for path in SPREADSHEETS if os.path.basename(path) != 'library.xlsx']
+
+def pandasSheet(filename, sheetName):
+    # rows of a sheet as read by pandas (the reader xls2model used before xlsxReader)
+    sheet = pd.read_excel(filename, sheet_name=sheetName, header=None, dtype=object)
+    return [[None if pd.isna(value) else value for value in row] for row in sheet.values.tolist()]
+
+def trimmed(rows):
+    # rows without trailing empty cells, for comparing tables of different widths
+    result = []
+    for row in rows:
+        row = list(row)
+        while row and row[-1] is None:
+            row.pop()
+        result.append(row)
+    return result
+
+@pytest.mark.parametrize('filename', SPREADSHEETS, ids=os.path.basename)
+def test_sheets_match_pandas(filename):
+    for sheetName in xlsxReader.sheetNames(filename):
+        assert trimmed(xlsxReader.readSheet(filename, sheetName)) == trimmed(pandasSheet(filename, sheetName)), sheetName
+
+@pytest.mark.parametrize('filename', MODELS, ids=os.path.basename)
+def test_models_match_pandas(filename, monkeypatch):
+    mymodel = xls2model.createModel(filename)
+    monkeypatch.setattr(xls2model, 'readSheet', pandasSheet)
+    expected = xls2model.createModel(filename)
+    for name in ('speciesIDs', 'speciesNames', 'reactionIDs', 'reactionRules'):
+        assert list(getattr(mymodel, name)) == list(getattr(expected, name)), name
+    for name in ('speciesParams', 'reactionParams'):
+        np.testing.assert_array_equal(getattr(mymodel, name), getattr(expected, name), err_msg=name)
+    for name in ('interactionMatrix', 'notMatrix'):
+        assert (getattr(mymodel, name) != getattr(expected, name)).nnz == 0, name
+
+def test_missing_sheet():
+    with pytest.raises(ValueError, match="Worksheet named 'nosuchsheet' not found"):
+        xlsxReader.readSheet(SPREADSHEETS[0], 'nosuchsheet')
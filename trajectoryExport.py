@@ -0,0 +1,143 @@
+# trajectoryExport.py
+# Streams a stored simulation (trajectoryStore) to the client in chunks, without building a
+# DataFrame or writing a file first. Used by webapp.downloadSimulation.
+#
+# formats:
+#   'csv'      t column, then one column per species (same layout as the old pandas export)
+#   'npz'      numpy archive with 't' (time,), 'y' (species x time, like solution.y) and 'species'
+#   'parquet'  t column plus one float64 column per species; needs pyarrow (optional dependency)
+# options:
+#   species    list of species IDs to export (default: all stored species)
+#   every      keep every n-th time point (the final time point is always kept)
+#
+# iterExport(...) yields bytes chunks of roughly CHUNK_ROWS time points each. Trajectories stored as
+# float32 (trajectoryStore.newHandle) are exported as float32, CSV values in their shortest float32 form.
+
+import io, zipfile
+import numpy as np
+import trajectoryStore
+
+EXPORT_FORMATS = ('csv', 'npz', 'parquet')
+MIMETYPES = {'csv': 'text/csv', 'npz': 'application/octet-stream', 'parquet': 'application/vnd.apache.parquet'}
+CHUNK_ROWS = 4096
+
+def speciesColumns(speciesIDs, species=None):
+    # positions of the requested species IDs (all species by default)
+    speciesIDs = list(speciesIDs)
+    if not species:
+        return np.arange(len(speciesIDs)), speciesIDs
+    index = {ID: i for i, ID in enumerate(speciesIDs)}
+    unknown = [ID for ID in species if ID not in index]
+    if unknown:
+        raise ValueError(f"Unknown species: {', '.join(map(str, unknown))}")
+    return np.array([index[ID] for ID in species], dtype=int), list(species)
+
+def decimatedRows(lengths, every=1):
+    # row indices kept in each segment when keeping every n-th point of the whole trajectory
+    if every < 1:
+        raise ValueError(f"every must be a positive integer, got {every}")
+    rows, offset = [], 0
+    for length in lengths:
+        rows.append(np.arange((-offset) % every, length, every))
+        offset += length
+    total = sum(lengths)
+    if total and (total - 1) % every:     # always keep the final point
+        rows[-1] = np.append(rows[-1], lengths[-1] - 1)
+    return rows
+
+def iterBlocks(root, handle, columns, every=1):
+    # yields (t, y) blocks of at most CHUNK_ROWS kept time points, y as (time x selected species)
+    parts = list(trajectoryStore.segments(root, handle))
+    for (t, y), rows in zip(parts, decimatedRows([len(t) for t, y in parts], every)):
+        for start in range(0, len(rows), CHUNK_ROWS):
+            block = rows[start:start + CHUNK_ROWS]
+            yield t[block], y[block][:, columns]
+
+def numRows(root, handle, every=1):
+    # number of exported time points
+    lengths = [len(t) for t, y in trajectoryStore.segments(root, handle)]
+    return sum(len(rows) for rows in decimatedRows(lengths, every))
+
+class ChunkWriter(io.RawIOBase):
+    # write-only, unseekable file object that collects written bytes until they are taken
+    def __init__(self):
+        self.chunks, self.position = [], 0
+    def writable(self):
+        return True
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        self.position += len(b)
+        return len(b)
+    def tell(self):
+        return self.position
+    def take(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+def iterCSV(root, handle, columns, names, every=1):
+    # CSV rows, floats written in shortest round-trip form like pandas.to_csv
+    yield (','.join(['t'] + [str(name) for name in names]) + '\n').encode()
+    for t, y in iterBlocks(root, handle, columns, every):
+        if y.dtype == np.float32:   # repr of the float64 value would print float32 rounding noise
+            rows = np.column_stack([np.asarray(t, dtype=float).astype(str), y.astype(str)])
+            yield ''.join(','.join(row) + '\n' for row in rows.tolist()).encode()
+            continue
+        rows = np.column_stack([t, y]).tolist()
+        yield ''.join(','.join(map(repr, row)) + '\n' for row in rows).encode()
+
+def iterNPZ(root, handle, columns, names, every=1):
+    # npz archive written on the fly: array headers carry the final shapes, data follows block by block
+    # y is stored in Fortran order as (species x time), so time-major blocks are appended directly
+    N, S = numRows(root, handle, every), len(columns)
+    dtypes = {'t': np.dtype(float), 'y': np.dtype(handle.get('dtype', 'float64'))}
+    out = ChunkWriter()
+    with zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_STORED) as archive:
+        with archive.open('species.npy', 'w') as f:
+            np.lib.format.write_array(f, np.array([str(name) for name in names]))
+        for name, shape in (('t', (N,)), ('y', (S, N))):
+            with archive.open(name + '.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(dtypes[name]),
+                                                         'fortran_order': name == 'y', 'shape': shape})
+                for t, y in iterBlocks(root, handle, columns, every):
+                    f.write(np.ascontiguousarray(t if name == 't' else y, dtype=dtypes[name]).tobytes())
+                    yield out.take()
+    yield out.take()
+
+def requirePyarrow():
+    # imports pyarrow for parquet export, with a clear error when it is not installed
+    try:
+        import pyarrow, pyarrow.parquet
+    except ImportError:
+        raise ValueError("Parquet export requires pyarrow (pip install pyarrow); use csv or npz instead") from None
+    return pyarrow, pyarrow.parquet
+
+def iterParquet(root, handle, columns, names, every=1):
+    # parquet file with one row group per block
+    pa, pq = requirePyarrow()
+    dtype = np.dtype(handle.get('dtype', 'float64'))
+    schema = pa.schema([('t', pa.float64())] + [(str(name), pa.from_numpy_dtype(dtype)) for name in names])
+    out = ChunkWriter()
+    with pq.ParquetWriter(out, schema) as writer:
+        for t, y in iterBlocks(root, handle, columns, every):
+            arrays = [pa.array(np.asarray(t, dtype=float))] + [pa.array(np.asarray(y[:, i], dtype=dtype)) for i in range(y.shape[1])]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            yield out.take()
+    yield out.take()
+
+def iterExport(root, handle, speciesIDs, fmt='csv', species=None, every=1):
+    # checks the options, then returns the generator of bytes chunks for the chosen format
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}, expected one of {EXPORT_FORMATS}")
+    if trajectoryStore.isEmpty(handle):
+        raise ValueError("No simulation to export")
+    speciesIDs = list(speciesIDs)
+    stored = [speciesIDs[i] for i in trajectoryStore.storedSpecies(handle)]
+    missing = [ID for ID in species or [] if ID in speciesIDs and ID not in stored]
+    if missing:
+        raise ValueError(f"Species not saved in this simulation: {', '.join(map(str, missing))}")
+    columns, names = speciesColumns(stored, species)
+    decimatedRows([1], every)   # validates every before the response starts
+    if fmt == 'parquet':
+        requirePyarrow()
+    writers = {'csv': iterCSV, 'npz': iterNPZ, 'parquet': iterParquet}
+    return writers[fmt](root, handle, columns, names, every)
@@ -0,0 +1,142 @@
+# trajectoryStore.py
+# Per-session storage of simulation trajectories as .npy segments on disk, so that the
+# Flask session only holds a small handle instead of t and y as nested lists.
+#
+# A trajectory is a folder <root>/<id>/ with three files per simulation segment:
+#   seg00000_t.npy  (time points,)   seg00000_y.npy  (time points, stored species)
+#   seg00000_last.npy  final state of all species (float64), for continuing the simulation
+# Continuing a simulation appends a segment (cost proportional to the new segment only);
+# readers concatenate the memory-mapped segments once per request.
+#
+# The handle is a dict: {'id', 'segments', 'numSpecies', 'version', 'species', 'dtype'}. It is updated
+# by appendSegment and must be stored back into the session; 'version' changes with every
+# append so it can be used as a cache key for the trajectory contents.
+# 'species' (stored species numbers, None = all) and 'dtype' ('float64' or 'float32') are set by the
+# first segment, so a trajectory can keep only the species and precision the user asked for.
+#
+# Folders of expired sessions are never cleared by their session; prune(root, maxAge) deletes the
+# trajectories not written or loaded for maxAge seconds (webapp: the session lifetime).
+
+import os, re, shutil, time, uuid
+import numpy as np
+
+ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+DTYPES = ('float64', 'float32')
+
+def newHandle(species=None, dtype='float64'):
+    # handle of an empty trajectory storing the given species numbers (None = all) as dtype
+    if dtype not in DTYPES:
+        raise ValueError(f"Unknown trajectory dtype: {dtype}, expected one of {DTYPES}")
+    species = None if species is None else sorted({int(i) for i in species})
+    return {'id': uuid.uuid4().hex, 'segments': 0, 'numSpecies': None, 'version': 0, 'species': species, 'dtype': dtype}
+
+def trajectoryFolder(root, handle):
+    # folder holding the segments of a trajectory
+    if not ID_PATTERN.match(str(handle.get('id', ''))):
+        raise ValueError(f"Invalid trajectory id: {handle.get('id')}")
+    return os.path.join(root, handle['id'])
+
+def segmentPaths(root, handle, segment):
+    folder = trajectoryFolder(root, handle)
+    return os.path.join(folder, f"seg{segment:05d}_t.npy"), os.path.join(folder, f"seg{segment:05d}_y.npy")
+
+def lastStatePath(root, handle, segment):
+    return os.path.join(trajectoryFolder(root, handle), f"seg{segment:05d}_last.npy")
+
+def storedSpecies(handle):
+    # species numbers of the stored rows of y
+    if handle.get('species') is not None:
+        return list(handle['species'])
+    return list(range(handle['numSpecies'] or 0))
+
+def isEmpty(handle):
+    return handle is None or handle.get('segments', 0) == 0
+
+def appendSegment(root, handle, t, y):
+    # appends a simulation segment (t: (time,), y: (all species, time) as from solve_ivp), returns the new handle
+    # (an empty handle from newHandle(species, dtype) chooses what is stored)
+    handle = dict(handle) if handle else newHandle()
+    t, y = np.asarray(t, dtype=float), np.asarray(y, dtype=float)
+    if handle['numSpecies'] is not None and y.shape[0] != handle['numSpecies']:
+        raise ValueError(f"Segment has {y.shape[0]} species, trajectory has {handle['numSpecies']}")
+    os.makedirs(trajectoryFolder(root, handle), exist_ok=True)
+    tPath, yPath = segmentPaths(root, handle, handle['segments'])
+    stored = y if handle.get('species') is None else y[handle['species']]
+    np.save(tPath, t)
+    np.save(yPath, np.ascontiguousarray(stored.T, dtype=handle.get('dtype', 'float64')))
+    if len(t):
+        np.save(lastStatePath(root, handle, handle['segments']), y[:, -1])
+    handle['segments'] += 1
+    handle['numSpecies'] = y.shape[0]
+    handle['version'] += 1
+    return handle
+
+def segments(root, handle):
+    # yields (t, y) of each segment, memory-mapped, y as (time, species)
+    if isEmpty(handle):
+        return
+    touch(root, handle)
+    for segment in range(handle['segments']):
+        tPath, yPath = segmentPaths(root, handle, segment)
+        yield np.load(tPath, mmap_mode='r'), np.load(yPath, mmap_mode='r')
+
+def load(root, handle):
+    # whole trajectory: t (time,) and y (stored species, time), like solution.t and solution.y
+    if isEmpty(handle):
+        return np.empty(0), np.empty((0, 0))
+    parts = list(segments(root, handle))
+    t = np.concatenate([t for t, y in parts])
+    y = np.concatenate([y for t, y in parts], axis=0)
+    return t, y.T
+
+def lastState(root, handle):
+    # final time and state (all species, float64) of the trajectory, reading only the last segment
+    segment = handle['segments'] - 1
+    tPath, yPath = segmentPaths(root, handle, segment)
+    t = np.load(tPath, mmap_mode='r')
+    if os.path.exists(lastStatePath(root, handle, segment)):
+        return float(t[-1]), np.load(lastStatePath(root, handle, segment))
+    return float(t[-1]), np.array(np.load(yPath, mmap_mode='r')[-1], dtype=float)
+
+def clear(root, handle):
+    # deletes the stored segments of a trajectory
+    if handle and handle.get('segments'):
+        shutil.rmtree(trajectoryFolder(root, handle), ignore_errors=True)
+
+def discardSegments(root, handle, first):
+    # deletes the segments from number first on (a continuation nobody kept); first=0 deletes the trajectory
+    if not handle or not handle.get('segments'):
+        return
+    if first <= 0:
+        clear(root, handle)
+        return
+    for segment in range(first, handle['segments']):
+        for path in segmentPaths(root, handle, segment) + (lastStatePath(root, handle, segment),):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def touch(root, handle):
+    # marks a trajectory as in use, so prune keeps it while its session reads it
+    try:
+        os.utime(trajectoryFolder(root, handle))
+    except OSError:
+        pass
+
+def prune(root, maxAge):
+    # deletes trajectory folders whose mtime is more than maxAge seconds old, returns how many
+    cutoff = time.time() - maxAge
+    removed = 0
+    try:
+        entries = list(os.scandir(root))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            if ID_PATTERN.match(entry.name) and entry.is_dir() and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+        except OSError:
+            pass
+    return removed
@@ -10,14 +10,12 @@
 # To do:
 # Need to test with more models and conditions.
 
-from flask import Flask, render_template, request, jsonify, session, g, send_from_directory
+from flask import Flask, render_template, request, jsonify, session, g, send_from_directory, Response, stream_with_context, has_request_context
 from flask_session import Session # server-side sessions
+from werkzeug.utils import secure_filename
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-from scipy.integrate import solve_ivp
-import io, os, base64
-import xls2model, model2PythonODE, model2xgmml
+import os, time
+import model2PythonODE, model2xgmml, modelCache, modelRegistry, simulation, trajectoryStore, trajectoryExport, plotRenderer, jobQueue, instrumentation, protocols, modelEdit, modelLibrary
 
 app = Flask(__name__)
 app.secret_key = 'NetfluxNetfluxNetflux'       # for session variables
@@ -25,8 +23,101 @@ app.config['SESSION_TYPE'] = 'filesystem'   # server-side sessions
 app.config['SESSION_FILE_DIR'] = './flask_sessions'
 app.config['UPLOAD_FOLDER'] = './uploads'
 app.config['MODELS_FOLDER'] = './models'
+app.config['TRAJECTORY_FOLDER'] = './flask_sessions/trajectories' # simulation results, see trajectoryStore.py
+app.config['TRAJECTORY_PRUNE_INTERVAL'] = 3600  # seconds between sweeps for trajectories of expired sessions
+app.config['THUMBNAIL_FOLDER'] = './flask_sessions/thumbnails'     # resized library images, see modelLibrary.py
+app.config['LIBRARY_MAX_AGE'] = 3600        # seconds browsers may reuse library images without revalidating
+app.config['ODE_ENGINE'] = 'numpy'          # 'numpy' (model2NumpyODE) or 'python' (generated ODEfuncText)
+app.config['SOLVER'] = 'auto'               # see simulation.SOLVERS; auto picks BDF for stiff models
+app.config['METRICS'] = True                # stage timings, solver stats and cache counters (instrumentation.py)
+app.config['METRICS_PUBLIC'] = False        # /metrics only answers local requests unless True
+app.config['PROFILING'] = False             # allow ?profile=1 / X-Netflux-Profile: 1 to cProfile one request
+
+class MeasuredSerializer:
+    # wraps the serializer the session backend already uses and records the size of every session it saves,
+    # so netflux_session_bytes costs no extra pickling (dump: file backends via cachelib, encode: the others)
+    def __init__(self, serializer):
+        self.serializer = serializer
+
+    def __getattr__(self, name):
+        return getattr(self.serializer, name)
+
+    def dump(self, value, f, *args, **kwargs):
+        start = f.tell()
+        self.serializer.dump(value, f, *args, **kwargs)
+        if isinstance(value, dict):     # cachelib also dumps its file count through here
+            observeSessionBytes(f.tell() - start)
+
+    def encode(self, session):
+        data = self.serializer.encode(session)
+        observeSessionBytes(len(data))
+        return data
+
+def observeSessionBytes(size):
+    # called while the session is saved, after after_request, still inside the request context
+    if app.config['METRICS'] and has_request_context():
+        instrumentation.observe('netflux_session_bytes', size, endpoint=request.endpoint or 'unknown')
 
 Session(app)                                # server-side sessions
+sessionCache = getattr(app.session_interface, 'cache', None)
+if hasattr(getattr(sessionCache, 'serializer', None), 'dump'):   # filesystem sessions: pickled straight to the file
+    sessionCache.serializer = MeasuredSerializer(sessionCache.serializer)   # instance attribute, the default is shared
+else:
+    app.session_interface.serializer = MeasuredSerializer(app.session_interface.serializer)
+lastTrajectoryPrune = [0.0]
+
+def pruneTrajectories():
+    # deletes trajectories of expired sessions (older than the session lifetime), at most once per interval
+    now = time.time()
+    if now - lastTrajectoryPrune[0] < app.config['TRAJECTORY_PRUNE_INTERVAL']:
+        return
+    lastTrajectoryPrune[0] = now
+    removed = trajectoryStore.prune(app.config['TRAJECTORY_FOLDER'], app.permanent_session_lifetime.total_seconds())
+    if removed:
+        print(f"DEBUG/pruneTrajectories: removed {removed} expired trajectories")
+
+pruneTrajectories()
+modelCache.warm(app.config['MODELS_FOLDER'])  # preload library models into the parsed-model cache
+modelLibrary.entries(app.config['MODELS_FOLDER'])  # library index (descriptions, images, model sizes)
+instrumentation.registerCache('modelCache', modelCache.stats)
+instrumentation.registerCache('modelRegistry', modelRegistry.stats)
+instrumentation.registerCache('plotRenderer', plotRenderer.stats)
+instrumentation.registerCache('modelLibrary', modelLibrary.stats)
+
+def requested(option):
+    # True if the request opts in with ?option=1 or an X-Netflux-<Option>: 1 header
+    value = request.args.get(option) or request.headers.get(f'X-Netflux-{option.capitalize()}')
+    return value not in (None, '', '0', 'false')
+
+@app.before_request
+def startInstrumentation():
+    # per-request timings (see instrumentation.py) and cProfile when requested
+    if app.config['METRICS']:
+        g.requestStart = time.perf_counter()
+        instrumentation.startRequest()
+    if app.config['PROFILING'] and requested('profile'):
+        g.profiler = instrumentation.startProfiler()
+
+@app.after_request
+def endInstrumentation(response):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        path, summary = instrumentation.saveProfile(profiler, request.endpoint or 'request')
+        print(f"DEBUG/profile: {request.path} profile written to {path}\n{summary}")
+        response.headers['X-Netflux-Profile'] = path
+    if app.config['METRICS'] and 'requestStart' in g:
+        timings = instrumentation.endRequest()
+        elapsed = time.perf_counter() - g.requestStart
+        instrumentation.observe('netflux_request_seconds', elapsed, endpoint=request.endpoint or 'unknown')
+        if requested('timing'):
+            response.headers['Server-Timing'] = instrumentation.serverTiming(timings + [('total', elapsed)])
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():  # Prometheus text format, local requests only unless METRICS_PUBLIC
+    if not app.config['METRICS_PUBLIC'] and request.remote_addr not in ('127.0.0.1', '::1'):
+        return jsonify({'status': 'Status: Error: metrics are only available locally'}), 403
+    return Response(instrumentation.prometheusText(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/')
 def index():
@@ -38,34 +129,40 @@ def openmodel():
     try:
         if request.method == 'POST':
             if 'filename' in request.form:  # Check if default_filename is in form data
-                filename = request.form['filename']
+                filename = os.path.basename(request.form['filename']) # library models only
                 #print(f"DEBUG:openmodel filename:{filename}")
                 filepath = os.path.join(app.config['MODELS_FOLDER'], filename)
+                diskCache = True # trusted folder, parsed model is cached next to the xlsx
                 #print(f"DEBUG:openmodel filepath:{filepath}")
             elif 'file' in request.files:  # Check if file is uploaded via file dialog
                 file = request.files['file']
                 if file.filename == '':
                     return jsonify({"status": "Error: No file selected"}), 400
-                filename = file.filename
+                filename = secure_filename(file.filename)
                 filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
                 file.save(filepath)
+                diskCache = False # uploads are only cached in memory, by content hash
                 #print(f"{filename} sent to uploads folder")
             else:
                 return jsonify({"status": "Error: No file uploaded"}), 400
     
         # Generate model and parameters
         #print(f"DEBUG/openmodel: filepath: {filepath}")
-        mymodel = xls2model.createModel(filepath)
+        with instrumentation.stage('loadModel'):
+            mymodel = modelCache.loadModel(filepath, diskCache=diskCache)
         #print(f"DEBUG/openmodel: mymodel: {mymodel}")
         modelName = mymodel.modelName
         #print(f"DEBUG/openmodel modelName:{modelName}")
-        ODEfuncText = model2PythonODE.generateODEfile(mymodel)
+        with instrumentation.stage('generateODEfile'):
+            ODEfuncText = model2PythonODE.generateODEfile(mymodel)
         #print(f"DEBUG/openmodel: ODEfuncText: {ODEfuncText}")
-        speciesIDs = mymodel.speciesIDs.tolist()  
-        reactionRules = mymodel.reactionRules.tolist()
+        speciesIDs = list(mymodel.speciesIDs)
+        reactionRules = list(mymodel.reactionRules)
         #print(f"DEBUG/openmodel: speciesParams:{mymodel.speciesParams}")
         #print(f"DEBUG/openmodel: reactionParams: {mymodel.reactionParams}")
                        
+        discardJob(session.get('job'))
+        trajectoryStore.clear(app.config['TRAJECTORY_FOLDER'], session.get('trajectory'))
         session.clear()
         session['NetfluxModel'] = mymodel
         session['reactionParams'] = mymodel.reactionParams
@@ -91,7 +188,9 @@ def downloadmodel():
         # Export the ODE, params, and run files to the upload folder
         upload_folder = app.config['UPLOAD_FOLDER']
         #print(f"DEBUG/downloadmodel: exporting model to export_path: {upload_folder}")
-        model2PythonODE.writeModel(mymodel,export_path=upload_folder)    
+        # the output settings of the last simulation (numPoints, species, dtype) are written into _run.py
+        with instrumentation.stage('writeModel'):
+            model2PythonODE.writeModel(mymodel,export_path=upload_folder,**session.get('outputOptions', {}))
         modelName = mymodel.modelName
         print(f"DEBUG/downloadmodel: modelName:{modelName}")
         filenames = [f"{modelName}_ODEs.py", f"{modelName}_run.py", f"{modelName}_params.py"]
@@ -100,50 +199,48 @@ def downloadmodel():
     except Exception as e:
         return jsonify({'status': f'Status: Error downloading model: py: {str(e)}'})
 
-@app.route('/downloadxgmml', methods=['POST'])
+@app.route('/downloadxgmml', methods=['GET'])
 def downloadxgmml():
+    # streams the XGMML as an attachment, written incrementally by model2xgmml.iter_xgmml
     try:
         print("starting downloadxgmml")
-        # Assuming you have the model stored in the session; DEBUG: add error handling
-        mymodel = session.get('NetfluxModel',[])
-        modelName = mymodel.modelName
-        upload_folder = app.config['UPLOAD_FOLDER']
-        model2xgmml.interaction_matrix_to_xgmml(mymodel, export_path=upload_folder)
-        #print(f"DEBUG/downloadxgmml: modelName:{modelName}")
-        filename = f"{modelName}.xgmml"
-        return jsonify({"status": f"Status: {modelName} XGMML downloading", "filename": filename})
+        mymodel = session.get('NetfluxModel')
+        if mymodel is None:
+            return jsonify({'status': 'Status: Error downloading XGMML: no model open'}), 400
+        filename = secure_filename(f"{mymodel.modelName}.xgmml")
+        #print(f"DEBUG/downloadxgmml: modelName:{mymodel.modelName}")
+        chunks = instrumentation.timedIterator(model2xgmml.iter_xgmml(mymodel), 'downloadxgmml')
+        return Response(stream_with_context(chunks), mimetype='application/xml',
+                        headers={'Content-Disposition': f'attachment; filename="{filename}"'})
         
     except Exception as e:
-        return jsonify({'status': f'Status: Error downloading XGMML: {str(e)}'})
+        return jsonify({'status': f'Status: Error downloading XGMML: {str(e)}'}), 500
 
-@app.route('/downloadSimulation', methods=['POST'])
+@app.route('/downloadSimulation', methods=['GET'])
 def downloadSimulation():
+    # streams the stored simulation as an attachment, see trajectoryExport.py
+    # query arguments: format=csv|npz|parquet, species=<ID> (repeatable, default all), every=<n> (keep every n-th point)
     try:
         print("starting downloadSimulation")
-        # Assuming you have the simulation stored in t and y; DEBUG: add error handling
-        mymodel = session.get('NetfluxModel',[])
-        modelName = mymodel.modelName
-        speciesIDs = mymodel.speciesIDs.tolist()
-        #print(f"DEBUG/downloadSimulation: speciesIDs:{speciesIDs}")
-        t = np.array(session.get('t', [])) # session variable
-        y = np.array(session.get('y', [])).T # transpose so it matches shape of t
-        
-        if t.size == 0 or y.size == 0:
-            raise ValueError("t or y arrays are empty")
-        #print(f"DEBUG/downloadSimulation: y: {y}")
-        #print(f"DEBUG/downloadSimulation: y.shape: {y.shape}")
-        
-        df = pd.DataFrame(t, columns=['t'])
-        for i, species in enumerate(speciesIDs):
-            df[species] = y[:, i]
-        #print(f"DEBUG/downloadSimulation: df: {df}")
-        filename = f"{modelName}_simulation.csv"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        df.to_csv(filepath, index=False)
-        return jsonify({"status": f"Status: {filename} exported to uploads folder", "filename": filename})
+        mymodel = session.get('NetfluxModel')
+        if mymodel is None:
+            return jsonify({'status': 'Status: Error downloading simulation: no model open'}), 400
+        fmt = request.args.get('format', 'csv')
+        species = request.args.getlist('species')
+        every = request.args.get('every', 1, type=int)
+        #print(f"DEBUG/downloadSimulation: format:{fmt} species:{species} every:{every}")
+        try:
+            chunks = trajectoryExport.iterExport(app.config['TRAJECTORY_FOLDER'], session.get('trajectory'),
+                                                 mymodel.speciesIDs, fmt, species, every)
+        except ValueError as e:
+            return jsonify({'status': f'Status: Error downloading simulation: {str(e)}'}), 400
+        filename = secure_filename(f"{mymodel.modelName}_simulation.{fmt}")
+        chunks = instrumentation.timedIterator(chunks, f'downloadSimulation_{fmt}')
+        return Response(stream_with_context(chunks), mimetype=trajectoryExport.MIMETYPES[fmt],
+                        headers={'Content-Disposition': f'attachment; filename="{filename}"'})
         
     except Exception as e:
-        return jsonify({'status': f'Status: Error downloading simulation: {str(e)}'})
+        return jsonify({'status': f'Status: Error downloading simulation: {str(e)}'}), 500
 
 @app.route('/uploads/<filename>')
 def download_file(filename):
@@ -151,9 +248,15 @@ def download_file(filename):
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
 
 @app.route('/models/<filename>')
-def serve_model(filename):
+def serve_model(filename):  # library files; images can be resized with ?width=400 and are cached by browsers
     #print(f"DEBUG/download_file: serving /models/{filename}")
-    return send_from_directory(app.config['MODELS_FOLDER'], filename)
+    if not filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.webp')):
+        return send_from_directory(app.config['MODELS_FOLDER'], filename)
+    width = request.args.get('width', type=int)
+    if width and width > 0 and os.path.isfile(os.path.join(app.config['MODELS_FOLDER'], os.path.basename(filename))):
+        path = modelLibrary.thumbnail(app.config['MODELS_FOLDER'], filename, width, app.config['THUMBNAIL_FOLDER'])
+        return send_from_directory(os.path.abspath(os.path.dirname(path)), os.path.basename(path), max_age=app.config['LIBRARY_MAX_AGE'])
+    return send_from_directory(app.config['MODELS_FOLDER'], filename, max_age=app.config['LIBRARY_MAX_AGE'])
 
 @app.route('/library')
 def library():
@@ -168,47 +271,174 @@ def about():
     return render_template('about.html')
 
 @app.route('/simulate', methods=['POST'])
-def simulate():     # runs when you hit Simulate button
+def simulate():     # runs when you hit Simulate button, queues the simulation as a background job
     print("DEBUG/simulate: starting simulate()")
     try:
         data = request.get_json()
         tmax = float(data['tmax'])
         tspan = [0, tmax]
         #print(f"DEBUG/simulate: session vars: {list(session.keys())}") # confirm NetfluxModel, ODEfuncText, loadParamsText getting passed  
+        job = jobQueue.get(session.get('job'))
+        if job is not None and job.state not in jobQueue.FINISHED:
+            return jsonify({'status': 'Status: Error: a simulation is already running', 'job': job.id}), 409
         ODEfuncText = session.get('ODEfuncText','ODEfuncText not found')
         speciesParams = np.array(session.get('speciesParams', []))
         reactionParams = np.array(session.get('reactionParams', []))
         y0, ymax, tau = speciesParams[:, 0], speciesParams[:, 1], speciesParams[:, 2]
         w, n, EC50 = reactionParams[:, 0], reactionParams[:, 1], reactionParams[:, 2]
+        engine = data.get('engine', app.config['ODE_ENGINE'])
+        if engine not in model2PythonODE.ODE_ENGINES:
+            raise ValueError(f"Unknown ODE engine: {engine}")
+        solver = data.get('solver', app.config['SOLVER'])
+        mode = data.get('mode', 'time') # 'time': integrate to tmax, 'steadystate': stop once max|dydt| < tol
+        if mode not in ('time', 'steadystate'):
+            raise ValueError(f"Unknown simulation mode: {mode}")
+        tol = float(data.get('tol', simulation.STEADY_STATE_TOL))
+        protocol = data.get('protocol') or []   # timed parameter/state changes, see protocols.py
+        if protocol and mode != 'time':
+            raise ValueError("A protocol cannot be combined with Stop at steady state")
+        # output controls (see simulation.outputGrid): numPoints or t_eval (times from the start of the run)
+        # instead of every solver step, dtype 'float32', and saveSpecies (IDs) to store only those species
+        numPoints = data.get('numPoints') or None
+        grid = simulation.outputGrid((0, tmax), data.get('t_eval'), numPoints)
+        dtype = simulation.checkDtype(data.get('dtype') or 'float64')
+        saveSpecies = data.get('saveSpecies') or None
+        savedSpecies = simulation.outputSpecies(session.get('speciesIDs', []), saveSpecies)
 
-        # load ODEfunc using Flask g variable
-        local_namespace = {}
-        global_namespace = {'np': np} 
-        exec(ODEfuncText, global_namespace, local_namespace)
-        global_namespace.update(local_namespace)
-        g.ODEfunc = local_namespace['ODEfunc']     
+        # load ODEfunc from modelRegistry (compiled once per model) using Flask g variable
+        # compiledModel gives the analytic Jacobian (numpy engine) or its sparsity (python engine)
+        with instrumentation.stage('compile'):
+            compiledModel = modelRegistry.getCompiledModel(session.get('NetfluxModel'))
+            if engine == 'numpy':
+                g.ODEfunc = compiledModel.ODEfunc
+            else:
+                g.ODEfunc = model2PythonODE.jobODEfunc(modelRegistry.getODEfuncs(ODEfuncText)[1])  # constants bound once per job
+        ODEfunc = g.ODEfunc
         #print(f"DEBUG/simulate: simulating {g.ODEfunc}")
 
         # Either continue or run new simulation
-        if 'y' in session: # continue simulation
-            told = np.array(session.get('t', [])) # DE-JSONIFY session variable
-            yold = np.array(session.get('y', []))
-            y0 = yold[:,-1]
-            tspan = tspan + told[-1] 
-            solution = solve_ivp(g.ODEfunc, tspan, y0, rtol=1e-8, args=(ymax, tau, w, n, EC50))        
-            t = np.hstack([told,solution.t])
-            y = np.hstack([yold,solution.y])
-        else:
-            solution = solve_ivp(g.ODEfunc, tspan, y0, rtol=1e-8, args=(ymax, tau, w, n, EC50))     
-            t = solution.t
-            y = solution.y
-        session['t'] = t.tolist() # make JSON compatible
-        session['y'] = y.tolist()
+        # results are appended as a segment to the trajectory store, the session only keeps its handle
+        pruneTrajectories()
+        trajectory = session.get('trajectory')
+        queuedStatus = 'Status: Simulation queued'
+        if not trajectoryStore.isEmpty(trajectory): # continue simulation from the last stored state
+            tlast, y0 = trajectoryStore.lastState(app.config['TRAJECTORY_FOLDER'], trajectory)
+            tspan = [tlast, tlast + tmax]
+            # the stored species and precision cannot change mid-trajectory; record what is actually used
+            storedIDs = None if trajectory.get('species') is None else [session['speciesIDs'][i] for i in trajectory['species']]
+            if dtype != trajectory.get('dtype', 'float64') or (None if saveSpecies is None else sorted(set(savedSpecies))) != trajectory.get('species'):
+                queuedStatus += ' (continuing with the stored species and precision; Reset Simulation to change them)'
+            saveSpecies, dtype = storedIDs, trajectory.get('dtype', 'float64')
+        else:   # a new trajectory keeps the requested species and precision (continuations reuse them)
+            trajectory = trajectoryStore.newHandle(None if saveSpecies is None else savedSpecies, dtype)
+        session['outputOptions'] = {'numPoints': numPoints, 'species': saveSpecies, 'dtype': dtype}
+        options = {} if grid is None else {'t_eval': grid + tspan[0]}
+        folder = app.config['TRAJECTORY_FOLDER']
+        profile = app.config['PROFILING'] and bool(data.get('profile'))
+        # protocol times are relative to the start of this run; one job runs the whole protocol
+        steps = protocols.compileProtocol(session.get('NetfluxModel'), protocol)
+        protocols.checkProtocol(steps, (0, tmax))
+        steps = [step._replace(t=step.t + tspan[0]) for step in steps]
+        params = np.concatenate([speciesParams.T.ravel(), reactionParams.T.ravel()]).astype(float)
+
+        def solve(job):
+            counter = instrumentation.stepCounter() # counts accepted steps for the solver statistics
+            start = time.perf_counter()
+            if steps:
+                solution = protocols.runProtocol(compiledModel, tspan, params, steps, y0, solver, ODEfunc=job.track(ODEfunc), events=[counter], **options)
+            elif mode == 'steadystate':
+                solution = simulation.runToSteadyState(job.track(ODEfunc), tspan, y0, (ymax, tau, w, n, EC50), solver, compiledModel, tol, events=[counter], **options)
+            else:
+                solution = simulation.runSimulation(job.track(ODEfunc), tspan, y0, (ymax, tau, w, n, EC50), solver, compiledModel, events=[counter], **options)
+            solveTime = time.perf_counter() - start
+            instrumentation.recordStage('solve', solveTime)
+            solverStats = instrumentation.solverStats(solution, counter)
+            instrumentation.recordSolver(solverStats)
+            with instrumentation.stage('store'):
+                handle = trajectoryStore.appendSegment(folder, trajectory, solution.t, solution.y)
+            return {'trajectory': handle, 'firstSegment': trajectory['segments'],
+                    'steadyState': getattr(solution, 'steadyState', None),
+                    'solverStats': solverStats, 'solveTime': solveTime}
+
+        def work(job):  # runs on a jobQueue worker thread, without access to the session
+            if not profile:
+                return solve(job)
+            result, path = instrumentation.profiled(lambda: solve(job), 'simulate')
+            result['profile'] = path
+            return result
+
+        job = jobQueue.submit(work, tspan, onDiscard=discardResult)
+        session['job'] = job.id
+        return jsonify({'status': queuedStatus, 'job': job.id})
+    except jobQueue.QueueFull as e:
+        return jsonify({'status': f'Status: Error: {str(e)}'}), 503
+    except Exception as e:
+        print(f"DEBUG: simulate Exception: {e}")
+        return jsonify({'status': f'Status: Error: {str(e)}'})
+
+def discardResult(job):
+    # deletes what an unfetched simulation job stored: its trajectory, or the segments it appended to one
+    trajectoryStore.discardSegments(app.config['TRAJECTORY_FOLDER'], job.result['trajectory'], job.result['firstSegment'])
+
+def discardJob(jobID):
+    # cancels a session's job, and deletes the trajectory it produced in case it was never fetched
+    job = jobQueue.cancel(jobID)
+    if job is not None and job.state == jobQueue.DONE:   # a running job is discarded by jobQueue if it finishes
+        job.discard()
+
+def sessionJob(jobID):
+    # the job with this ID if it belongs to the current session, otherwise None
+    return jobQueue.get(jobID) if jobID == session.get('job') else None
+
+@app.route('/job/<jobID>', methods=['GET'])
+def jobStatus(jobID):  # progress of a simulation job, polled by the page
+    job = sessionJob(jobID)
+    if job is None:
+        return jsonify({'status': 'Status: Error: unknown job'}), 404
+    info = job.info()
+    if job.state in (jobQueue.QUEUED, jobQueue.RUNNING):
+        info['status'] = f"Status: Simulating... t={job.tCurrent:.4g} of {job.tEnd:.4g} ({100*job.progress:.0f}%)"
+    elif job.state == jobQueue.FAILED:
+        info['status'] = f"Status: Error: {job.error}"
+    else:
+        info['status'] = f"Status: Simulation {job.state}"
+    return jsonify(info)
+
+@app.route('/job/<jobID>/cancel', methods=['POST'])
+def cancelJob(jobID):  # stops a running simulation job
+    job = sessionJob(jobID)
+    if job is None:
+        return jsonify({'status': 'Status: Error: unknown job'}), 404
+    jobQueue.cancel(jobID)
+    return jsonify({'status': 'Status: Cancelling simulation', 'job': jobID})
+
+@app.route('/job/<jobID>/result', methods=['POST'])
+def jobResult(jobID):  # stores a finished job's trajectory in the session and returns the plot
+    try:
+        job = sessionJob(jobID)
+        if job is None:
+            return jsonify({'status': 'Status: Error: unknown job'}), 404
+        if job.state != jobQueue.DONE:
+            return jsonify({'status': f'Status: Error: simulation {job.state}', 'state': job.state}), 409
+        job.claim()     # the trajectory now belongs to the session, jobQueue must not discard it
+        session['trajectory'] = job.result['trajectory']
         plot_url = create_plot()   
         print("DEBUG: finished simulate()") 
-        return jsonify({'status': 'Status: Simulation complete', 'plot': plot_url}) 
+        stats = {'solverStats': job.result['solverStats'], 'solveTime': job.result['solveTime']}
+        instrumentation.addTiming('solve', job.result['solveTime'])
+        if 'profile' in job.result:
+            stats['profile'] = job.result['profile']
+        steadyState = job.result['steadyState']
+        if steadyState is not None:
+            if steadyState['reached']:
+                maxRate = steadyState['maxRatePolished'] if steadyState['polished'] else steadyState['maxRate']
+                status = f"Status: Steady state reached at t={steadyState['tEnd']:.4g} (max|dydt|={maxRate:.2g})"
+            else:
+                status = f"Status: Steady state not reached by t={steadyState['tEnd']:.4g} (max|dydt|={steadyState['maxRate']:.2g})"
+            return jsonify({'status': status, 'plot': plot_url, 'steadyState': steadyState, **stats})
+        return jsonify({'status': 'Status: Simulation complete', 'plot': plot_url, **stats}) 
     except Exception as e:
-        print(f"DEBUG: simulate Exception: {e}")
+        print(f"DEBUG: jobResult Exception: {e}")
         return jsonify({'status': f'Status: Error: {str(e)}'})
     
 def create_plot():     # creates the plot
@@ -218,28 +448,30 @@ def create_plot():     # creates the plot
         #print(f"DEBUG/create_plot: session vars: {list(session.keys())}") 
         #print(f"DEBUG/create_plot: data: {data}") # BUG: currently only contains tmax
         selectedVariables = data['selectedVariables'] # selected variables from multi-select
-        t = np.array(session.get('t', [])) # session variable
-        y = np.array(session.get('y', []))
+        trajectory = session.get('trajectory')
+        if trajectoryStore.isEmpty(trajectory):
+            raise ValueError("No simulation to plot")
         mymodel = session.get('NetfluxModel',[])
-        plotVars = np.array([index for index, value in mymodel.speciesIDs.items() if value in selectedVariables]) - 1  # subtract bc dataseries starts at 1
+        selectedVariables = set(selectedVariables)
+        plotVars = [i for i, speciesID in enumerate(mymodel.speciesIDs) if speciesID in selectedVariables] # in model order
+        plotNames = [mymodel.speciesIDs[i] for i in plotVars]
+        stored = trajectoryStore.storedSpecies(trajectory)     # rows of the stored y (all species unless saveSpecies was used)
+        missing = [name for i, name in zip(plotVars, plotNames) if i not in stored]
+        if missing:
+            raise ValueError(f"Species not saved in this simulation: {', '.join(map(str, missing))}")
+        plotVars = [stored.index(i) for i in plotVars]
         #print(f"DEBUG/create_plot: plotting selected variabes {plotVars} ")
         
-        plt.figure()
-        plt.plot(t,y[plotVars,:].T)
-        plt.legend(selectedVariables)
-        plt.xlabel('Time')
-        plt.ylabel('Normalized activity')        
-        img = io.BytesIO()
-        plt.savefig(img, format='png')
-        #plt.show() # DEBUG
-        img.seek(0)
-        plot_url = base64.b64encode(img.getvalue()).decode('utf8')
+        # rendered by plotRenderer (Agg, downsampled), cached per trajectory version, species and size
+        load = lambda: trajectoryStore.load(app.config['TRAJECTORY_FOLDER'], trajectory)
+        with instrumentation.stage('plot'):
+            plot_url = plotRenderer.cachedPlot(trajectory, plotVars, plotNames, load, data.get('width'), data.get('height'))
         print("DEBUG: finished create_plot()")
         return plot_url
         
     except Exception as e:
-        print("DEBUG: error in create_plot")
-        return jsonify({'status': f'Status: Error in create_plot: {str(e)}'})
+        print(f"DEBUG: error in create_plot: {e}")
+        raise # simulate() and replot() report the error status
     
 @app.route('/replot', methods=['POST'])
 def replot():     # runs when you click Plot button
@@ -255,8 +487,8 @@ def replot():     # runs when you click Plot button
 def resetparams():  # runs when you click Reset Parameters
     #print("DEBUG: starting resetparams()")
     mymodel = session.get('NetfluxModel',[])
-    speciesIDs = mymodel.speciesIDs.tolist()
-    reactionRules = mymodel.reactionRules.tolist()
+    speciesIDs = list(mymodel.speciesIDs)
+    reactionRules = list(mymodel.reactionRules)
     speciesParams = np.array(mymodel.speciesParams) 
     reactionParams = np.array(mymodel.reactionParams) 
     #print(f"DEBUG/resetparams: reaectionParams:{reactionParams}")
@@ -275,8 +507,8 @@ def resetparams():  # runs when you click Reset Parameters
 @app.route('/resetsim', methods=['POST'])
 def resetsim():  # runs when you click Reset Simulation
     print("DEBUG: starting resetsim()")
-    session.pop('t', None)
-    session.pop('y', None)
+    discardJob(session.pop('job', None))
+    trajectoryStore.clear(app.config['TRAJECTORY_FOLDER'], session.pop('trajectory', None))
     tmax = 10   # FIXME: hard code this or load it from the form?
     return jsonify({'status': 'Status: Simulation reset', 'tmax':tmax}) 
 
@@ -342,17 +574,87 @@ def getSelectedReactionParams(): # when you change which parameter is selected,
     #print(f"DEBUG/getSelectedReactionParams w:{w}, n:{n}, ec50:{ec50}")
     return jsonify({'status': 'Status: Updated reaction parameters', 'w':w, 'n':n, 'ec50':ec50})
 
+@app.route('/editModel', methods=['POST'])
+def editModel():    # adds, removes or changes a reaction rule or species of the open model (see modelEdit.py)
+    # edit: 'setRule', 'addReaction', 'removeReaction' (reaction: the selected rule, rule, reactionID, w, n, ec50)
+    #       'addSpecies', 'renameSpecies', 'removeSpecies' (species, speciesID, name, y0, ymax, tau)
+    # only the equations of the affected species are regenerated, from the sections kept in the session
+    print("DEBUG: starting editModel()")
+    try:
+        data = request.get_json()
+        edit = data.get('edit')
+        mymodel = session.get('NetfluxModel')
+        if mymodel is None:
+            raise ValueError("No model open")
+        speciesParams = np.array(session.get('speciesParams', []))
+        reactionParams = np.array(session.get('reactionParams', []))
+        reactionRules = session.get('reactionRules', [])
+        with instrumentation.stage('editModel'):
+            if edit in ('setRule', 'removeReaction'):
+                pos = reactionRules.index(data['reaction'])
+                reactionID = mymodel.reactionIDs[pos]
+                if edit == 'setRule':
+                    affected = modelEdit.setRule(mymodel, reactionID, data['rule'])
+                else:
+                    affected = modelEdit.removeReaction(mymodel, reactionID)
+                    reactionParams = np.delete(reactionParams, pos, axis=0)
+            elif edit == 'addReaction':
+                reactionID = data.get('reactionID') or newReactionID(mymodel)
+                params = [float(data.get(name, default)) for name, default in zip(('w', 'n', 'ec50'), modelEdit.DEFAULT_REACTION_PARAMS)]
+                affected = modelEdit.addReaction(mymodel, reactionID, data['rule'], *params)
+                reactionParams = np.vstack([reactionParams.reshape(-1, 3), [params]])
+            elif edit == 'addSpecies':
+                params = [float(data.get(name, default)) for name, default in zip(('y0', 'ymax', 'tau'), modelEdit.DEFAULT_SPECIES_PARAMS)]
+                affected = modelEdit.addSpecies(mymodel, data['speciesID'], data.get('name') or None, *params)
+                speciesParams = np.vstack([speciesParams.reshape(-1, 3), [params]])
+            elif edit == 'renameSpecies':
+                affected = modelEdit.renameSpecies(mymodel, data['species'], data['speciesID'])
+            elif edit == 'removeSpecies':
+                pos = session.get('speciesIDs', []).index(data['species'])
+                affected = modelEdit.removeSpecies(mymodel, data['species'])
+                speciesParams = np.delete(speciesParams, pos, axis=0)
+            else:
+                raise ValueError(f"Unknown model edit: {edit}")
+        with instrumentation.stage('generateODEfile'):
+            ODEfuncText, ODEsections = modelEdit.updateODEfile(mymodel, session.get('ODEsections'), affected)
+
+        if edit in ('addSpecies', 'removeSpecies'): # the stored trajectory has the old species
+            discardJob(session.pop('job', None))
+            trajectoryStore.clear(app.config['TRAJECTORY_FOLDER'], session.pop('trajectory', None))
+        if edit.endswith('Species'):    # saved species IDs may no longer exist
+            session.pop('outputOptions', None)
+        speciesIDs = list(mymodel.speciesIDs)
+        reactionRules = list(mymodel.reactionRules)
+        session['NetfluxModel'] = mymodel
+        session['speciesParams'] = speciesParams
+        session['reactionParams'] = reactionParams
+        session['ODEfuncText'] = ODEfuncText
+        session['ODEsections'] = ODEsections
+        session['speciesIDs'] = speciesIDs
+        session['reactionRules'] = reactionRules
+        print(f"DEBUG/editModel: {edit} regenerated {len(affected)} of {len(speciesIDs)} equations")
+        return jsonify({'status': f'Status: Model edited ({edit})', 'variables': speciesIDs, 'reactionRules': reactionRules})
+    except KeyError as e:
+        return jsonify({'status': f'Status: Error: missing {str(e)}'})
+    except Exception as e:
+        print(f"DEBUG: editModel Exception: {e}")
+        return jsonify({'status': f'Status: Error: {str(e)}'})
+
+def newReactionID(mymodel):
+    # first free reaction ID r<number> for reactions added without an ID
+    reactionIDs = set(mymodel.reactionIDs)
+    number = len(reactionIDs) + 1
+    while f"r{number}" in reactionIDs:
+        number += 1
+    return f"r{number}"
+
 # ------------------- Model Library ---------------------
 
 @app.route('/loadLibrary', methods=['GET'])
 def loadLibrary():
     try:
-        # Load the Excel file
-        filepath = os.path.join(app.config['MODELS_FOLDER'], 'library.xlsx')
-        library = pd.read_excel(filepath)
-        session['library'] = library
-        # Extract the model names (assuming they are in the first column)
-        modelList = library.iloc[:, 0].tolist()  
+        # model names from the shared library index (modelLibrary.py), in library.xlsx order
+        modelList = list(modelLibrary.entries(app.config['MODELS_FOLDER']))
         print(f"DEBUG/loadLibrary: modelList:{modelList}")
         return jsonify(modelList)
     except Exception as e:
@@ -364,14 +666,15 @@ def getModelInfo():
         data = request.get_json()
         selectedModel = data['selectedModel']
         print(f"DEBUG/getModelInfo: selectedModel: {selectedModel}")
-        library = session.get('library',[])
-        row = library[library.iloc[:, 0] == selectedModel]       
-        description = row.iloc[0, 1]
-        imageName = row.iloc[0, 2] 
-        imagepath = os.path.join(app.config['MODELS_FOLDER'], imageName)
-        #print(f"description: {description}")
-        #print(f"imageName: {imageName}")
-        return jsonify({'selectedModel': selectedModel, 'description': description,'imagepath': imagepath})
+        entry = modelLibrary.entries(app.config['MODELS_FOLDER']).get(selectedModel)
+        if entry is None:
+            return jsonify({'description': f'Model {selectedModel} is not in the library', 'imagepath': ''}), 404
+        imagepath = f"/models/{entry.image}" if entry.image else ''
+        #print(f"description: {entry.description}")
+        #print(f"imageName: {entry.image}")
+        return jsonify({'selectedModel': selectedModel, 'description': entry.description, 'imagepath': imagepath,
+                        'thumbnail': f"{imagepath}?width=400" if imagepath else '',
+                        'numSpecies': entry.numSpecies, 'numReactions': entry.numReactions})
     except Exception as e:
         return jsonify({'description': f'Model description could not be loaded. Error: {e}', 'imagepath': ''}), 500
 
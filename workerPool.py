@@ -0,0 +1,53 @@
+# workerPool.py
+# Process pool shared by sensitivity.py, globalSensitivity.py, parameterEstimation.py and batchRunner.py.
+# The large read-only state of a run (compiled model, parameters, data) is sent to each worker once by
+# the pool initializer, tasks only carry what differs between them, and results stream back as they finish.
+#
+#   for result in poolMap(fn, tasks, state, maxWorkers):
+#       ...     # fn(state, task) for every task, in order of completion
+#
+# fn (and setup) must be module-level functions so they can be pickled. setup(state), if given, runs once
+# per worker (e.g. to compile models there) and its result is what fn receives.
+# maxWorkers defaults to the number of cores; with 1 the tasks run in this process, in order, without a pool.
+# At most maxInFlight tasks (default 2 per worker) are submitted at once, so tasks can be a generator.
+# Leaving the loop early, or a task raising, cancels the tasks that have not started.
+
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+# set in each worker process by initWorker
+_worker = {}
+
+def initWorker(state, setup):
+    # pool initializer: keeps the state (after setup) in the worker
+    _worker['state'] = setup(state) if setup is not None else state
+
+def runTask(fn, task):
+    # runs one task in a worker
+    return fn(_worker['state'], task)
+
+def poolMap(fn, tasks, state=None, maxWorkers=None, setup=None, maxInFlight=None):
+    # yields fn(state, task) for every task as each one finishes (order not guaranteed)
+    maxWorkers = maxWorkers or os.cpu_count() or 1
+    if maxWorkers == 1:
+        state = setup(state) if setup is not None else state
+        for task in tasks:
+            yield fn(state, task)
+        return
+    maxInFlight = maxInFlight or 2*maxWorkers
+    with ProcessPoolExecutor(max_workers=maxWorkers, initializer=initWorker, initargs=(state, setup)) as pool:
+        pending = set()
+        try:
+            for task in tasks:
+                pending.add(pool.submit(runTask, fn, task))
+                if len(pending) >= maxInFlight:     # bounded number of tasks in flight
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in pending:  # stop pending work if the caller stops early or a task fails
+                future.cancel()
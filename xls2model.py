@@ -4,45 +4,216 @@
 # This is based roughly on xls2Netflux.m
 #
 # A NetfluxModel has attributes: modelName, speciesIDs, speciesNames, reactionIDs, reactionRules, reactionParams, interactionMatrix, notMatrix
+# interactionMatrix and notMatrix are scipy.sparse (species x reactions) matrices
 # speciesParameters contains: Y0, Ymax, tau parameters
 # reactionParameters contains: w, n, and EC50 parameters
+# IDs, names and rules are tuples indexed from 0 (species i is speciesIDs[i] and row i of the matrices);
+# the parameters are read-only (species x 3) and (reactions x 3) float arrays, so replace them to edit
+# NetfluxModel.to_bytes()/from_bytes() is a versioned binary format, also used when a model is pickled
+# (sessions, modelCache), which is smaller and faster to load than pickling the arrays and matrices
+# Spreadsheets are read with xlsxReader (no pandas); pandas is only imported for legacy .xls files.
 import numpy as np
-import pandas as pd
-import os, traceback, re
+import scipy.sparse as sp
+import os, re, sys, json, struct, zipfile
+import xlsxReader
+
+# tokens of reaction rules: => or ->, & or AND, ! or NOT, species IDs
+TOKEN_PATTERN = re.compile(r"\s*(?:(?P<arrow>=>|->)|(?P<and>&)|(?P<not>!)|(?P<id>(?:[^\s&!+=<>-]|-(?!>))+)|(?P<error>\S))")
+KEYWORDS = {'AND': 'and', 'NOT': 'not'}
+
+MODEL_MAGIC = b'NFXM'
+MODEL_FORMAT_VERSION = 1
+MODEL_HEADER = struct.Struct('<4sHI')    # magic, format version, length of the JSON header
 
 # internal representation of a Netflux2 model
 class NetfluxModel:
-  def __init__(self, modelName, speciesIDs, speciesNames, speciesParams, reactionIDs, reactionRules, reactionParams):
+  # speciesIndex/reactionIndex (ID -> position, first occurrence) and speciesReactions (reactions whose
+  # rule uses each species) are built on first use and reset when the IDs or interactionMatrix are replaced
+  __slots__ = ('modelName', 'speciesNames', 'reactionRules', 'notMatrix', '_speciesIDs', '_reactionIDs',
+               '_speciesParams', '_reactionParams', '_interactionMatrix', '_speciesIndex', '_reactionIndex',
+               '_speciesReactions')
+
+  def __init__(self, modelName, speciesIDs, speciesNames, speciesParams, reactionIDs, reactionRules, reactionParams,
+               interactionMatrix=None, notMatrix=None):
     self.modelName = modelName
     self.speciesIDs = speciesIDs
-    self.speciesNames = speciesNames
+    self.speciesNames = texts(speciesNames)
     self.speciesParams = speciesParams
     self.reactionIDs = reactionIDs
-    self.reactionRules = reactionRules
+    self.reactionRules = texts(reactionRules)
     self.reactionParams = reactionParams
+    self.interactionMatrix = interactionMatrix
+    self.notMatrix = notMatrix
+
+  @property
+  def speciesIDs(self):
+    return self._speciesIDs
+
+  @speciesIDs.setter
+  def speciesIDs(self, values):
+    self._speciesIDs, self._speciesIndex = texts(values), None
+
+  @property
+  def reactionIDs(self):
+    return self._reactionIDs
+
+  @reactionIDs.setter
+  def reactionIDs(self, values):
+    self._reactionIDs, self._reactionIndex = texts(values), None
+
+  @property
+  def speciesParams(self):
+    return self._speciesParams
+
+  @speciesParams.setter
+  def speciesParams(self, values):
+    self._speciesParams = paramArray(values)
+
+  @property
+  def reactionParams(self):
+    return self._reactionParams
+
+  @reactionParams.setter
+  def reactionParams(self, values):
+    self._reactionParams = paramArray(values)
+
+  @property
+  def interactionMatrix(self):
+    return self._interactionMatrix
+
+  @interactionMatrix.setter
+  def interactionMatrix(self, matrix):
+    self._interactionMatrix, self._speciesReactions = matrix, None
+
+  @property
+  def speciesIndex(self):
+    if self._speciesIndex is None:
+      self._speciesIndex = positions(self._speciesIDs)
+    return self._speciesIndex
+
+  @property
+  def reactionIndex(self):
+    if self._reactionIndex is None:
+      self._reactionIndex = positions(self._reactionIDs)
+    return self._reactionIndex
+
+  @property
+  def speciesReactions(self):
+    if self._speciesReactions is None:
+      rowMatrix = sp.csr_matrix(self._interactionMatrix)
+      rowMatrix.sort_indices()
+      self._speciesReactions = tuple(tuple(rowMatrix.indices[rowMatrix.indptr[i]:rowMatrix.indptr[i + 1]].tolist())
+                                     for i in range(rowMatrix.shape[0]))
+    return self._speciesReactions
+
+  def __copy__(self):
+    # shallow copy: shares the (read-only) tuples, arrays and matrices, and the lookups built so far
+    other = NetfluxModel.__new__(NetfluxModel)
+    for name in NetfluxModel.__slots__:
+      setattr(other, name, getattr(self, name))
+    return other
+
+  def __reduce__(self):
+    # pickle (sessions, modelCache) stores to_bytes()
+    return (modelFromBytes, (self.to_bytes(),))
+
+  def __repr__(self):
+    return f"NetfluxModel({self.modelName!r}, {len(self._speciesIDs)} species, {len(self._reactionIDs)} reactions)"
+
+  def to_bytes(self):
+    # versioned binary format: MODEL_HEADER, JSON (name, IDs, names, rules), then the parameter arrays (float64)
+    # and interactionMatrix/notMatrix in CSC form (indptr and indices int32, data int8)
+    matrices = []
+    for matrix in (self._interactionMatrix, self.notMatrix):
+      matrix = sp.csc_matrix(matrix, copy=True)
+      matrix.sum_duplicates()
+      data = matrix.data.astype(np.int8)
+      if not np.array_equal(data, matrix.data):
+        raise ValueError("interactionMatrix and notMatrix entries must be small integers to be stored")
+      matrices.append((matrix.indptr.astype('<i4'), matrix.indices.astype('<i4'), data))
+    header = json.dumps({'modelName': self.modelName, 'speciesIDs': self._speciesIDs, 'speciesNames': self.speciesNames,
+                         'reactionIDs': self._reactionIDs, 'reactionRules': self.reactionRules,
+                         'nnz': [len(data) for indptr, indices, data in matrices]}).encode()
+    parts = [MODEL_HEADER.pack(MODEL_MAGIC, MODEL_FORMAT_VERSION, len(header)), header,
+             self._speciesParams.astype('<f8').tobytes(), self._reactionParams.astype('<f8').tobytes()]
+    for arrays in matrices:
+      parts += [array.tobytes() for array in arrays]
+    return b''.join(parts)
+
+  @classmethod
+  def from_bytes(cls, data):
+    # NetfluxModel from to_bytes(); raises ValueError for other data or format versions
+    data = memoryview(data)
+    if len(data) < MODEL_HEADER.size:
+      raise ValueError("Not a NetfluxModel: too short")
+    magic, version, headerLength = MODEL_HEADER.unpack_from(data)
+    if magic != MODEL_MAGIC:
+      raise ValueError("Not a NetfluxModel")
+    if version != MODEL_FORMAT_VERSION:
+      raise ValueError(f"NetfluxModel format version {version}, expected {MODEL_FORMAT_VERSION}")
+    offset = MODEL_HEADER.size + headerLength
+    header = json.loads(bytes(data[MODEL_HEADER.size:offset]))
+    S, R = len(header['speciesIDs']), len(header['reactionIDs'])
+    def read(dtype, count):
+      nonlocal offset
+      array = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+      offset += array.nbytes
+      return array
+    speciesParams, reactionParams = read('<f8', 3*S).reshape(S, 3), read('<f8', 3*R).reshape(R, 3)
+    matrices = []
+    for nnz in header['nnz']:
+      indptr, indices, values = read('<i4', R + 1), read('<i4', nnz), read(np.int8, nnz)
+      matrices.append(sp.csc_matrix((values.astype(float), indices.astype(np.int32), indptr.astype(np.int32)), shape=(S, R)))
+    return cls(header['modelName'], header['speciesIDs'], header['speciesNames'], speciesParams, header['reactionIDs'],
+               header['reactionRules'], reactionParams, *matrices)
+
+def modelFromBytes(data):
+  # unpickles a NetfluxModel (see NetfluxModel.__reduce__)
+  return NetfluxModel.from_bytes(data)
+
+def texts(values):
+  # tuple of IDs, names or rules; strings are interned, so models share repeated IDs
+  try:
+    return tuple(map(sys.intern, values))   # all strings (from_bytes, edits)
+  except TypeError:
+    values = [value.item() if isinstance(value, np.generic) else value for value in values]
+    return tuple([sys.intern(value) if isinstance(value, str) else value for value in values])
+
+def paramArray(values):
+  # read-only (rows x 3) float64 array of parameters
+  array = np.array(values, dtype=float).reshape(-1, 3)
+  array.setflags(write=False)
+  return array
+
+def positions(IDs):
+  # {ID: position}, first occurrence like list.index
+  index = {}
+  for i, ID in enumerate(IDs):
+    index.setdefault(ID, i)
+  return index
 
 def createModel(xlsfilename):
     # creates the NetfluxModel from the spreadsheet in Netflux syntax
     try:
-        # Read the species sheet
-        species_df = pd.read_excel(xlsfilename, sheet_name='species') # what about csv?
+        # Read the species sheet: row 1 is the header, row 2 the module row, species start at row 3
+        species_rows = readSheet(xlsfilename, 'species')[2:] # what about csv?
         
         # Extract Species ID, Species Name, and Species Parameters
-        speciesIDs = species_df.iloc[1:, 1].str.strip()  # Species ID in column B
-        speciesNames = species_df.iloc[1:, 2]  # Species Name in column C
-        speciesParams = species_df.iloc[1:, 3:6] # Y0, Ymax, tau parameters
+        speciesIDs = [ID.strip() if isinstance(ID, str) else ID if ID is None else str(ID) for ID in column(species_rows, 1)]  # Species ID in column B
+        speciesNames = column(species_rows, 2)  # Species Name in column C
+        speciesParams = paramColumns(species_rows, 3) # Y0, Ymax, tau parameters
         #print(f"speciesIDs:{speciesIDs}, speciesNames:{speciesNames}, speciesParams:{speciesParams}")
         
         # Read the reactions sheet
-        reactions_df = pd.read_excel(xlsfilename, sheet_name='reactions')
+        reactions_rows = readSheet(xlsfilename, 'reactions')[2:]
         
         # Extract Reaction IDs, Reaction Rules, and Reaction Parameters
-        reactionIDs = reactions_df.iloc[1:, 1]  # Start Row 2, Column B
-        reactionRules = reactions_df.iloc[1:, 2]  # Start Row 2, Column C
-        reactionParams = reactions_df.iloc[1:,3:6] # w, n, and EC50 parameters
+        reactionIDs = column(reactions_rows, 1)  # Start Row 3, Column B
+        reactionRules = column(reactions_rows, 2)  # Start Row 3, Column C
+        reactionParams = paramColumns(reactions_rows, 3) # w, n, and EC50 parameters
         #print(f"reactionIDs:{reactionIDs}, reactionRules:{reactionRules}, reactionParams:{reactionParams}")
         
-        modelName = os.path.basename(xlsfilename).strip('.xlsx')
+        modelName = modelNameFromFilename(xlsfilename)
         mymodel= NetfluxModel(modelName,speciesIDs,speciesNames,speciesParams,reactionIDs,reactionRules,reactionParams)
     
     # Add more error handling?
@@ -68,58 +239,152 @@ def createModel(xlsfilename):
     
     return mymodel
 
+def readSheet(xlsfilename, sheetName):
+    # rows of a sheet (xlsxReader.readSheet); legacy .xls files are read with pandas, when installed
+    if zipfile.is_zipfile(xlsfilename) or not os.path.exists(xlsfilename):
+        return xlsxReader.readSheet(xlsfilename, sheetName)
+    import pandas as pd
+    sheet = pd.read_excel(xlsfilename, sheet_name=sheetName, header=None, dtype=object)
+    return [[None if pd.isna(value) else value for value in row] for row in sheet.values.tolist()]
+
+def column(rows, i):
+    # column i of the rows (None where a row is shorter)
+    return [row[i] if i < len(row) else None for row in rows]
+
+def paramColumns(rows, first):
+    # (rows x 3) parameters from columns first..first+2, NaN for empty cells
+    return [[np.nan if value is None else value for value in (list(row[first:first + 3]) + [None]*3)[:3]] for row in rows]
+
+def modelNameFromFilename(xlsfilename):
+    # model name used by createModel for an xlsx file
+    return os.path.basename(xlsfilename).strip('.xlsx')
+
 def createInteractionMatrix(mymodel):
     # Creates n x m interaction matrix from reactionRules
     # createInteractionMatrix is called by createModel()
     # 4/2025: handles both old syntax (A & !B => C) and new syntax (A AND NOT B -> C)
+    # Rules are tokenized by parseReactionRule and species are looked up in a dict, so this is
+    # linear in the total rule length. interactionMatrix (-1 reactant, 1 product) and notMatrix
+    # (1 for inhibiting reactants) are scipy.sparse CSC matrices, one column per reaction.
+    # All rule errors are collected and raised together in one exception.
     
-    # Initialize interaction matrix and not matrix
-    speciesIDs = mymodel.speciesIDs.tolist()
-    reactionIDs = mymodel.reactionIDs.tolist()
-    reactionRules = mymodel.reactionRules.tolist()
-    interaction_matrix = np.zeros((len(speciesIDs), len(reactionRules)))
-    not_matrix = np.zeros((len(speciesIDs), len(reactionRules)))
-    try:
-        # Fill interaction matrix
-        for i, rule in enumerate(reactionRules, start=0):
-            #print(f"DEBUG/createInteractionMatrix: reactionID:{reactionIDs[i]}, reaction:{rule}")
-            reactants, product = re.split(r'->|=>', rule) # split with => or -> ; only 1 product allowed
-            #print(f"DEBUG/createInteractionMatrix: reactants:{reactants}") # parsing problems here sometimes caused by use of "+" instead of "&"
-            
-            reactants = re.split(r'&|AND', reactants) # OLD CODE: reactants.split('&')
-            #print(f"DEBUG/createInteractionMatrix: reactants:{reactants}") # parsing problems here sometimes caused by use of "+" instead of "&"
-            
-            for reactant in reactants:
-                reactant = reactant.strip()
-                if reactant: 
-                    if '!' in reactant or 'NOT' in reactant:        # handles old !X or new NOT X syntax
-                        reactant = reactant.replace('!', '')       
-                        reactant = reactant.replace('NOT ', '')    
-                        reactantNum = speciesIDs.index(reactant)    
-                        not_matrix[reactantNum, i] = 1 # reactant is inhibiting
-                    else:
-                        reactantNum = speciesIDs.index(reactant) 
-                    interaction_matrix[reactantNum, i] = -1  # add reactant
-            #print(f"DEBUG/createInteractionMatrix: reactant:{reactant}")   
-            
-            product = product.strip()
-            if product:
-                #print(f"DEBUG/createInteractionMatrix: product: {product}")
-                productNum = speciesIDs.index(product)
-                interaction_matrix[productNum, i] = 1  # add product
-            #print(f"DEBUG/xls2model/createInteractionMatrix: reaction {rule}, reactant:{reactant}, product:{product}")
+    speciesIDs = list(mymodel.speciesIDs)
+    reactionRules = list(mymodel.reactionRules)
+    reactionIDs = list(mymodel.reactionIDs) or [f"reaction {i+1}" for i in range(len(reactionRules))]
+    speciesIndex = mymodel.speciesIndex   # first occurrence, like list.index
+    
+    rows, cols, values, notRows, notCols = [], [], [], [], []
+    errors = []
+    for i, rule in enumerate(reactionRules):
+        try:
+            entries, inhibitors = ruleEntries(rule, speciesIndex)
+        except ValueError as e:
+            errors.append(f"reaction {reactionIDs[i]} '{rule}': {e}")
+            continue
+        for speciesNum, value in entries.items():
+            rows.append(speciesNum)
+            cols.append(i)
+            values.append(value)
+        notRows.extend(inhibitors)  # reactants that are inhibiting
+        notCols.extend([i]*len(inhibitors))
     
-    except (ValueError, IndexError) as e:
-        lineno = traceback.extract_tb(e.__traceback__)[-1].lineno
-        print(f"Error in xls2model.createInteractionMatrix on line {lineno}: :{e}")
-        error_message = f"{type(e).__name__} reading reaction {reactionIDs[i]}:{rule}, reactant:{reactant}, product:{product}. "
-        raise Exception(error_message) from e
+    if errors:
+        print(f"Error in xls2model.createInteractionMatrix: {len(errors)} reaction rule errors")
+        raise ValueError(f"{len(errors)} error(s) in reaction rules: " + "; ".join(errors))
     
-    #print(f"createInteractionMatrix: {interaction_matrix}")
-    mymodel.interactionMatrix = interaction_matrix
-    mymodel.notMatrix = not_matrix
-    #print("DEBUG: at bottom of createInteractionMatrix")
+    shape = (len(speciesIDs), len(reactionRules))
+    mymodel.interactionMatrix = sp.csc_matrix((np.array(values, dtype=float), (rows, cols)), shape=shape)
+    mymodel.notMatrix = sp.csc_matrix((np.ones(len(notRows)), (notRows, notCols)), shape=shape)
     return mymodel
+
+def ruleEntries(rule, speciesIndex):
+    # interaction matrix column of one rule: ({speciesNum: -1 reactant or 1 product}, [inhibiting speciesNum])
+    # speciesIndex maps species IDs to species numbers; raises ValueError for syntax errors and unknown species
+    reactants, product = parseReactionRule(rule)
+    entries, inhibitors = {}, []
+    for reactant, inhibiting in reactants:
+        if reactant not in speciesIndex:
+            raise ValueError(f"unknown reactant '{reactant}'")
+        reactantNum = speciesIndex[reactant]
+        entries[reactantNum] = -1   # add reactant
+        if inhibiting:
+            inhibitors.append(reactantNum) # reactant is inhibiting
+    if product is not None:
+        if product not in speciesIndex:
+            raise ValueError(f"unknown product '{product}'")
+        entries[speciesIndex[product]] = 1  # add product
+    return entries, inhibitors
+
+def reactionIncidence(mymodel):
+    # lists built in one pass over the (sparse or dense) interaction and not matrices:
+    # productReactions[speciesNum]: reactions where the species is the product, in order
+    # reactants[rcnID]: (speciesNum, inhibiting) for each reactant, in species order
+    interactionMatrix = sp.csc_matrix(mymodel.interactionMatrix, copy=True)
+    interactionMatrix.sum_duplicates()
+    numSpecies, numReactions = interactionMatrix.shape
+    inhibiting = set(zip(*sp.csc_matrix(mymodel.notMatrix).nonzero()))
+    productReactions = [[] for _ in range(numSpecies)]
+    reactants = [[] for _ in range(numReactions)]
+    entries = interactionMatrix.tocoo()
+    for speciesNum, rcnID, value in zip(entries.row.tolist(), entries.col.tolist(), entries.data.tolist()):
+        if value == 1:
+            productReactions[speciesNum].append(rcnID)
+        elif value == -1:
+            reactants[rcnID].append((speciesNum, (speciesNum, rcnID) in inhibiting))
+    return productReactions, reactants
+
+def tokenizeReactionRule(rule):
+    # splits a rule into (kind, text) tokens; kind is 'arrow', 'and', 'not', 'id', or 'error'
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(rule):
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == 'id' and text in KEYWORDS:
+            kind = KEYWORDS[text]
+        tokens.append((kind, text))
+    return tokens
+
+def parseReactionRule(rule):
+    # parses 'A & !B => C' or 'A AND NOT B -> C' into ([(reactant, inhibiting), ...], product)
+    # product is None for rules without one; raises ValueError describing the syntax error
+    if not isinstance(rule, str) or not rule.strip():
+        raise ValueError("empty reaction rule")
+    tokens = tokenizeReactionRule(rule)
+    kinds = [kind for kind, text in tokens]
+    for kind, text in tokens:
+        if kind == 'error':
+            hint = " (use '&' for AND gates, '+' is deprecated)" if text == '+' else ""
+            raise ValueError(f"unexpected '{text}'{hint}")
+    if kinds.count('arrow') != 1:
+        raise ValueError("expected exactly one '=>' or '->'")
+    arrow = kinds.index('arrow')
+    
+    reactants = []
+    expectReactant = False  # True after '&'
+    inhibiting = False
+    for kind, text in tokens[:arrow]:
+        if kind == 'not':
+            if inhibiting:
+                raise ValueError("repeated NOT")
+            inhibiting = True
+        elif kind == 'id':
+            if reactants and not expectReactant:
+                raise ValueError(f"missing '&' before '{text}'")
+            reactants.append((text, inhibiting))
+            inhibiting, expectReactant = False, False
+        elif kind == 'and':
+            if not reactants or expectReactant or inhibiting:
+                raise ValueError("'&' must join two reactants")
+            expectReactant = True
+    if expectReactant or inhibiting:
+        raise ValueError("missing reactant before '=>'")
+    
+    productTokens = tokens[arrow+1:]
+    if not productTokens:
+        return reactants, None
+    if len(productTokens) > 1 or productTokens[0][0] != 'id':
+        raise ValueError("only one product allowed, without '&' or NOT")
+    return reactants, productTokens[0][1]
     
 # for debugging xls2model.createInteractionMatrix in isolation
 if __name__ == "__main__":
@@ -127,7 +392,7 @@ if __name__ == "__main__":
     # # testing with model: ['A & B => C', 'B => A']
     # # current error on line 80
     # mymodel = NetfluxModel("net",[],[],[],[],[],[])
-    # mymodel.speciesIDs = np.array(['A','B','C'])
+    # mymodel.speciesIDs = ['A','B','C']
     # #mymodel.reactionRules = np.array(['A & B => C', 'B => A'])
     # mymodel.reactionRules = np.array(['A AND NOT B => C', 'B => A'])
     # mymodel = createInteractionMatrix(mymodel)
@@ -0,0 +1,149 @@
+# xlsxReader.py
+# Small streaming reader for .xlsx worksheets (zipfile + xml.etree iterparse), so that loading a
+# Netflux model needs neither pandas nor openpyxl. Only cell values are read: shared and inline
+# strings, numbers (int when integral, as pandas.read_excel gives them), booleans, and the cached
+# value of formulas; empty and error cells are None. Styles, dates and merged cells are ignored.
+#
+# readSheet(filename, sheetName=None) returns the rows of a sheet (the first sheet for None) as lists
+#     of the same length, starting at cell A1; trailing empty rows are dropped like pandas.read_excel
+# sheetNames(filename) lists the sheets in workbook order
+# Raises ValueError for a missing sheet, or for files that are not xlsx (zip) workbooks.
+
+import posixpath, re, zipfile
+from xml.etree.ElementTree import iterparse
+
+CELL_REFERENCE = re.compile(r'([A-Z]+)(\d*)')
+OFFICE_DOCUMENT = '/officeDocument'     # end of the relationship type of the workbook part
+SHARED_STRINGS = '/sharedStrings'
+
+def localName(tag):
+    # element name without its namespace (also accepts the Strict OOXML namespaces)
+    return tag.rsplit('}', 1)[-1]
+
+def attribute(element, name):
+    # attribute by local name, with or without a namespace
+    for key, value in element.attrib.items():
+        if localName(key) == name:
+            return value
+    return None
+
+def relationships(archive, part):
+    # {id: (type, target path in the archive)} of the relationships of part
+    folder, name = posixpath.split(part)
+    relsPath = posixpath.join(folder, '_rels', name + '.rels')
+    if relsPath not in archive.namelist():
+        return {}
+    result = {}
+    with archive.open(relsPath) as f:
+        for event, element in iterparse(f):
+            if localName(element.tag) == 'Relationship':
+                target = element.get('Target')
+                path = target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join(folder, target))
+                result[element.get('Id')] = (element.get('Type', ''), path)
+    return result
+
+def workbookParts(archive):
+    # (workbook path, {sheet name: worksheet path} in workbook order, shared strings path or None)
+    workbook = next((path for kind, path in relationships(archive, '').values() if kind.endswith(OFFICE_DOCUMENT)),
+                    'xl/workbook.xml')
+    rels = relationships(archive, workbook)
+    sheets = {}
+    with archive.open(workbook) as f:
+        for event, element in iterparse(f):
+            if localName(element.tag) == 'sheet':
+                sheets[element.get('name')] = rels[attribute(element, 'id')][1]
+    strings = next((path for kind, path in rels.values() if kind.endswith(SHARED_STRINGS)), None)
+    return workbook, sheets, strings
+
+def openWorkbook(filename):
+    # zipfile.ZipFile of an xlsx file; ValueError if it is not one
+    try:
+        return zipfile.ZipFile(filename)
+    except zipfile.BadZipFile:
+        raise ValueError(f"{filename} is not an xlsx workbook") from None
+
+def sheetNames(filename):
+    # names of the sheets, in workbook order
+    with openWorkbook(filename) as archive:
+        return list(workbookParts(archive)[1])
+
+def sharedStrings(archive, path):
+    # the shared string table (rich text runs joined, phonetic runs left out)
+    strings = []
+    if path is None or path not in archive.namelist():
+        return strings
+    with archive.open(path) as f:
+        parts, skip = [], 0
+        for event, element in iterparse(f, events=('start', 'end')):
+            name = localName(element.tag)
+            if name == 'rPh':
+                skip += 1 if event == 'start' else -1
+            elif event == 'end' and name == 't' and not skip:
+                parts.append(element.text or '')
+            elif event == 'end' and name == 'si':
+                strings.append(''.join(parts))
+                parts = []
+                element.clear()
+    return strings
+
+def cellValue(cell, strings):
+    # value of a <c> element
+    kind = cell.get('t', 'n')
+    if kind == 'inlineStr':
+        return ''.join(t.text or '' for t in cell.iter() if localName(t.tag) == 't')
+    value = next((child.text for child in cell if localName(child.tag) == 'v'), None)
+    if value is None or kind == 'e':
+        return None
+    if kind == 's':
+        return strings[int(value)]
+    if kind in ('str', 'd'):
+        return value
+    if kind == 'b':
+        return value == '1'
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+def columnNumber(letters):
+    # 0-based column number of 'A', 'B', ..., 'AA'
+    number = 0
+    for letter in letters:
+        number = 26*number + ord(letter) - 64
+    return number - 1
+
+def readSheet(filename, sheetName=None):
+    # rows of a worksheet as equal-length lists of cell values (None for empty cells)
+    with openWorkbook(filename) as archive:
+        workbook, sheets, stringsPath = workbookParts(archive)
+        if sheetName is None:
+            sheetName = next(iter(sheets), None)
+        if sheetName not in sheets:
+            raise ValueError(f"Worksheet named '{sheetName}' not found")
+        strings = sharedStrings(archive, stringsPath)
+        rows = {}
+        with archive.open(sheets[sheetName]) as f:
+            rowNum = -1
+            for event, element in iterparse(f):
+                name = localName(element.tag)
+                if name != 'row':
+                    continue
+                rowNum = int(element.get('r')) - 1 if element.get('r') else rowNum + 1
+                cells, colNum = {}, -1
+                for cell in element:
+                    if localName(cell.tag) != 'c':
+                        continue
+                    match = CELL_REFERENCE.match(cell.get('r', ''))
+                    colNum = columnNumber(match.group(1)) if match else colNum + 1
+                    value = cellValue(cell, strings)
+                    if value is not None:
+                        cells[colNum] = value
+                if cells:
+                    rows[rowNum] = cells
+                element.clear()
+    if not rows:
+        return []
+    width = 1 + max(max(cells) for cells in rows.values())
+    table = [[None]*width for _ in range(1 + max(rows))]
+    for rowNum, cells in rows.items():
+        for colNum, value in cells.items():
+            table[rowNum][colNum] = value
+    return table